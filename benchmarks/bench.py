@@ -0,0 +1,708 @@
+#!/usr/bin/env python3
+"""
+GPTCode-Benchmarks – Headless- und REPL-Läufe gegen einen lokalen OpenAI-Ersatz
+- Start: `python benchmarks/bench.py` (alle Workloads) oder `--workload tail_file --workload repl`
+- Antworten kommen geskriptet von `FakeOpenAI` (`/v1/chat/completions`, Latenz per `--latency`)
+- Messwerte: Wandzeit, Peak-RSS, Overhead pro Schritt (Schrittdauer ohne Modellaufruf), Verlaufsgröße,
+  Schrittlatenz p50/p95, Anteil gecachter Prompt-Tokens (simuliertes Präfix-Caching), HTTP-Verbindungen
+- `startup`: Importzeit von gptcode.py in einem frischen Interpreter (Median aus mehreren Prozessen)
+- Baselines: `--update-baseline` schreibt `benchmarks/baseline.json`, `--check` meldet Regressionen (Exit-Code 1)
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+GPTCODE = ROOT / "gptcode.py"
+BASELINE_FILE = Path(__file__).resolve().parent / "baseline.json"
+MiB = 1024 * 1024
+
+# Kennzahl → (absolute Mindestabweichung, Einheit); kleinere Abweichungen gelten als Rauschen.
+METRICS = {
+    "wall_s": (0.25, "s"),
+    "peak_rss_mb": (8.0, "MiB"),
+    "step_overhead_ms": (5.0, "ms"),
+    "history_kb": (1.0, "KiB"),
+    "step_p95_ms": (20.0, "ms"),
+    "cached_ratio": (0.05, ""),
+    "import_ms": (20.0, "ms"),
+}
+HIGHER_IS_BETTER = {"cached_ratio"}
+# Wie beim Anbieter: Präfix-Caching erst ab 1024 Tokens, danach in 128er-Blöcken.
+CACHE_MIN_TOKENS, CACHE_BLOCK_TOKENS = 1024, 128
+FAST_LATENCY_FACTOR = 0.25  # Latenz des schnellen Modells relativ zu --latency
+
+
+class FakeOpenAI:
+    """Lokaler Ersatz für die Chat-Completions-API mit geskripteten Antworten.
+
+    Jede Antwort ist ``{"content": "..."}``, ``{"tool_calls": [(name, args), ...]}`` oder
+    ``{"status": 429, "retry_after": 0.05}`` (Fehler mit ``retry-after-ms``); sie werden in
+    Reihenfolge ausgeliefert, danach meldet der Server „Fertig.“. ``cached_tokens`` in der
+    Usage simuliert Präfix-Caching: gemeinsames Präfix (Tools, dann Nachrichten) mit einer
+    früheren Anfrage desselben Modells.
+    """
+
+    def __init__(
+        self,
+        replies: List[Dict[str, Any]],
+        latency: float = 0.0,
+        fast_model: Optional[str] = None,
+    ) -> None:
+        self.replies = list(replies)
+        self.latency = latency
+        self.fast_model = fast_model
+        self.fast_requests = 0
+        self.requests = 0
+        self.errors = 0
+        self.connections = 0
+        self.prompt_tokens = self.cached_total = 0
+        self._prefixes: List[str] = []
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def cached_tokens(self, request: Dict[str, Any]) -> int:
+        # Der Cache des Anbieters gilt pro Modell – Routing-Wechsel treffen ihn nicht.
+        canonical = (
+            str(request.get("model"))
+            + "\n"
+            + json.dumps(request.get("tools") or [], ensure_ascii=False)
+            + json.dumps(request.get("messages") or [], ensure_ascii=False)
+        )
+        with self._lock:
+            common = max(
+                (_common_prefix(canonical, old) for old in self._prefixes), default=0
+            )
+            self._prefixes = (self._prefixes + [canonical])[-16:]
+        tokens = common // 4
+        return (
+            tokens // CACHE_BLOCK_TOKENS * CACHE_BLOCK_TOKENS
+            if tokens >= CACHE_MIN_TOKENS
+            else 0
+        )
+
+    @property
+    def cached_ratio(self) -> float:
+        return (
+            round(self.cached_total / self.prompt_tokens, 3)
+            if self.prompt_tokens
+            else 0.0
+        )
+
+    def next_reply(self) -> Tuple[int, Dict[str, Any]]:
+        with self._lock:
+            index = self.requests
+            self.requests += 1
+            reply = self.replies.pop(0) if self.replies else {"content": "Fertig."}
+            if reply.get("status"):
+                self.errors += 1
+        return index, reply
+
+    def next_completion(
+        self,
+        request: Dict[str, Any],
+        prompt_bytes: int,
+        index: int,
+        reply: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        message: Dict[str, Any] = {"role": "assistant", "content": reply.get("content")}
+        calls = reply.get("tool_calls") or []
+        if calls:
+            message["tool_calls"] = [
+                {
+                    "id": f"call_{index}_{i}",
+                    "type": "function",
+                    "function": {"name": name, "arguments": json.dumps(args)},
+                }
+                for i, (name, args) in enumerate(calls)
+            ]
+        completion_tokens = max(1, len(json.dumps(message)) // 4)
+        prompt_tokens = prompt_bytes // 4
+        cached = min(prompt_tokens, self.cached_tokens(request))
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.cached_total += cached
+        return {
+            "id": f"chatcmpl-bench-{index}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "bench"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": message,
+                    "finish_reason": "tool_calls" if calls else "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached},
+            },
+        }
+
+    def start(self) -> str:
+        """Startet den Server auf einem freien Port und liefert die ``base_url``."""
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = (
+                "HTTP/1.1"  # Keep-alive, damit Verbindungswiederverwendung messbar ist
+            )
+            disable_nagle_algorithm = (
+                True  # Header und Body getrennt geschrieben – sonst ~40 ms Delayed-ACK
+            )
+
+            def setup(self) -> None:
+                super().setup()
+                with fake._lock:
+                    fake.connections += 1
+
+            def do_POST(self) -> None:  # noqa: N802
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self.send_error(404)
+                    return
+                index, reply = fake.next_reply()
+                if reply.get("status"):
+                    payload = json.dumps(
+                        {
+                            "error": {
+                                "message": "Rate limit (bench)",
+                                "type": "rate_limit",
+                            }
+                        }
+                    ).encode()
+                    self.send_response(int(reply["status"]))
+                    self.send_header(
+                        "retry-after-ms",
+                        str(int(1000 * float(reply.get("retry_after", 0.05)))),
+                    )
+                else:
+                    request = json.loads(body or b"{}")
+                    fast = (
+                        fake.fast_model is not None
+                        and request.get("model") == fake.fast_model
+                    )
+                    if fast:
+                        with fake._lock:
+                            fake.fast_requests += 1
+                    if fake.latency:
+                        time.sleep(
+                            fake.latency * (FAST_LATENCY_FACTOR if fast else 1.0)
+                        )
+                    payload = json.dumps(
+                        fake.next_completion(request, len(body), index, reply)
+                    ).encode()
+                    self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _common_prefix(a: str, b: str) -> int:
+    """Länge des gemeinsamen Präfixes (Binärsuche über Slice-Vergleiche statt Zeichenschleife)."""
+
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _write_lines(
+    path: Path,
+    size: int,
+    template: str = "{i:09d} INFO worker heartbeat ok latency=12ms\n",
+) -> int:
+    """Schreibt Zeilen bis ``size`` Bytes und liefert die Zeilenzahl."""
+
+    count = written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        chunk: List[str] = []
+        while written < size:
+            line = template.format(i=count)
+            chunk.append(line)
+            written += len(line)
+            count += 1
+            if len(chunk) >= 10000:
+                f.write("".join(chunk))
+                chunk = []
+        f.write("".join(chunk))
+    return count
+
+
+def _tool_steps(calls: List[Tuple[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    return [{"tool_calls": [call]} for call in calls] + [{"content": "Fertig."}]
+
+
+def workload_tail_file(
+    work: Path, scale: float
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    _write_lines(work / "app.log", int(64 * MiB * scale))
+    calls = [("tail_file", {"path": "app.log", "lines": 500})] * 5
+    calls += [("tail_file", {"path": "app.log", "follow": True})] * 5
+    return _tool_steps(calls), []
+
+
+def workload_read_file(
+    work: Path, scale: float
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    lines = _write_lines(work / "huge.txt", int(128 * MiB * scale))
+    calls = [
+        ("read_file", {"path": "huge.txt"}),
+        (
+            "read_file",
+            {
+                "path": "huge.txt",
+                "start_line": lines // 2,
+                "end_line": lines // 2 + 200,
+            },
+        ),
+        ("read_file", {"path": "huge.txt", "start_line": max(1, lines - 100)}),
+        (
+            "read_file",
+            {"path": "huge.txt", "offset": int(100 * MiB * scale), "length": 32 * 1024},
+        ),
+    ] * 3
+    return _tool_steps(calls), []
+
+
+def workload_list_dir(
+    work: Path, scale: float
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    dirs, files = max(2, int(50 * scale)), 100
+    for d in range(dirs):
+        pkg = work / "src" / f"pkg{d:03d}" / "sub"
+        pkg.mkdir(parents=True)
+        for i in range(files):
+            (pkg.parent if i % 2 else pkg).joinpath(f"mod{i:03d}.py").write_text(
+                f"def func_{i}():\n    return {i}  # needle{i % 7}\n", encoding="utf-8"
+            )
+    (work / ".gitignore").write_text("build/\n", encoding="utf-8")
+    calls = [
+        ("list_dir", {"path": ".", "depth": 3}),
+        ("list_dir", {"path": "src", "depth": 2, "glob": "*.py"}),
+        ("find_files", {"pattern": "mod042.py"}),
+        ("search", {"query": "needle3"}),
+        ("list_dir", {"path": ".", "depth": 3}),
+    ]
+    return _tool_steps(calls), []
+
+
+def workload_run_chatty(
+    work: Path, scale: float
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    lines = max(1000, int(2_000_000 * scale))
+    calls = [
+        ("run", {"cmd": f"seq 1 {lines}"}),
+        (
+            "run",
+            {
+                "cmd": f"yes 'build: compiling module with a rather long progress line' | head -n {lines // 4}"
+            },
+        ),
+        ("run", {"cmd": f"seq 1 {lines} >&2"}),
+    ] * 2
+    return _tool_steps(calls), []
+
+
+def workload_long_session(
+    work: Path, scale: float
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    (work / "notes.txt").write_text(
+        "".join(f"Zeile {i}\n" for i in range(200)), encoding="utf-8"
+    )
+    cycle = [
+        ("read_file", {"path": "notes.txt", "start_line": 1, "end_line": 40}),
+        ("run", {"cmd": "echo schritt"}),
+        ("list_dir", {"path": "."}),
+        ("write_file", {"path": "out.txt", "content": "x" * 512}),
+    ]
+    steps = max(5, int(100 * scale))
+    return _tool_steps([cycle[i % len(cycle)] for i in range(steps - 1)]), []
+
+
+def workload_repl(work: Path, scale: float) -> Tuple[List[Dict[str, Any]], List[str]]:
+    for folder in (work, work / "sub"):
+        folder.mkdir(exist_ok=True)
+        (folder / "notes.txt").write_text("hallo\n" * 100, encoding="utf-8")
+    turns = max(3, int(30 * scale))
+    replies = [
+        {"tool_calls": [("read_file", {"path": "notes.txt"})]} for _ in range(turns)
+    ]
+    lines: List[str] = []
+    for i in range(turns):
+        if i % 5 == 4:  # Verzeichniswechsel dürfen das Prompt-Präfix nicht entwerten
+            lines.append(":cd sub" if i % 10 == 4 else ":cd ..")
+        lines.append(f"Schritt {i}")
+    return replies, lines + [":stats", ":quit"]
+
+
+def workload_flaky_api(
+    work: Path, scale: float
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    (work / "notes.txt").write_text(
+        "".join(f"Zeile {i}\n" for i in range(200)), encoding="utf-8"
+    )
+    steps: List[Dict[str, Any]] = []
+    for step in _tool_steps(
+        [("read_file", {"path": "notes.txt", "start_line": 1, "end_line": 80})]
+        * max(4, int(20 * scale))
+    ):
+        steps += [{"status": 429, "retry_after": 0.02}] * 3 + [
+            step
+        ]  # mehr als die SDK-Vorgabe von 2 Wiederholungen
+    return steps, []
+
+
+WORKLOADS: Dict[
+    str, Callable[[Path, float], Tuple[List[Dict[str, Any]], List[str]]]
+] = {
+    "tail_file": workload_tail_file,
+    "read_file": workload_read_file,
+    "list_dir": workload_list_dir,
+    "run_chatty": workload_run_chatty,
+    "long_session": workload_long_session,
+    "repl": workload_repl,
+    "flaky_api": workload_flaky_api,
+}
+
+
+IMPORT_PROBE = """
+import importlib.util, sys, time
+path = sys.argv[1]
+spec = importlib.util.spec_from_file_location("gptcode", path)
+module = importlib.util.module_from_spec(spec)
+code = compile(open(path, encoding="utf-8").read(), path, "exec")  # entspricht einem vorhandenen .pyc
+started = time.perf_counter()
+exec(code, module.__dict__)
+print(time.perf_counter() - started)
+"""
+STARTUP_RUNS = 7
+
+
+def run_startup() -> Dict[str, Any]:
+    """Misst die Importzeit von gptcode.py (ohne Kompilieren) als Median über mehrere Prozesse."""
+
+    times = sorted(
+        float(
+            subprocess.run(
+                [sys.executable, "-c", IMPORT_PROBE, str(GPTCODE)],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+        )
+        for _ in range(STARTUP_RUNS)
+    )
+    return {"import_ms": round(times[len(times) // 2] * 1000, 2)}
+
+
+def summarize_trace(path: Path) -> Dict[str, Any]:
+    """Verdichtet die JSONL-Spans aus ``--trace`` zu Kennzahlen pro Lauf."""
+
+    steps: Dict[int, float] = {}
+    model: Dict[int, float] = {}
+    history = 0
+    for line in path.read_text(encoding="utf-8").splitlines():
+        span = json.loads(line)
+        if span["kind"] == "step":
+            steps[span["step"]] = span["duration"]
+        elif span["kind"] == "model":
+            model[span["step"]] = model.get(span["step"], 0.0) + span["duration"]
+            history = max(history, int(span.get("history_bytes") or 0))
+    overhead = [steps[s] - model.get(s, 0.0) for s in steps]
+    durations = sorted(steps.values()) or [0.0]
+    return {
+        "steps": len(steps),
+        "model_ms": round(1000 * sum(model.values()) / max(1, len(model)), 2),
+        "step_overhead_ms": round(1000 * sum(overhead) / max(1, len(overhead)), 2),
+        "step_p50_ms": round(1000 * _percentile(durations, 0.50), 2),
+        "step_p95_ms": round(1000 * _percentile(durations, 0.95), 2),
+        "history_kb": round(history / 1024, 1),
+    }
+
+
+def _percentile(values: List[float], q: float) -> float:
+    """Nearest-rank-Perzentil einer sortierten Liste."""
+
+    return values[min(len(values), max(1, math.ceil(q * len(values)))) - 1]
+
+
+def run_workload(
+    name: str,
+    scale: float = 1.0,
+    latency: float = 0.0,
+    fast_model: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Führt einen Workload in einem eigenen GPTCode-Prozess aus und liefert die Messwerte."""
+
+    with tempfile.TemporaryDirectory(prefix=f"gptcode-bench-{name}-") as tmp:
+        home, work = Path(tmp) / "home", Path(tmp) / "work"
+        work.mkdir()
+        (home / ".config" / "gptcode").mkdir(parents=True)
+        (home / ".config" / "gptcode" / "config.json").write_text(
+            json.dumps({"api_key": "bench", "model": "bench-model", "dryrun": False}),
+            encoding="utf-8",
+        )
+        replies, stdin_lines = WORKLOADS[name](work, scale)
+        trace = Path(tmp) / "trace.jsonl"
+        fake = FakeOpenAI(replies, latency=latency, fast_model=fast_model)
+        env = dict(
+            os.environ,
+            HOME=str(home),
+            OPENAI_BASE_URL=fake.start(),
+            OPENAI_API_KEY="bench",
+            GPTCODE_PYTEST_SHARDS="1",
+        )
+        cmd = [sys.executable, str(GPTCODE), "--cache", "off", "--trace", str(trace)]
+        if fast_model:
+            cmd += ["--fast-model", fast_model]
+        if stdin_lines:
+            cmd.append("--auto")
+        else:
+            cmd += [
+                "--headless",
+                "--goal",
+                f"Benchmark {name}",
+                "--max-steps",
+                str(len(replies) + 1),
+            ]
+        stderr = Path(tmp) / "stderr.txt"
+        try:
+            with open(stderr, "wb") as err:
+                started = time.perf_counter()
+                proc = subprocess.Popen(
+                    cmd,
+                    cwd=work,
+                    env=env,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.DEVNULL,
+                    stderr=err,
+                )
+                assert proc.stdin is not None
+                proc.stdin.write("".join(f"{line}\n" for line in stdin_lines).encode())
+                proc.stdin.close()
+                _, status, usage = os.wait4(proc.pid, 0)
+                wall = time.perf_counter() - started
+                proc.returncode = os.waitstatus_to_exitcode(status)
+        finally:
+            fake.close()
+        if proc.returncode != 0 or not trace.exists():
+            raise RuntimeError(
+                f"{name}: gptcode endete mit {proc.returncode}\n"
+                + stderr.read_text(encoding="utf-8", errors="replace")[-2000:]
+            )
+        # ru_maxrss: Linux in KiB, macOS in Bytes.
+        rss = usage.ru_maxrss / (MiB if sys.platform == "darwin" else 1024)
+        return {
+            "wall_s": round(wall, 3),
+            "peak_rss_mb": round(rss, 1),
+            "requests": fake.requests,
+            "fast_requests": fake.fast_requests,
+            "rate_limited": fake.errors,
+            "connections": fake.connections,
+            "cached_ratio": fake.cached_ratio,
+            **summarize_trace(trace),
+        }
+
+
+def compare(
+    results: Dict[str, Dict[str, Any]],
+    baseline: Dict[str, Dict[str, Any]],
+    tolerance: float,
+) -> List[str]:
+    """Kennzahlen, die die Baseline um mehr als ``tolerance`` (relativ) und das Rauschminimum übersteigen."""
+
+    regressions = []
+    for name, metrics in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for key, (floor, unit) in METRICS.items():
+            old, new = base.get(key), metrics.get(key)
+            if old is None or new is None:
+                continue
+            if key in HIGHER_IS_BETTER:
+                if new < old * (1 - tolerance) and old - new > floor:
+                    regressions.append(
+                        f"{name}.{key}: {new}{unit} statt {old}{unit} (-{(1 - new / old) * 100:.0f}%)"
+                    )
+            elif new > old * (1 + tolerance) and new - old > floor:
+                regressions.append(
+                    f"{name}.{key}: {new}{unit} statt {old}{unit} (+{(new / old - 1) * 100 if old else 100:.0f}%)"
+                )
+    return regressions
+
+
+def _format_table(results: Dict[str, Dict[str, Any]]) -> str:
+    columns = (
+        "wall_s",
+        "peak_rss_mb",
+        "steps",
+        "step_overhead_ms",
+        "step_p50_ms",
+        "step_p95_ms",
+        "history_kb",
+        "cached_ratio",
+        "connections",
+        "import_ms",
+    )
+    width = max(len("WORKLOAD"), *(len(name) for name in results))
+    lines = ["WORKLOAD".ljust(width) + "".join(f"  {c.upper():>16}" for c in columns)]
+    for name, metrics in results.items():
+        lines.append(
+            name.ljust(width) + "".join(f"  {metrics.get(c, '-'):>16}" for c in columns)
+        )
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="GPTCode-Benchmarks gegen einen lokalen OpenAI-Ersatz"
+    )
+    parser.add_argument(
+        "--workload",
+        action="append",
+        choices=sorted([*WORKLOADS, "startup"]),
+        help="Nur diesen Workload ausführen (mehrfach möglich)",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Faktor für Dateigrößen und Schrittzahlen",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        metavar="SEK",
+        help="Künstliche Modelllatenz pro Anfrage",
+    )
+    parser.add_argument(
+        "--fast-model",
+        metavar="NAME",
+        help="Routing mit schnellem Modell (antwortet mit einem Viertel von --latency)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Läufe pro Workload (Median zählt)",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=str(BASELINE_FILE),
+        metavar="PFAD",
+        help="Baseline-Datei (JSON)",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Mit Baseline vergleichen, Exit-Code 1 bei Regression",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Erlaubte relative Verschlechterung",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Ergebnisse als neue Baseline speichern",
+    )
+    parser.add_argument(
+        "--json", metavar="PFAD", help="Ergebnisse zusätzlich als JSON schreiben"
+    )
+    args = parser.parse_args(argv)
+
+    results: Dict[str, Dict[str, Any]] = {}
+    for name in args.workload or [*WORKLOADS, "startup"]:
+        if name == "startup":
+            results[name] = run_startup()
+            print(f"[bench] startup: {results[name]['import_ms']}ms", file=sys.stderr)
+            continue
+        runs = [
+            run_workload(
+                name, scale=args.scale, latency=args.latency, fast_model=args.fast_model
+            )
+            for _ in range(max(1, args.repeat))
+        ]
+        results[name] = sorted(runs, key=lambda r: r["wall_s"])[len(runs) // 2]
+        print(f"[bench] {name}: {results[name]['wall_s']}s", file=sys.stderr)
+    print(_format_table(results))
+
+    document = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": args.scale,
+        "latency": args.latency,
+        "fast_model": args.fast_model,
+        "workloads": results,
+    }
+    if args.json:
+        Path(args.json).write_text(
+            json.dumps(document, indent=2) + "\n", encoding="utf-8"
+        )
+    if args.update_baseline:
+        Path(args.baseline).write_text(
+            json.dumps(document, indent=2) + "\n", encoding="utf-8"
+        )
+        print(f"[bench] Baseline gespeichert: {args.baseline}", file=sys.stderr)
+    if args.check:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        if (
+            baseline.get("scale"),
+            baseline.get("latency"),
+            baseline.get("fast_model"),
+        ) != (args.scale, args.latency, args.fast_model):
+            print(
+                "[bench] Baseline wurde mit anderem --scale/--latency/--fast-model erstellt.",
+                file=sys.stderr,
+            )
+            return 2
+        regressions = compare(results, baseline.get("workloads", {}), args.tolerance)
+        for line in regressions:
+            print(f"[REGRESSION] {line}")
+        if regressions:
+            return 1
+        print("[bench] Keine Regressionen gegenüber der Baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,14 +3,47 @@
 GPTCode – Chat-first DevOps/Coding Assistent (Claude-Style) fürs Terminal
 - Start: `gptcode` im Projektordner
 - First-Run: fragt API-Key + Modell und legt Config an
-- Tools: list_dir, read_file, write_file, apply_patch, run, tail_file, systemctl, docker, pytest
+- Tools: list_dir, find_files, search, read_file, write_file, edit_file, apply_patch, run, tail_file, systemctl, docker, pytest
 - Modi: :dryrun on/off, :auto on/off, Headless (--headless --goal "..."), CLI-Overrides (--model, --dryrun)
 """
+
 import argparse
-import os, sys, json, subprocess, shutil
+import ast
+import atexit
+import contextvars
+import difflib
+import hashlib
+import importlib.util
+import json
+import mmap
+import os
+import re
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
 from dataclasses import dataclass, field
-from typing import List, Dict, Any, Optional, Tuple
+from typing import TYPE_CHECKING, List, Dict, Any, Optional, Tuple, Callable, Set, Union
+
+if TYPE_CHECKING:
+    # asyncio importieren erst die Async-Einstiegspunkte, damit der Import von gptcode schnell bleibt.
+    import asyncio
+
+    from concurrent.futures import ProcessPoolExecutor
+
 
 CONFIG_DIR = Path(os.path.expanduser("~/.config/gptcode"))
 CONFIG_FILE = CONFIG_DIR / "config.json"
@@ -18,39 +51,129 @@ DEFAULT_MODEL = "gpt-4o-mini"
 DEFAULT_TIMEOUT = int(os.getenv("GPTCODE_TIMEOUT", "60"))  # sec
 DOCKER_LEGACY_ENV = "GPTCODE_DOCKER_COMPOSE_LEGACY"
 _DOCKER_COMPOSE_CMD: Optional[List[str]] = None
+PROBE_FILE = CONFIG_DIR / "probe.json"
+_PROBE_BINARIES = ("git", "docker", "docker-compose", "pytest")
+_PROBE: Optional[Dict[str, Any]] = None
+_PROBE_FILE: Optional[Path] = None
+
+
+def _probe_key() -> str:
+    """Hash über PATH, Legacy-Override und die mtimes der PATH-Verzeichnisse."""
+
+    path = os.environ.get("PATH", "")
+    parts = [path, os.getenv(DOCKER_LEGACY_ENV) or ""]
+    for entry in path.split(os.pathsep):
+        try:
+            parts.append(str(os.stat(entry or ".").st_mtime_ns))
+        except OSError:
+            parts.append("-")
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+def _binary_mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _scan_binaries() -> Dict[str, Optional[str]]:
+    binaries = {name: shutil.which(name) for name in _PROBE_BINARIES}
+    legacy = (os.getenv(DOCKER_LEGACY_ENV) or "").strip()
+    if legacy:
+        binaries["legacy"] = shutil.which(legacy) or (
+            legacy if Path(legacy).exists() else None
+        )
+    return binaries
+
+
+def runtime_probe(cache_file: Optional[Path] = None) -> Dict[str, Any]:
+    """Gefundene Werkzeuge (``binaries``) und ggf. erkannter Compose-Befehl (``compose``).
+
+    Mit ``cache_file`` wird das Ergebnis über Starts hinweg wiederverwendet, solange
+    PATH (samt Verzeichnis-mtimes) und die mtimes der gefundenen Binaries gleich bleiben.
+    """
+
+    global _PROBE, _PROBE_FILE
+    if _PROBE is not None:
+        return _PROBE
+    key = _probe_key()
+    if cache_file is not None:
+        try:
+            cached = json.loads(cache_file.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            cached = None
+        if (
+            isinstance(cached, dict)
+            and cached.get("key") == key
+            and all(
+                _binary_mtime(p) == m for p, m in (cached.get("mtimes") or {}).items()
+            )
+        ):
+            _PROBE, _PROBE_FILE = cached, cache_file
+            return cached
+    binaries = _scan_binaries()
+    _PROBE = {
+        "key": key,
+        "binaries": binaries,
+        "compose": None,
+        "mtimes": {p: _binary_mtime(p) for p in binaries.values() if p},
+    }
+    if cache_file is not None:
+        _PROBE_FILE = cache_file
+        _save_probe()
+    return _PROBE
+
+
+def _save_probe() -> None:
+    if _PROBE is None or _PROBE_FILE is None:
+        return
+    try:
+        _PROBE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        _atomic_write(_PROBE_FILE, json.dumps(_PROBE, indent=2))
+    except OSError:
+        pass
 
 
 def _docker_binaries_present() -> bool:
     """Prüft, ob mindestens ein Docker-/Compose-Binary verfügbar ist."""
 
-    if shutil.which("docker"):
-        return True
-    if shutil.which("docker-compose"):
-        return True
-    legacy_override = os.getenv(DOCKER_LEGACY_ENV)
-    if legacy_override:
-        candidate = legacy_override.strip()
-        if candidate and (shutil.which(candidate) or Path(candidate).exists()):
-            return True
-    return False
+    binaries = runtime_probe()["binaries"]
+    return any(binaries.get(name) for name in ("docker", "docker-compose", "legacy"))
+
 
+# None = noch nicht geprüft; wird beim Start bzw. beim ersten docker-Aufruf ermittelt.
+DOCKER_FEATURES_AVAILABLE: Optional[bool] = None
 
-DOCKER_FEATURES_AVAILABLE: bool = _docker_binaries_present()
+
+def docker_features_available() -> bool:
+    global DOCKER_FEATURES_AVAILABLE
+    if DOCKER_FEATURES_AVAILABLE is None:
+        DOCKER_FEATURES_AVAILABLE = _docker_binaries_present()
+    return DOCKER_FEATURES_AVAILABLE
 
 
 def check_runtime_prerequisites() -> None:
-    """Stellt sicher, dass Kernwerkzeuge im PATH liegen."""
+    """Stellt sicher, dass Kernwerkzeuge im PATH liegen (Ergebnis gecacht in ``PROBE_FILE``)."""
 
-    global DOCKER_FEATURES_AVAILABLE
+    global DOCKER_FEATURES_AVAILABLE, _DOCKER_COMPOSE_CMD
+
+    probe = runtime_probe(PROBE_FILE)
+    if _DOCKER_COMPOSE_CMD is None and probe.get("compose"):
+        _DOCKER_COMPOSE_CMD = list(probe["compose"])
 
     def _present(binary: str) -> bool:
-        return shutil.which(binary) is not None
+        return probe["binaries"].get(binary) is not None
 
     missing_required: List[str] = []
     optional_warnings: List[str] = []
 
     requirements = (
-        ("git", True, "Installiere git (z. B. `sudo apt install git`) oder siehe https://git-scm.com/downloads."),
+        (
+            "git",
+            True,
+            "Installiere git (z. B. `sudo apt install git`) oder siehe https://git-scm.com/downloads.",
+        ),
     )
 
     optional_tools = (
@@ -109,6 +232,7 @@ def check_runtime_prerequisites() -> None:
         )
         sys.exit(1)
 
+
 def ensure_config():
     CONFIG_DIR.mkdir(parents=True, exist_ok=True)
     if CONFIG_FILE.exists():
@@ -122,30 +246,204 @@ def ensure_config():
     CONFIG_FILE.write_text(json.dumps(cfg, indent=2))
     print(f"\n✅ Gespeichert in {CONFIG_FILE}\n")
 
+
 def load_config() -> dict:
     ensure_config()
     return json.loads(CONFIG_FILE.read_text())
 
+
 def save_config(cfg: dict):
     CONFIG_DIR.mkdir(parents=True, exist_ok=True)
     CONFIG_FILE.write_text(json.dumps(cfg, indent=2))
 
-try:
-    from openai import OpenAI
-except Exception:
-    OpenAI = None  # type: ignore[assignment]
+
+def openai_installed() -> bool:
+    """Prüft, ob das openai-SDK installiert ist, ohne es zu importieren."""
+
+    return importlib.util.find_spec("openai") is not None
+
+
+# Abschnitt ``http`` in config.json; Wiederholungen mit exponentiellem Backoff übernimmt das SDK.
+HTTP_DEFAULTS: Dict[str, float] = {
+    "max_retries": 5,
+    "timeout": 120.0,
+    "max_connections": 32,
+    "keepalive_connections": 16,
+    "keepalive_expiry": 90.0,
+}
+_DURATION_PART = r"(\d+(?:\.\d+)?)(ms|h|m|s)"  # erst bei Bedarf kompiliert (Startzeit)
+
+
+def _parse_reset(value: Optional[str]) -> float:
+    """Wartezeit aus ``Retry-After``/``x-ratelimit-reset-*`` (``"20"``, ``"1m30s"``, ``"250ms"``) in Sekunden."""
+
+    if not value:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    scale = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    return sum(float(n) * scale[unit] for n, unit in re.findall(_DURATION_PART, value))
+
+
+class RatePacer:
+    """Bremst alle Anfragen eines Prozesses, sobald der Anbieter ein Rate-Limit meldet.
+
+    Nach einem 429 (``Retry-After``) oder aufgebrauchtem Kontingent
+    (``x-ratelimit-remaining-requests: 0``) warten auch parallele Sitzungen bis
+    zum gemeldeten Reset, statt das Limit weiter anzulaufen.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic) -> None:
+        self.clock = clock
+        self.paused_until = 0.0
+        self.pauses = 0
+        self._lock = threading.Lock()
+
+    def delay(self) -> float:
+        return max(0.0, self.paused_until - self.clock())
+
+    def observe(self, status: int, headers: Any) -> None:
+        wait = 0.0
+        if status == 429:
+            ms = headers.get("retry-after-ms")
+            wait = (
+                float(ms) / 1000
+                if ms
+                else _parse_reset(headers.get("retry-after")) or 1.0
+            )
+        elif headers.get("x-ratelimit-remaining-requests") == "0":
+            wait = _parse_reset(headers.get("x-ratelimit-reset-requests"))
+        elif headers.get("x-ratelimit-remaining-tokens") == "0":
+            wait = _parse_reset(headers.get("x-ratelimit-reset-tokens"))
+        if wait > 0:
+            with self._lock:
+                self.paused_until = max(
+                    self.paused_until, self.clock() + min(wait, 60.0)
+                )
+                self.pauses += 1
+
+    # httpx-Event-Hooks
+    def before(self, request: Any) -> None:
+        delay = self.delay()
+        if delay:
+            time.sleep(delay)
+
+    def after(self, response: Any) -> None:
+        self.observe(response.status_code, response.headers)
+
+    async def before_async(self, request: Any) -> None:
+        import asyncio
+
+        delay = self.delay()
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def after_async(self, response: Any) -> None:
+        self.after(response)
+
+
+RATE_PACER = RatePacer()
+
+
+def http_options(section: Optional[Dict[str, Any]] = None) -> Dict[str, float]:
+    """``HTTP_DEFAULTS`` ergänzt um bekannte Schlüssel aus dem Konfigurationsabschnitt ``http``."""
+
+    return {
+        **HTTP_DEFAULTS,
+        **{k: v for k, v in (section or {}).items() if k in HTTP_DEFAULTS},
+    }
+
+
+class _LazyClient:
+    """Stellvertreter für ``OpenAI``/``AsyncOpenAI``.
+
+    Das SDK wird erst beim ersten Attributzugriff importiert und der Client erst
+    dann erzeugt – Läufe aus Cache oder Cassette starten ohne den teuren Import.
+    Der Client hält Verbindungen offen (Keep-alive), wiederholt 429/5xx mit
+    Backoff und pausiert über ``RATE_PACER`` bei gemeldeten Rate-Limits.
+    """
+
+    def __init__(
+        self, kind: str = "OpenAI", http: Optional[Dict[str, float]] = None
+    ) -> None:
+        self.kind = kind
+        self.http = http_options(http)
+        self._client: Any = None
+        self._lock = threading.Lock()
+
+    def _http_client(self, openai: Any) -> Any:
+        import httpx
+
+        sync = self.kind == "OpenAI"
+        factory = getattr(
+            openai, "DefaultHttpxClient" if sync else "DefaultAsyncHttpxClient", None
+        ) or (httpx.Client if sync else httpx.AsyncClient)
+        hooks = (
+            {"request": [RATE_PACER.before], "response": [RATE_PACER.after]}
+            if sync
+            else {
+                "request": [RATE_PACER.before_async],
+                "response": [RATE_PACER.after_async],
+            }
+        )
+        limits = httpx.Limits(
+            max_connections=int(self.http["max_connections"]),
+            max_keepalive_connections=int(self.http["keepalive_connections"]),
+            keepalive_expiry=float(self.http["keepalive_expiry"]),
+        )
+        return factory(
+            limits=limits, timeout=float(self.http["timeout"]), event_hooks=hooks
+        )
+
+    def get(self) -> Any:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import openai
+
+                    factory = getattr(openai, self.kind, None)
+                    if factory is None:
+                        raise RuntimeError(
+                            f"openai-SDK ohne {self.kind} – bitte aktualisieren."
+                        )
+                    self._client = factory(
+                        max_retries=int(self.http["max_retries"]),
+                        timeout=float(self.http["timeout"]),
+                        http_client=self._http_client(openai),
+                    )
+        return self._client
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.get(), name)
+
 
 SYSTEM_PROMPT_TMPL = (
     "Du bist ein Chat-first DevOps/Coding-Assistent (Claude-Style). "
-    "Arbeite vom aktuellen Ordner aus: {cwd}. "
+    "Arbeite vom aktuellen Ordner aus (steht in der letzten Systemnachricht). "
     "Wenn du Aktionen brauchst, gib **nur JSON** mit einem Tool-Call zurück. "
-    "Schema: {\\n\"tool\": \"list_dir|read_file|write_file|apply_patch|run|tail_file|systemctl|docker|pytest\", \"args\": {...}\\n}. "
-    "Tool-Args: run:{cmd,timeout?,env?}, tail_file:{path,lines?}, systemctl:{action,status|restart|start|stop|daemon-reload,unit}, "
-    "docker:{action,service?}, pytest:{path?,k?}. "
+    'Schema: {{\\n"tool": "<name>", "args": {{...}}\\n}}. '
+    "Tools und Args: {tools}. "
+    "Bestehende Dateien mit edit_file gezielt ändern statt sie per write_file komplett neu zu schreiben. "
+    "Bevor du schreibst/ausführst: kurz begründen und nach Bestätigung fragen (oder im Auto-Modus nur ankündigen). "
+    "Kleine Schritte. Nach jeder Aktion Ergebnis zusammenfassen und nächsten Schritt vorschlagen."
+)
+
+SYSTEM_PROMPT_NATIVE_TMPL = (
+    "Du bist ein Chat-first DevOps/Coding-Assistent (Claude-Style). "
+    "Arbeite vom aktuellen Ordner aus (steht in der letzten Systemnachricht). "
+    "Für Aktionen nutze ausschließlich die bereitgestellten Tools (Function Calling). "
+    "Unabhängige Aktionen darfst du in einer Antwort bündeln, z. B. mehrere Dateien gleichzeitig lesen. "
+    "Bestehende Dateien mit edit_file gezielt ändern statt sie per write_file komplett neu zu schreiben. "
     "Bevor du schreibst/ausführst: kurz begründen und nach Bestätigung fragen (oder im Auto-Modus nur ankündigen). "
     "Kleine Schritte. Nach jeder Aktion Ergebnis zusammenfassen und nächsten Schritt vorschlagen."
 )
 
+# Veränderlicher Zustand steht am Ende der Anfrage, damit System-Prompt, Tool-Schemas
+# und Verlauf ein byte-stabiles Präfix für das Prompt-Caching des Anbieters bilden.
+SESSION_STATE_TMPL = "Arbeitsverzeichnis: {cwd}"
+
 HELP = (
     ":help – Hilfe\n"
     ":cwd – aktuelles Verzeichnis\n"
@@ -153,384 +451,5626 @@ HELP = (
     ":yes / :no – letzte Aktion erlauben/ablehnen\n"
     ":dryrun on|off – Schreib/Ausführ-Dry-Run\n"
     ":auto on|off – Schritte automatisch erlauben (vorsichtig!)\n"
+    ":stream on|off – Antworten live streamen\n"
+    ":shell on|off|reset – persistente Shell für run\n"
+    ":stats – Zeit- und Token-Statistik der Sitzung\n"
+    ":readonly confirm|prefetch|auto – rein lesende Aktionen bestätigen/vorab ausführen/freigeben\n"
     ":quit – beenden\n"
 )
 
-@dataclass
-class Session:
-    client: Any
-    model: str
-    dryrun: bool = False
-    auto: bool = False
-    messages: List[Dict[str, str]] = field(default_factory=list)
-    pending_action: Optional[Dict[str, Any]] = None
-    def add(self, role: str, content: str):
-        self.messages.append({"role": role, "content": content})
-
-def run_model(sess: Session) -> str:
-    sys_prompt = SYSTEM_PROMPT_TMPL.format(cwd=str(Path.cwd()))
-    resp = sess.client.chat.completions.create(
-        model=sess.model,
-        messages=[{"role":"system","content":sys_prompt}] + sess.messages,
-        temperature=0.2,
-    )
-    return resp.choices[0].message.content
+TOOL_RESULT_PREFIX = "ERGEBNIS ("
+SUMMARY_PROMPT = (
+    "Fasse den folgenden Gesprächsverlauf eines DevOps/Coding-Assistenten knapp zusammen. "
+    "Behalte Ziele, getroffene Entscheidungen, geänderte Dateien, Befehle und offene Fehler. "
+    "Antworte nur mit der Zusammenfassung."
+)
 
-def list_dir(path: str) -> str:
-    p = Path(path).expanduser().resolve()
-    if not p.exists():
-        return f"[list_dir] Pfad existiert nicht: {p}"
-    if p.is_file():
-        return f"[list_dir] {p} ist eine Datei"
-    rows=[]
-    for c in sorted(p.iterdir()):
-        k = "d" if c.is_dir() else "f"
-        rows.append(f"{k}\t{c.name}")
-    return f"[list_dir] {p}\n" + "\n".join(rows)
 
-def read_file(path: str) -> str:
-    p = Path(path).expanduser().resolve()
-    if not p.exists() or not p.is_file():
-        return f"[read_file] Datei nicht gefunden: {p}"
+def _encoding_for(model: str):
     try:
-        return p.read_text(encoding="utf-8", errors="ignore")
-    except Exception as e:
-        return f"[read_file] Fehler: {e}"
-
-def write_file(path: str, content: str, dry: bool=False) -> str:
-    p = Path(path).expanduser().resolve()
-    if dry:
-        return f"[write_file:DRYRUN] Würde schreiben: {p} (len={len(content)}B)"
-    p.parent.mkdir(parents=True, exist_ok=True)
+        import tiktoken  # optional und teuer im Import – erst bei Bedarf laden
+    except Exception:
+        return None
     try:
-        old = p.read_text(encoding="utf-8", errors="ignore") if p.exists() else None
-        p.write_text(content, encoding="utf-8")
-        return f"[write_file] Geschrieben: {p} (alt: {len(old or '')}B, neu: {len(content)}B)"
-    except Exception as e:
-        return f"[write_file] Fehler: {e}"
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        try:
+            return tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            return None
 
-def apply_patch(patch_text: str, dry: bool=False) -> str:
-    if dry:
-        return "[apply_patch:DRYRUN] Würde Patch anwenden (git apply -p0)."
-    try:
-        proc = subprocess.run(["git","apply","-p0","-"], input=patch_text.encode(),
-                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if proc.returncode == 0:
-            return "[apply_patch] Patch angewendet."
-        return f"[apply_patch] Fehler (rc={proc.returncode}):\n{proc.stderr.decode()}"
-    except FileNotFoundError:
-        return "[apply_patch] git nicht gefunden. Bitte installieren."
-
-def run(cmd: str, timeout: int=DEFAULT_TIMEOUT, env: Optional[dict]=None) -> str:
-    try:
-        full_env = os.environ.copy()
-        if env:
-            for k,v in env.items():
-                if isinstance(v, str):
-                    full_env[k]=v
-        proc = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                              text=True, timeout=timeout, env=full_env)
-        return f"[run] rc={proc.returncode}\nSTDOUT:\n{proc.stdout}\nSTDERR:\n{proc.stderr}"
-    except subprocess.TimeoutExpired:
-        return f"[run] Timeout nach {timeout}s: {cmd}"
-    except Exception as e:
-        return f"[run] Fehler: {e}"
 
-def tail_file(path: str, lines: int=200) -> str:
-    p = Path(path).expanduser().resolve()
-    if not p.exists() or not p.is_file():
-        return f"[tail_file] Datei nicht gefunden: {p}"
-    try:
-        with p.open("r", encoding="utf-8", errors="ignore") as f:
-            data = f.readlines()[-lines:]
-        return "".join(data)
-    except Exception as e:
-        return f"[tail_file] Fehler: {e}"
+def estimate_tokens(text: str, encoding: Any = None) -> int:
+    """Zählt Tokens mit tiktoken oder schätzt grob (≈4 Zeichen pro Token)."""
 
-def systemctl(action: str, unit: str) -> str:
-    if action not in {"status","restart","stop","start","daemon-reload"}:
-        return f"[systemctl] Ungültige Action: {action}"
-    cmd = ["systemctl", action] + ([unit] if unit and action not in {"daemon-reload"} else [])
-    try:
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        return f"[systemctl] rc={proc.returncode}\nSTDOUT:\n{proc.stdout}\nSTDERR:\n{proc.stderr}"
-    except Exception as e:
-        return f"[systemctl] Fehler: {e}"
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
 
-def resolve_docker_compose_base() -> List[str]:
-    """Bestimmt die Compose-Basisbefehle und cached das Ergebnis."""
 
-    global _DOCKER_COMPOSE_CMD
-    if _DOCKER_COMPOSE_CMD is not None:
-        return _DOCKER_COMPOSE_CMD
+def _truncate_middle(text: str, limit: int) -> str:
+    """Kürzt ``text`` auf Kopf und Ende mit Auslassungsmarker."""
 
-    legacy_override = os.getenv(DOCKER_LEGACY_ENV)
-    if legacy_override:
-        candidate = legacy_override.strip()
-        if candidate and (shutil.which(candidate) or Path(candidate).exists()):
-            _DOCKER_COMPOSE_CMD = [candidate]
-            return _DOCKER_COMPOSE_CMD
+    if len(text) <= limit:
+        return text
+    head = limit * 2 // 3
+    tail = limit - head
+    dropped = len(text) - head - tail
+    return (
+        f"{text[:head]}\n… [{dropped} Zeichen ausgelassen] …\n{text[len(text) - tail:]}"
+    )
 
-    try:
-        proc = subprocess.run(
-            ["docker", "compose", "version"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
+
+@dataclass
+class ContextManager:
+    """Hält die an das Modell gesendete Historie innerhalb eines Token-Budgets.
+
+    Reihenfolge der Verdichtung: alte Tool-Ergebnisse kürzen, dann die ältesten
+    Einheiten verwerfen bzw. (optional) zusammenfassen. Die erste Nachricht
+    (Ziel/Einstieg) und die neuesten ``keep_turns`` Einheiten bleiben unverändert.
+    Token-Zählungen werden pro Nachricht gecacht; ``prepare`` verwirft Einträge
+    für Nachrichten, die nicht mehr im Verlauf stehen.
+    """
+
+    max_tokens: int = 24000
+    keep_turns: int = 8
+    tool_output_chars: int = 2000
+    summarize: bool = False
+    model: str = DEFAULT_MODEL
+    _encoding: Any = field(default=None, init=False, repr=False)
+    _encoding_loaded: bool = field(default=False, init=False, repr=False)
+    _counts: Dict[int, Tuple[Dict[str, Any], Any, int]] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _truncated: Dict[int, Tuple[Dict[str, Any], Any, Dict[str, Any], int]] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _summary: str = field(default="", init=False, repr=False)
+    _summarized_upto: int = field(default=1, init=False, repr=False)
+
+    @classmethod
+    def from_config(
+        cls, cfg: Dict[str, Any], model: str = DEFAULT_MODEL
+    ) -> "ContextManager":
+        section = cfg.get("context") or {}
+        return cls(
+            max_tokens=int(section.get("max_tokens", cls.max_tokens)),
+            keep_turns=int(section.get("keep_turns", cls.keep_turns)),
+            tool_output_chars=int(
+                section.get("tool_output_chars", cls.tool_output_chars)
+            ),
+            summarize=bool(section.get("summarize", cls.summarize)),
+            model=model,
         )
-        if proc.returncode == 0:
-            _DOCKER_COMPOSE_CMD = ["docker", "compose"]
-            return _DOCKER_COMPOSE_CMD
-    except FileNotFoundError:
-        pass
 
-    legacy = shutil.which("docker-compose")
-    if legacy:
-        _DOCKER_COMPOSE_CMD = [legacy]
-        return _DOCKER_COMPOSE_CMD
+    def tokens(self, text: str) -> int:
+        if not self._encoding_loaded:
+            self._encoding = _encoding_for(self.model)
+            self._encoding_loaded = True
+        return estimate_tokens(text, self._encoding)
 
-    _DOCKER_COMPOSE_CMD = ["docker", "compose"]
-    return _DOCKER_COMPOSE_CMD
+    def count(self, msg: Dict[str, Any]) -> int:
+        """Token-Anzahl einer Nachricht (gecacht über die Identität von Nachricht und Inhalt)."""
 
+        content = msg.get("content")
+        cached = self._counts.get(id(msg))
+        if cached is not None and cached[0] is msg and cached[1] is content:
+            return cached[2]
+        n = 4 + self.tokens(
+            content if isinstance(content, str) else json.dumps(content or "")
+        )
+        self._counts[id(msg)] = (msg, content, n)
+        return n
 
-def docker_compose(action: str, service: Optional[str]=None) -> str:
-    if action not in {"up","down","build","logs"}:
-        return f"[docker] Ungültige Action: {action}"
-    if not DOCKER_FEATURES_AVAILABLE:
-        return (
-            "[docker] Docker-Unterstützung ist deaktiviert, weil kein ausführbares `docker`/`docker-compose` gefunden wurde. "
-            "Installiere Docker Engine inkl. Compose Plugin oder ein Legacy-`docker-compose`-Binary."
+    def _shrunk(self, msg: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+        content = msg.get("content")
+        is_tool_result = msg.get("role") == "tool" or (
+            isinstance(content, str) and content.startswith(TOOL_RESULT_PREFIX)
         )
-    base = resolve_docker_compose_base()
-    if action == "up":
-        cmd = base + ["up","-d"] + ([service] if service else [])
-    elif action == "down":
-        cmd = base + ["down"]
-    elif action == "build":
-        cmd = base + ["build"] + ([service] if service else [])
-    else:
-        cmd = base + ["logs","--no-log-prefix","--tail","200"] + ([service] if service else [])
-    try:
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        return f"[docker] rc={proc.returncode}\nSTDOUT:\n{proc.stdout}\nSTDERR:\n{proc.stderr}"
-    except Exception as e:
-        return f"[docker] Fehler: {e}"
+        if not (
+            is_tool_result
+            and isinstance(content, str)
+            and len(content) > self.tool_output_chars
+        ):
+            return msg, self.count(msg)
+        cached = self._truncated.get(id(msg))
+        if cached is not None and cached[0] is msg and cached[1] is content:
+            return cached[2], cached[3]
+        short = dict(msg, content=_truncate_middle(content, self.tool_output_chars))
+        n = 4 + self.tokens(short["content"])
+        self._truncated[id(msg)] = (msg, content, short, n)
+        return short, n
 
-def pytest_run(path: str=".", k: Optional[str]=None, timeout: int=DEFAULT_TIMEOUT) -> str:
-    cmd = ["pytest","-q",path]
-    if k:
-        cmd += ["-k", k]
-    try:
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=timeout)
-        return f"[pytest] rc={proc.returncode}\nSTDOUT:\n{proc.stdout}\nSTDERR:\n{proc.stderr}"
-    except FileNotFoundError:
-        return "[pytest] nicht gefunden. `pip install pytest` im Projekt/venv."
-    except subprocess.TimeoutExpired:
-        return f"[pytest] Timeout nach {timeout}s."
+    def _prune(self, messages: List[Dict[str, Any]]) -> None:
+        """Entfernt Cache-Einträge für Nachrichten, die nicht mehr im Verlauf stehen."""
 
-def maybe_parse_json(s: str):
-    s=s.strip()
-    if not (s.startswith('{') and s.endswith('}')):
-        return None
-    try:
-        return json.loads(s)
-    except json.JSONDecodeError:
-        return None
+        if len(self._counts) <= len(messages) and len(self._truncated) <= len(messages):
+            return
+        live = {id(m) for m in messages}
+        for cache in (self._counts, self._truncated):
+            for key in [key for key in cache if key not in live]:
+                del cache[key]
 
-def dispatch_tool(sess, tool: str, args: dict) -> str:
-    if tool == "list_dir":
-        return list_dir(args.get("path","."))
-    if tool == "read_file":
-        return read_file(args.get("path",""))
-    if tool == "write_file":
-        return write_file(args.get("path",""), args.get("content",""), dry=sess.dryrun)
-    if tool == "apply_patch":
-        return apply_patch(args.get("patch",""), dry=sess.dryrun)
-    if tool == "run":
-        t = int(args.get("timeout", DEFAULT_TIMEOUT))
-        env = args.get("env") if isinstance(args.get("env"), dict) else None
-        if sess.dryrun:
-            return f"[run:DRYRUN] Würde ausführen: {args.get('cmd','')} (timeout={t})"
-        return run(args.get("cmd",""), timeout=t, env=env)
-    if tool == "tail_file":
-        return tail_file(args.get("path",""), int(args.get("lines",200)))
-    if tool == "systemctl":
-        if sess.dryrun:
-            return f"[systemctl:DRYRUN] Würde ausführen: systemctl {args.get('action')} {args.get('unit','')}"
-        return systemctl(args.get("action","status"), args.get("unit",""))
-    if tool == "docker":
-        if sess.dryrun:
-            return f"[docker:DRYRUN] Würde docker compose {args.get('action')} {args.get('service','')}"
-        return docker_compose(args.get("action","logs"), args.get("service"))
-    if tool == "pytest":
-        if sess.dryrun:
-            return "[pytest:DRYRUN] Würde pytest ausführen."
-        return pytest_run(args.get("path","."), args.get("k"))
-    return f"Unbekanntes Tool: {tool}"
-
-def headless_loop(sess, goal: str, max_steps: int=30):
-    sess.add("user", f"Ziel: {goal}. Lege los, arbeite iterativ bis abgeschlossen. Melde Fortschritt kurz.")
-    for step in range(1, max_steps+1):
-        ai = run_model(sess)
-        parsed = maybe_parse_json(ai)
-        if parsed and "tool" in parsed:
-            result = dispatch_tool(sess, parsed.get("tool",""), parsed.get("args",{}))
-            print(result)
-            sess.add("user", f"ERGEBNIS ({parsed.get('tool')}):\n{result}")
-            continue
-        txt = ai.strip().lower()
-        print(ai.strip())
-        sess.add("assistant", ai)
-        if any(k in txt for k in ["fertig","abgeschlossen","done","final"]):
-            print("[headless] Fertig gemeldet nach", step, "Schritten.")
-            break
-    else:
-        print("[headless] Max Steps erreicht.")
+    @staticmethod
+    def _units(messages: List[Dict[str, Any]]) -> List[Tuple[int, int]]:
+        """Gruppiert Nachrichten in atomare Einheiten (Tool-Antworten hängen am Vorgänger)."""
 
-def determine_session_settings(cfg: Dict[str, Any], model_override: Optional[str]=None,
-                               dryrun_override: Optional[bool]=None) -> Tuple[str, bool]:
-    model = (model_override or cfg.get("model") or DEFAULT_MODEL)
-    dryrun = dryrun_override if dryrun_override is not None else bool(cfg.get("dryrun", False))
-    return model, dryrun
+        units: List[Tuple[int, int]] = []
+        for i, msg in enumerate(messages):
+            if msg.get("role") == "tool" and units:
+                units[-1] = (units[-1][0], i + 1)
+            else:
+                units.append((i, i + 1))
+        return units
 
+    def prepare(
+        self,
+        messages: List[Dict[str, Any]],
+        reserve: int = 0,
+        summarizer: Optional[Any] = None,
+    ) -> List[Dict[str, Any]]:
+        """Liefert die verdichtete Nachrichtenliste für den nächsten Request."""
 
-def repl(headless: bool=False, goal: Optional[str]=None, auto: Optional[bool]=None,
-         model_override: Optional[str]=None, dryrun_override: Optional[bool]=None):
-    if OpenAI is None:
-        print("[FEHLER] openai-SDK fehlt. Bitte Installer erneut ausführen.", file=sys.stderr)
-        sys.exit(1)
+        self._prune(messages)
+        budget = max(self.max_tokens - reserve, 0)
+        if sum(self.count(m) for m in messages) <= budget:
+            return list(messages)
 
-    cfg = load_config()
-    os.environ["OPENAI_API_KEY"] = cfg.get("api_key","")
-    model, dryrun = determine_session_settings(cfg, model_override=model_override,
-                                               dryrun_override=dryrun_override)
-    client = OpenAI()
-    sess = Session(client=client, model=model, dryrun=dryrun)
-    if auto is not None:
-        sess.auto = auto
+        units = self._units(messages)
+        pinned = units[:1]
+        recent_start = max(1, len(units) - self.keep_turns)
+        older = units[1:recent_start]
+        recent = units[recent_start:]
 
-    help_text = (
-        ":help – Hilfe\n"
-        ":cwd – aktuelles Verzeichnis\n"
-        ":cd <pfad> – wechseln\n"
-        ":yes / :no – letzte Aktion erlauben/ablehnen\n"
-        ":dryrun on|off – Schreib/Ausführ-Dry-Run\n"
-        ":auto on|off – Schritte automatisch erlauben\n"
-        ":quit – beenden\n"
-    )
-    dry_info = "on" if sess.dryrun else "off"
-    print(f"GPTCode bereit – Modell: {sess.model} (dryrun={dry_info})\nProjekt: {Path.cwd()}\n\n{help_text}")
+        def emit(
+            span: Tuple[int, int], shrink: bool
+        ) -> Tuple[List[Dict[str, Any]], int]:
+            out: List[Dict[str, Any]] = []
+            total = 0
+            for msg in messages[span[0] : span[1]]:
+                item, n = self._shrunk(msg) if shrink else (msg, self.count(msg))
+                out.append(item)
+                total += n
+            return out, total
 
-    if headless and goal:
-        print("[Headless] Auto-Modus gestartet: ", goal)
-        sess.auto = True
-        headless_loop(sess, goal)
-        return
+        head, head_tokens = emit(pinned[0], False) if pinned else ([], 0)
+        tail: List[Dict[str, Any]] = []
+        tail_tokens = 0
+        for span in recent:
+            part, n = emit(span, False)
+            tail.extend(part)
+            tail_tokens += n
+        middle_parts = [emit(span, True) for span in older]
+        middle_tokens = sum(n for _, n in middle_parts)
 
-    while True:
-        try:
-            user = input("you> ").strip()
-        except (EOFError, KeyboardInterrupt):
-            print(); break
-        if not user:
-            continue
+        dropped = 0
+        remaining = budget - head_tokens - tail_tokens
+        while middle_parts and middle_tokens > remaining:
+            _, n = middle_parts.pop(0)
+            middle_tokens -= n
+            dropped += 1
 
-        if user == ":quit":
-            break
-        if user == ":help":
-            print(HELP); continue
-        if user == ":cwd":
-            print(Path.cwd()); continue
-        if user.startswith(":cd "):
-            target = user[4:].strip()
-            try:
-                os.chdir(target); print(f"OK: {Path.cwd()}")
-            except Exception as e:
-                print(f"Fehler: {e}")
-            continue
-        if user.startswith(":dryrun"):
-            _, _, val = user.partition(" ")
-            val = val.strip().lower()
-            if val in {"on","off"}:
-                cfg = load_config()
-                cfg["dryrun"] = (val=="on"); save_config(cfg)
-                sess.dryrun = (val=="on")
-                print(f"dryrun={sess.dryrun}")
-            else:
-                print(f"dryrun aktuell: {sess.dryrun}")
-            continue
-        if user.startswith(":auto"):
-            _, _, val = user.partition(" ")
-            val = val.strip().lower()
-            if val in {"on","off"}:
-                sess.auto = (val=="on"); print(f"auto={sess.auto}")
-            else:
-                print(f"auto aktuell: {sess.auto}")
-            continue
-        if user in (":yes", ":no"):
-            if not sess.pending_action:
-                print("Keine ausstehende Aktion."); continue
-            if user == ":no":
-                print("Aktion verworfen."); sess.pending_action=None; continue
-            action = sess.pending_action; sess.pending_action=None
-            result = dispatch_tool(sess, action.get("tool",""), action.get("args",{}))
-            print(result)
-            sess.add("user", f"ERGEBNIS ({action.get('tool')}):\n{result}")
-            ai = run_model(sess)
-            parsed = maybe_parse_json(ai)
-            if parsed and "tool" in parsed and "args" in parsed:
-                if sess.auto:
-                    result = dispatch_tool(sess, parsed.get("tool",""), parsed.get("args",{}))
-                    print(result)
-                    sess.add("user", f"ERGEBNIS ({parsed.get('tool')}):\n{result}")
-                else:
-                    sess.pending_action = parsed
-                    print("AI möchte ausführen →", json.dumps(parsed, ensure_ascii=False))
-                    print("Bestätigen? (:yes / :no)")
+        bridge: List[Dict[str, Any]] = []
+        if dropped:
+            if dropped < len(older):
+                first_kept = older[dropped][0]
             else:
-                print(ai.strip()); sess.add("assistant", ai)
-            continue
+                first_kept = (
+                    units[recent_start][0]
+                    if recent_start < len(units)
+                    else len(messages)
+                )
+            note = f"[Kontext] {dropped} ältere Verlaufseinheiten wurden ausgelassen."
+            if self.summarize and summarizer is not None:
+                summary = self._update_summary(messages, first_kept, summarizer)
+                if summary:
+                    note = f"[Kontext] Zusammenfassung früherer Schritte:\n{summary}"
+            bridge.append({"role": "user", "content": note})
 
-        # Normaler Chat
-        sess.add("user", user)
-        ai = run_model(sess)
-        parsed = maybe_parse_json(ai)
-        if parsed and "tool" in parsed and "args" in parsed:
-            if sess.auto:
-                result = dispatch_tool(sess, parsed.get("tool",""), parsed.get("args",{}))
-                print(result)
-                sess.add("user", f"ERGEBNIS ({parsed.get('tool')}):\n{result}")
-            else:
-                sess.pending_action = parsed
-                print("AI möchte ausführen →", json.dumps(parsed, ensure_ascii=False))
-                print("Bestätigen? (:yes / :no)")
-        else:
-            print(ai.strip()); sess.add("assistant", ai)
+        middle = [item for part, _ in middle_parts for item in part]
+        return head + bridge + middle + tail
 
-def parse_cli_args(argv: List[str]) -> argparse.Namespace:
-    parser = argparse.ArgumentParser(prog="gptcode", description="GPTCode – Chat-first DevOps/Coding Assistent")
-    parser.add_argument("--headless", action="store_true", help="Headless-Modus aktivieren")
-    parser.add_argument("--goal", metavar="TEXT", help="Zielbeschreibung für Headless-Läufe")
-    parser.add_argument("--auto", action="store_true", help="Automatische Freigabe aktivieren")
-    parser.add_argument("--model", metavar="NAME", help="Modell nur für diese Sitzung überschreiben")
-    parser.add_argument("--dryrun", choices=["on","off"], help="Dry-Run nur für diese Sitzung setzen")
-    return parser.parse_args(argv)
+    def verbatim_from(self, messages: List[Dict[str, Any]]) -> int:
+        """Index, ab dem der Verlauf auch nach einer weiteren Einheit noch ungekürzt gesendet wird."""
 
+        keep = self.keep_turns - 1
+        units = self._units(messages)
+        if keep <= 0:
+            return len(messages)
+        return units[-keep][0] if len(units) > keep else 0
 
-def main() -> None:
-    check_runtime_prerequisites()
-    cli_args = parse_cli_args(sys.argv[1:])
-    ensure_config()
-    dry_override = None
-    if cli_args.dryrun is not None:
-        dry_override = (cli_args.dryrun == "on")
-    auto_flag = True if cli_args.auto else None
+    def _update_summary(
+        self, messages: List[Dict[str, Any]], upto: int, summarizer: Any
+    ) -> str:
+        """Fasst inkrementell alle Nachrichten vor ``upto`` zusammen."""
+
+        if upto <= self._summarized_upto:
+            return self._summary
+        chunk = messages[self._summarized_upto : upto]
+        lines = [
+            f"{m.get('role')}: {_truncate_middle(str(m.get('content') or ''), self.tool_output_chars)}"
+            for m in chunk
+        ]
+        if self._summary:
+            lines.insert(0, f"Bisherige Zusammenfassung:\n{self._summary}")
+        try:
+            summary = summarizer("\n\n".join(lines))
+        except Exception:
+            return self._summary
+        if summary:
+            self._summary = summary.strip()
+            self._summarized_upto = upto
+        return self._summary
+
+
+_TRACE_WRITE_LOCK = threading.Lock()
+_TRACE_FIELDS = (
+    "bytes_in",
+    "bytes_out",
+    "prompt_tokens",
+    "completion_tokens",
+    "cached_tokens",
+)
+
+
+class Tracer:
+    """Misst Spans (Modellaufrufe, Tools, Schritte) und schreibt sie optional als JSONL.
+
+    Pro Span entsteht eine Zeile mit Startzeit, Dauer, Art, Name und Zusatzfeldern
+    (Bytes, Tokens, Verlaufsgröße). Aggregate für ``:stats`` und die Abschluss-
+    Zusammenfassung bleiben im Speicher; einzelne Spans nur in der Trace-Datei.
+    """
+
+    def __init__(self, out: Optional[Any] = None, label: Optional[str] = None) -> None:
+        self.out = out
+        self.label = label
+        self.step = 0
+        self._lock = threading.Lock()
+        self._totals: Dict[Tuple[str, str], Dict[str, float]] = {}
+        self._slowest: Tuple[float, int] = (0.0, 0)
+        self._history = {"messages": 0, "bytes": 0}
+
+    @contextmanager
+    def span(self, kind: str, name: str, **fields: Any):
+        """Misst den Block; Felder können im Block über das gelieferte Dict ergänzt werden."""
+
+        started, t0 = time.time(), time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.record(kind, name, time.perf_counter() - t0, started, fields)
+
+    def record(
+        self,
+        kind: str,
+        name: str,
+        duration: float,
+        started: float,
+        fields: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        fields = fields or {}
+        with self._lock:
+            agg = self._totals.setdefault(
+                (kind, name),
+                dict.fromkeys(("count", "total", "max", "cached") + _TRACE_FIELDS, 0),
+            )
+            agg["count"] += 1
+            agg["total"] += duration
+            agg["max"] = max(agg["max"], duration)
+            agg["cached"] += 1 if fields.get("cached") else 0
+            for key in _TRACE_FIELDS:
+                agg[key] += int(fields.get(key) or 0)
+            if kind == "step" and duration > self._slowest[0]:
+                self._slowest = (duration, self.step)
+            if "messages" in fields:
+                self._history = {
+                    "messages": fields["messages"],
+                    "bytes": fields.get("history_bytes", 0),
+                }
+        if self.out is None:
+            return
+        line = {
+            "ts": round(started, 6),
+            "duration": round(duration, 6),
+            "kind": kind,
+            "name": name,
+            "step": self.step,
+            **fields,
+        }
+        if self.label is not None:
+            line["session"] = self.label
+        with _TRACE_WRITE_LOCK:
+            self.out.write(json.dumps(line, ensure_ascii=False, default=str) + "\n")
+            self.out.flush()
+
+    def totals(self, kind: str) -> Dict[str, float]:
+        """Summe aller Aggregate einer Span-Art."""
+
+        out = dict.fromkeys(("count", "total", "max", "cached") + _TRACE_FIELDS, 0)
+        with self._lock:
+            for (k, _), agg in self._totals.items():
+                if k == kind:
+                    for key, value in agg.items():
+                        out[key] = (
+                            max(out[key], value) if key == "max" else out[key] + value
+                        )
+        return out
+
+    def summary(self) -> str:
+        """Kompakte Übersicht: Modell- vs. Toolzeit, Tokens, Verlaufsgröße, Tools nach Gesamtdauer."""
+
+        steps, model, tools = (
+            self.totals("step"),
+            self.totals("model"),
+            self.totals("tool"),
+        )
+        lines = [
+            f"[stats] {int(steps['count'])} Schritte in {steps['total']:.2f}s; "
+            f"Modell {model['total']:.2f}s ({int(model['count'])} Aufrufe, {int(model['cached'])} aus Cache), "
+            f"Tools {tools['total']:.2f}s ({int(tools['count'])} Aufrufe)",
+            f"  Tokens: prompt {int(model['prompt_tokens'])} ({_percent(model['cached_tokens'], model['prompt_tokens'])} "
+            f"aus Prompt-Cache), completion {int(model['completion_tokens'])}; "
+            f"Verlauf: {self._history['messages']} Nachrichten, {_human_size(int(self._history['bytes']))}",
+        ]
+        if self._slowest[1]:
+            lines.append(
+                f"  Langsamster Schritt: #{self._slowest[1]} ({self._slowest[0]:.2f}s)"
+            )
+        with self._lock:
+            models = sorted(
+                (
+                    (name, dict(agg))
+                    for (kind, name), agg in self._totals.items()
+                    if kind == "model"
+                ),
+                key=lambda row: -row[1]["count"],
+            )
+            rows = sorted(
+                (
+                    (name, agg)
+                    for (kind, name), agg in self._totals.items()
+                    if kind == "tool"
+                ),
+                key=lambda row: -row[1]["total"],
+            )
+        if len(models) > 1:
+            lines.append(
+                "  Modelle: "
+                + "; ".join(
+                    f"{name} {int(agg['count'])}× Ø {agg['total'] / agg['count']:.2f}s, "
+                    f"{int(agg['prompt_tokens'] + agg['completion_tokens'])} Tokens"
+                    for name, agg in models
+                )
+            )
+        if rows:
+            width = max(len(name) for name, _ in rows)
+            lines.append(
+                f"  {'TOOL'.ljust(width)}  AUFRUFE   SUMME     MAX  BYTES REIN/RAUS"
+            )
+            for name, agg in rows:
+                lines.append(
+                    f"  {name.ljust(width)}  {int(agg['count']):7d}  {agg['total']:5.2f}s  {agg['max']:5.2f}s  "
+                    f"{_human_size(int(agg['bytes_in']))}/{_human_size(int(agg['bytes_out']))}"
+                )
+        return "\n".join(lines)
+
+
+def _percent(part: float, total: float) -> str:
+    return f"{100 * part / total:.0f}%" if total else "0%"
+
+
+def _history_size(messages: List[Dict[str, Any]]) -> int:
+    """Ungefähre Größe des Verlaufs in Zeichen (Inhalte plus native Tool-Calls)."""
+
+    size = 0
+    for message in messages:
+        size += len(str(message.get("content") or ""))
+        if message.get("tool_calls"):
+            size += len(json.dumps(message["tool_calls"], ensure_ascii=False))
+    return size
+
+
+RESULT_SPILL_CHARS = int(os.getenv("GPTCODE_RESULT_SPILL_CHARS", "24000"))
+RESULT_DIFF_MIN_CHARS = 400
+
+
+@dataclass
+class _StoredResult:
+    digest: str
+    label: str
+    index: int  # Position der Vollfassung in Session.messages
+    text: Optional[str] = None  # kleine Ergebnisse bleiben im Speicher …
+    path: Optional[str] = None  # … große liegen nur auf der Platte
+
+
+class ResultStore:
+    """Inhaltsadressierter Speicher für die Tool-Ergebnisse einer Session.
+
+    Ein identisches Ergebnis landet nur als Verweis im Verlauf, ein fast
+    identisches Ergebnis desselben Aufrufs als Diff. Verwiesen wird nur auf
+    Vollfassungen, die der ``ContextManager`` noch ungekürzt sendet; sonst wird
+    das Ergebnis wieder vollständig eingefügt. Ausgaben über ``spill_chars``
+    werden in eine Datei ausgelagert, im Verlauf bleiben Anfang, Ende und Pfad.
+    """
+
+    def __init__(
+        self, dedupe: bool = True, spill_chars: int = RESULT_SPILL_CHARS
+    ) -> None:
+        self.dedupe = dedupe
+        self.spill_chars = spill_chars
+        self.saved_chars = 0
+        self._by_digest: Dict[str, _StoredResult] = {}
+        self._by_call: Dict[str, _StoredResult] = {}
+        self._dir: Optional[str] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> "ResultStore":
+        section = cfg.get("tool_results") or {}
+        return cls(
+            dedupe=bool(section.get("dedupe", True)),
+            spill_chars=int(section.get("spill_chars", RESULT_SPILL_CHARS)),
+        )
+
+    def _spill(self, digest: str, text: str) -> str:
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(prefix="gptcode-results-")
+        path = os.path.join(self._dir, f"{digest}.txt")
+        if not os.path.exists(path):
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+        return path
+
+    def _reads_spill_file(self, args: Dict[str, Any]) -> bool:
+        path = args.get("path")
+        return (
+            self._dir is not None
+            and isinstance(path, str)
+            and path.startswith(self._dir + os.sep)
+        )
+
+    def compact(
+        self, name: str, args: Dict[str, Any], text: str, index: int, verbatim_from: int
+    ) -> str:
+        """Liefert den Text, der statt ``text`` an Position ``index`` in den Verlauf kommt."""
+
+        if self._reads_spill_file(args):
+            return text
+        digest = hashlib.sha256(text.encode("utf-8", "surrogatepass")).hexdigest()[:12]
+        key = name + json.dumps(args, sort_keys=True, ensure_ascii=False, default=str)
+        with self._lock:
+            if self.dedupe:
+                same = self._by_digest.get(digest)
+                if same is not None and same.index >= verbatim_from:
+                    ref = (
+                        f"[Ergebnis #{digest}] Identisch mit dem Ergebnis von {same.label} weiter oben "
+                        f"({len(text)} Zeichen) – nicht erneut eingefügt."
+                    )
+                    if same.path:
+                        ref += f" Vollständig: {same.path}"
+                    if len(ref) < len(text):
+                        self.saved_chars += len(text) - len(ref)
+                        return ref
+                prev = self._by_call.get(key)
+                if (
+                    prev is not None
+                    and prev.text is not None
+                    and prev.index >= verbatim_from
+                    and RESULT_DIFF_MIN_CHARS <= len(text) <= self.spill_chars
+                ):
+                    diff = list(
+                        difflib.unified_diff(
+                            prev.text.splitlines(), text.splitlines(), lineterm="", n=1
+                        )
+                    )[2:]
+                    out = (
+                        f"[Ergebnis #{digest}] Fast identisch mit #{prev.digest} ({prev.label} weiter oben); "
+                        f"Änderungen:\n" + "\n".join(diff)
+                    )
+                    if len(out) < len(text) // 2:
+                        self.saved_chars += len(text) - len(out)
+                        return out
+            stored = _StoredResult(digest, _call_label(name, args), index)
+            if len(text) > self.spill_chars:
+                stored.path = self._spill(digest, text)
+                out = (
+                    _truncate_middle(text, self.spill_chars // 3)
+                    + f"\n[Ergebnis #{digest}: {len(text)} Zeichen, vollständig in {stored.path} – "
+                    "bei Bedarf per read_file mit start_line/end_line nachlesen]"
+                )
+                self.saved_chars += len(text) - len(out)
+            else:
+                stored.text = out = text
+            self._by_digest[digest] = self._by_call[key] = stored
+            return out
+
+    def close(self) -> None:
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+
+def _call_label(name: str, args: Dict[str, Any], limit: int = 120) -> str:
+    label = f"{name} {json.dumps(args, ensure_ascii=False, default=str)}"
+    return (
+        label
+        if len(label) <= limit
+        else f"{label[:limit // 3]}…{label[-(limit * 2 // 3):]}"
+    )
+
+
+@dataclass
+class ToolCall:
+    name: str
+    args: Dict[str, Any] = field(default_factory=dict)
+    id: Optional[str] = None
+    error: Optional[str] = None
+
+    def to_message(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "type": "function",
+            "function": {
+                "name": self.name,
+                "arguments": json.dumps(self.args, ensure_ascii=False),
+            },
+        }
+
+
+@dataclass
+class ModelReply:
+    text: str = ""
+    tool_calls: List[ToolCall] = field(default_factory=list)
+    streamed: bool = False
+    usage: Optional[Dict[str, int]] = None
+
+    @property
+    def native(self) -> bool:
+        return bool(self.tool_calls) and all(call.id for call in self.tool_calls)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "text": self.text,
+            "tool_calls": [
+                {"name": c.name, "args": c.args, "id": c.id, "error": c.error}
+                for c in self.tool_calls
+            ],
+            "usage": self.usage,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ModelReply":
+        calls = [
+            ToolCall(
+                name=c["name"],
+                args=c.get("args") or {},
+                id=c.get("id"),
+                error=c.get("error"),
+            )
+            for c in data.get("tool_calls") or []
+        ]
+        return cls(
+            text=data.get("text") or "", tool_calls=calls, usage=data.get("usage")
+        )
+
+
+ROUTE_FAST_TOOLS = (
+    "list_dir",
+    "find_files",
+    "search",
+    "read_file",
+    "tail_file",
+    "systemctl",
+    "docker",
+)
+_ROUTE_FAILURE = (
+    r"(?m)^\[[^\]\n]+\] (?:rc=(?!0\b)|Fehler|Argumente)|^(?:Fehler|Unbekanntes Tool)"
+)
+
+
+@dataclass
+class ModelRouter:
+    """Wählt pro Schritt zwischen schnellem Modell und Hauptmodell.
+
+    Das schnelle Modell bekommt nur mechanische Folgeschritte: Der letzte Schritt
+    bestand ausschließlich aus ``fast_tools``, die mit ihren Argumenten lesend waren
+    (``systemctl restart`` zählt nicht), lief fehlerfrei und lieferte höchstens
+    ``max_result_chars`` Zeichen. Neue Nutzerziele, Schreib-/Ausführschritte und
+    Fehler gehen an das Hauptmodell. Liefert das schnelle Modell einen unlesbaren
+    Tool-Call oder eine leere Antwort, wird der Schritt mit dem Hauptmodell wiederholt.
+    """
+
+    fast_model: Optional[str] = None
+    fast_tools: Tuple[str, ...] = ROUTE_FAST_TOOLS
+    max_result_chars: int = 6000
+
+    @classmethod
+    def from_config(
+        cls, cfg: Dict[str, Any], fast_model_override: Optional[str] = None
+    ) -> "ModelRouter":
+        section = cfg.get("routing") or {}
+        fast = (
+            fast_model_override
+            if fast_model_override is not None
+            else section.get("fast_model")
+        )
+        return cls(
+            fast_model=(
+                None if str(fast or "").lower() in ("", "off", "none") else str(fast)
+            ),
+            fast_tools=tuple(section.get("fast_tools", cls.fast_tools)),
+            max_result_chars=int(section.get("max_result_chars", cls.max_result_chars)),
+        )
+
+    def choose(self, sess) -> Tuple[str, str]:
+        """(Modell, Route) für den nächsten Aufruf; Route ist ``main`` oder ``fast``."""
+
+        if not self.fast_model or self.fast_model == sess.model:
+            return sess.model, "main"
+        step = _last_tool_step(sess.messages)
+        if step is None:
+            return sess.model, "main"
+        calls, results = step
+        if (
+            not calls
+            or not all(self._read_only_step(name, args) for name, args in calls)
+            or sum(len(r) for r in results) > self.max_result_chars
+            or any(re.search(_ROUTE_FAILURE, r[:2000]) for r in results)
+        ):
+            return sess.model, "main"
+        return self.fast_model, "fast"
+
+    def _read_only_step(self, name: str, args: Optional[Dict[str, Any]]) -> bool:
+        spec = TOOLS.get(name)
+        if name not in self.fast_tools or spec is None:
+            return False
+        # Ohne Argumente (Textprotokoll) nur Tools, die unabhängig davon lesend sind.
+        return spec.read_only is True if args is None else spec.is_read_only(args)
+
+    @staticmethod
+    def needs_escalation(reply: "ModelReply") -> bool:
+        if any(call.error or call.name not in TOOLS for call in reply.tool_calls):
+            return True
+        text = reply.text.strip()
+        return not reply.tool_calls and (not text or text.startswith("{"))
+
+
+def _last_tool_step(
+    messages: List[Dict[str, Any]],
+) -> Optional[Tuple[List[Tuple[str, Optional[Dict[str, Any]]]], List[str]]]:
+    """Tool-Calls (Name, Argumente) und Ergebnisse des letzten Schritts, falls der Verlauf mit Tool-Ergebnissen endet.
+
+    Im Textprotokoll stehen nur die Ergebnisse im Verlauf; die Argumente sind dann ``None``.
+    """
+
+    results: List[str] = []
+    calls: List[Tuple[str, Optional[Dict[str, Any]]]] = []
+    for message in reversed(messages):
+        content = str(message.get("content") or "")
+        if message["role"] == "tool":
+            results.append(content)
+        elif message["role"] == "user" and content.startswith(TOOL_RESULT_PREFIX):
+            calls.append((content[len(TOOL_RESULT_PREFIX) :].split(")", 1)[0], None))
+            results.append(content)
+        elif (
+            message["role"] == "assistant"
+            and message.get("tool_calls")
+            and results
+            and not calls
+        ):
+            for c in message["tool_calls"]:
+                args = maybe_parse_json(c["function"].get("arguments") or "{}")
+                calls.append(
+                    (c["function"]["name"], args if isinstance(args, dict) else None)
+                )
+            break
+        else:
+            break
+    return (calls, results) if results else None
+
+
+@dataclass
+class Session:
+    client: Any
+    model: str
+    async_client: Any = None
+    dryrun: bool = False
+    auto: bool = False
+    stream: bool = False
+    stream_cutoff: bool = True
+    native_tools: bool = True
+    tool_workers: int = 8
+    persistent_shell: bool = False
+    cwd: Optional[str] = None
+    rate_limiter: Any = None
+    response_cache: Optional["ResponseCache"] = None
+    cassette: Optional[Union["Cassette", "_GoalCassette"]] = None
+    messages: List[Dict[str, Any]] = field(default_factory=list)
+    pending_action: Optional[ModelReply] = None
+    read_only_policy: str = "confirm"  # confirm | prefetch | auto
+    prefetch: Optional["Prefetch"] = field(default=None, repr=False)
+    tail_cursors: Dict[str, Tuple[int, int]] = field(default_factory=dict)
+    listing_cache: Dict[str, Tuple[int, List[Tuple[str, bool, int]]]] = field(
+        default_factory=dict
+    )
+    touched: Set[str] = field(default_factory=set)
+    log_cursors: Dict[str, Tuple[str, int]] = field(default_factory=dict)
+    usage: Dict[str, int] = field(
+        default_factory=lambda: {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cached_tokens": 0,
+        }
+    )
+    context: ContextManager = field(default_factory=ContextManager)
+    tracer: Tracer = field(default_factory=Tracer)
+    results: ResultStore = field(default_factory=ResultStore)
+    router: ModelRouter = field(default_factory=ModelRouter)
+    _tool_pool: Optional[ThreadPoolExecutor] = field(
+        default=None, init=False, repr=False
+    )
+    _shell: Optional["ShellWorker"] = field(default=None, init=False, repr=False)
+
+    def add(self, role: str, content: str):
+        self.messages.append({"role": role, "content": content})
+
+    @property
+    def workdir(self) -> str:
+        """Arbeitsverzeichnis der Session (ohne prozessweites ``os.chdir``)."""
+
+        return self.cwd or os.getcwd()
+
+    def resolve(self, path: str) -> str:
+        p = Path(path or ".").expanduser()
+        if not p.is_absolute():
+            p = Path(self.workdir) / p
+        return str(p.resolve())
+
+    def track_usage(self, usage: Optional[Dict[str, int]]) -> None:
+        for key in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+            self.usage[key] = self.usage.get(key, 0) + int((usage or {}).get(key) or 0)
+
+    def tool_pool(self) -> ThreadPoolExecutor:
+        if self._tool_pool is None:
+            self._tool_pool = ThreadPoolExecutor(
+                max_workers=max(1, self.tool_workers), thread_name_prefix="gptcode-tool"
+            )
+        return self._tool_pool
+
+    def shell(self) -> "ShellWorker":
+        if self._shell is None:
+            self._shell = ShellWorker(cwd=self.workdir)
+        return self._shell
+
+    def reset_shell(self) -> None:
+        if self._shell is not None:
+            self._shell.close()
+            self._shell = None
+
+    def close(self) -> None:
+        """Gibt Thread-Pool und persistente Shell frei."""
+
+        self.reset_shell()
+        if self.prefetch is not None:
+            self.prefetch.discard()
+            self.prefetch = None
+        self.results.close()
+        if self._tool_pool is not None:
+            self._tool_pool.shutdown(wait=False)
+            self._tool_pool = None
+
+    def record_tool_results(self, reply: ModelReply, results: List[str]) -> None:
+        """Hängt Tool-Ergebnisse im passenden Protokoll an die Historie an.
+
+        Wiederholte bzw. große Ergebnisse verdichtet ``self.results`` vorher zu
+        Verweis, Diff oder Vorschau mit Dateipfad.
+        """
+
+        verbatim_from = self.context.verbatim_from(self.messages)
+        if reply.native:
+            self.messages.append(
+                {
+                    "role": "assistant",
+                    "content": reply.text or None,
+                    "tool_calls": [call.to_message() for call in reply.tool_calls],
+                }
+            )
+            for call, result in zip(reply.tool_calls, results):
+                content = self.results.compact(
+                    call.name, call.args, result, len(self.messages), verbatim_from
+                )
+                self.messages.append(
+                    {"role": "tool", "tool_call_id": call.id, "content": content}
+                )
+            return
+        for call, result in zip(reply.tool_calls, results):
+            content = self.results.compact(
+                call.name, call.args, result, len(self.messages), verbatim_from
+            )
+            self.add("user", f"{TOOL_RESULT_PREFIX}{call.name}):\n{content}")
+
+
+class _JsonObjectScanner:
+    """Erkennt inkrementell das Ende des ersten JSON-Objekts in einem Stream."""
+
+    def __init__(self) -> None:
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.started = False
+
+    def feed(self, chunk: str) -> Optional[int]:
+        """Verarbeitet ``chunk`` und liefert die Gesamtlänge bis zur schließenden Klammer."""
+
+        for i, ch in enumerate(chunk):
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                continue
+            if ch == '"':
+                self.in_string = True
+            elif ch == "{":
+                self.depth += 1
+                self.started = True
+            elif ch == "}":
+                self.depth -= 1
+                if self.started and self.depth == 0:
+                    end = self.pos + i + 1
+                    self.pos += len(chunk)
+                    return end
+        self.pos += len(chunk)
+        return None
+
+
+def _merge_tool_call_delta(pending: Dict[int, Dict[str, Any]], delta: Any) -> None:
+    for item in delta or []:
+        slot = pending.setdefault(
+            getattr(item, "index", 0) or 0, {"id": None, "name": "", "arguments": ""}
+        )
+        if getattr(item, "id", None):
+            slot["id"] = item.id
+        function = getattr(item, "function", None)
+        if function is not None:
+            slot["name"] += getattr(function, "name", None) or ""
+            slot["arguments"] += getattr(function, "arguments", None) or ""
+
+
+class _StreamAssembler:
+    """Setzt gestreamte Chunks zu einer ``ModelReply`` zusammen (sync und async).
+
+    Prosa wird sofort ausgegeben, eine mit ``{`` beginnende Antwort gepuffert;
+    ``feed`` meldet ``True``, sobald das JSON-Objekt geschlossen ist und der
+    Rest des Streams verworfen werden darf.
+    """
+
+    def __init__(self, cutoff: bool = True, echo: bool = True) -> None:
+        self.cutoff = cutoff
+        self.echo = echo
+        self.parts: List[str] = []
+        self.mode: Optional[str] = (
+            None  # None = noch unentschieden, "prose" oder "json"
+        )
+        self.pending = ""
+        self.scanner = _JsonObjectScanner()
+        self.json_end: Optional[int] = None
+        self.native_calls: Dict[int, Dict[str, Any]] = {}
+        self.usage: Optional[Dict[str, int]] = None
+
+    def feed(self, chunk: Any) -> bool:
+        if getattr(chunk, "usage", None) is not None:
+            self.usage = _usage_dict(chunk.usage)
+        if not getattr(chunk, "choices", None):
+            return False
+        delta_obj = chunk.choices[0].delta
+        _merge_tool_call_delta(
+            self.native_calls, getattr(delta_obj, "tool_calls", None)
+        )
+        delta = delta_obj.content or ""
+        if not delta:
+            return False
+        if self.mode is None:
+            self.pending += delta
+            stripped = self.pending.lstrip()
+            if not stripped:
+                return False
+            self.mode = "json" if stripped.startswith("{") else "prose"
+            delta = stripped
+        self.parts.append(delta)
+        if self.mode == "prose":
+            if self.echo:
+                sys.stdout.write(delta)
+                sys.stdout.flush()
+            return False
+        end = self.scanner.feed(delta)
+        if end is not None and self.json_end is None:
+            self.json_end = end
+            return self.cutoff
+        return False
+
+    def finish(self) -> ModelReply:
+        text = "".join(self.parts)
+        streamed = self.mode == "prose" and self.echo
+        if streamed:
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+        elif self.mode == "json" and self.json_end is not None and self.cutoff:
+            text = text[: self.json_end]
+        calls = [
+            _tool_call_from_raw(raw["id"], raw["name"], raw["arguments"])
+            for _, raw in sorted(self.native_calls.items())
+        ]
+        return _finish_reply(text, calls, streamed=streamed, usage=self.usage)
+
+
+def _run_model_streaming(sess: Session, request: Dict[str, Any]) -> ModelReply:
+    """Streamt die Antwort: Prosa sofort ausgeben, JSON-Tool-Calls puffern."""
+
+    stream = sess.client.chat.completions.create(
+        **request, stream=True, stream_options={"include_usage": True}
+    )
+    assembler = _StreamAssembler(cutoff=sess.stream_cutoff)
+    try:
+        for chunk in stream:
+            if assembler.feed(chunk):
+                break
+    finally:
+        close = getattr(stream, "close", None)
+        if callable(close):
+            close()
+    return assembler.finish()
+
+
+def _tool_call_from_raw(
+    call_id: Optional[str], name: str, arguments: Optional[str]
+) -> ToolCall:
+    try:
+        args = json.loads(arguments or "{}")
+    except json.JSONDecodeError as e:
+        return ToolCall(
+            name=name, id=call_id, error=f"Argumente sind kein gültiges JSON: {e}"
+        )
+    if not isinstance(args, dict):
+        return ToolCall(
+            name=name, id=call_id, error="Argumente müssen ein JSON-Objekt sein."
+        )
+    return ToolCall(name=name, args=args, id=call_id)
+
+
+def _usage_dict(usage: Any) -> Optional[Dict[str, int]]:
+    if usage is None:
+        return None
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": int(getattr(usage, "prompt_tokens", 0) or 0),
+        "completion_tokens": int(getattr(usage, "completion_tokens", 0) or 0),
+        "cached_tokens": int(getattr(details, "cached_tokens", 0) or 0),
+    }
+
+
+def _finish_reply(
+    text: str,
+    calls: List[ToolCall],
+    streamed: bool = False,
+    usage: Optional[Dict[str, int]] = None,
+) -> ModelReply:
+    """Ergänzt native Tool-Calls um das JSON-im-Text-Protokoll als Fallback."""
+
+    if not calls:
+        calls = parse_text_tool_calls(text)
+        if calls:
+            return ModelReply(text="", tool_calls=calls, usage=usage)
+    return ModelReply(text=text, tool_calls=calls, streamed=streamed, usage=usage)
+
+
+def _summarize_history(sess: Session, transcript: str) -> str:
+    resp = sess.client.chat.completions.create(
+        model=sess.model,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript},
+        ],
+        temperature=0,
+    )
+    return resp.choices[0].message.content or ""
+
+
+def build_system_prompt(sess: Session) -> str:
+    """Sitzungsunabhängiger System-Prompt – enthält bewusst keinen veränderlichen Zustand."""
+
+    if sess.native_tools:
+        return SYSTEM_PROMPT_NATIVE_TMPL
+    return SYSTEM_PROMPT_TMPL.format(tools=text_protocol_hint())
+
+
+def build_state_note(sess: Session) -> str:
+    return SESSION_STATE_TMPL.format(cwd=sess.workdir)
+
+
+def _build_request(sess: Session, model: Optional[str] = None) -> Dict[str, Any]:
+    """Anfrage in cache-freundlicher Reihenfolge: fester Prompt, Verlauf, zuletzt der Sitzungszustand."""
+
+    sys_prompt, state = build_system_prompt(sess), build_state_note(sess)
+    history = sess.context.prepare(
+        sess.messages,
+        reserve=sess.context.tokens(sys_prompt) + sess.context.tokens(state),
+        summarizer=lambda transcript: _summarize_history(sess, transcript),
+    )
+    request: Dict[str, Any] = {
+        "model": model or sess.model,
+        "messages": [{"role": "system", "content": sys_prompt}]
+        + history
+        + [{"role": "system", "content": state}],
+        "temperature": 0.2,
+    }
+    if sess.native_tools:
+        request["tools"] = tool_schemas()
+        request["parallel_tool_calls"] = True
+    return request
+
+
+def request_key(request: Dict[str, Any]) -> str:
+    """Inhaltsadresse einer Anfrage: Modell, Temperatur, Prompt/Verlauf und Tool-Schemas."""
+
+    material = {
+        k: request.get(k) for k in ("model", "temperature", "messages", "tools")
+    }
+    blob = json.dumps(
+        material, sort_keys=True, ensure_ascii=False, separators=(",", ":")
+    )
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Antwort-Cache auf der Platte (eine JSON-Datei pro Anfrage-Hash).
+
+    Treffer frischen die mtime auf; überschreitet der Cache ``max_bytes``,
+    werden die am längsten nicht genutzten Einträge gelöscht.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> Optional["ResponseCache"]:
+        section = cfg.get("response_cache") or {}
+        if not section.get("enabled", False):
+            return None
+        directory = Path(
+            section.get("dir") or CONFIG_DIR / "cache" / "responses"
+        ).expanduser()
+        return cls(
+            directory, max_bytes=int(float(section.get("max_mb", 64)) * 1024 * 1024)
+        )
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def get(self, key: str) -> Optional[ModelReply]:
+        path = self._path(key)
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return ModelReply.from_dict(data)
+
+    def put(self, key: str, reply: ModelReply) -> None:
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp = self._path(key).with_suffix(f".{uuid.uuid4().hex}.tmp")
+            tmp.write_text(
+                json.dumps(reply.to_dict(), ensure_ascii=False), encoding="utf-8"
+            )
+            os.replace(tmp, self._path(key))
+            self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                st = entry.stat()
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+
+
+class CassetteError(RuntimeError):
+    pass
+
+
+class Cassette:
+    """Aufzeichnung von Modellantworten als JSONL für reproduzierbare Offline-Läufe.
+
+    ``record`` hängt jede Antwort an, ``replay`` liefert sie wieder aus: bevorzugt
+    über den Anfrage-Hash, sonst in Aufnahmereihenfolge (z. B. wenn sich
+    ein Pfad im Systemprompt geändert hat). Im Batch tragen Einträge den
+    Zielindex (``for_goal``); dort gilt nur der Anfrage-Hash, da die Reihenfolge
+    nebenläufiger Ziele nicht reproduzierbar ist.
+    """
+
+    def __init__(self, path: str, mode: str) -> None:
+        self.path = Path(path).expanduser()
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._file: Any = None
+        self._entries: List[Tuple[str, Dict[str, Any], Optional[int]]] = []
+        self._used: Set[int] = set()
+        if mode == "record":
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "w", encoding="utf-8")
+        elif mode == "replay":
+            for line in self.path.read_text(encoding="utf-8").splitlines():
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries.append(
+                        (entry["key"], entry["reply"], entry.get("goal"))
+                    )
+        else:
+            raise ValueError(f"Unbekannter Cassette-Modus: {mode}")
+
+    def record(self, key: str, reply: ModelReply, goal: Optional[int] = None) -> None:
+        entry: Dict[str, Any] = {"key": key, "reply": reply.to_dict()}
+        if goal is not None:
+            entry["goal"] = goal
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def replay(self, key: str, goal: Optional[int] = None) -> ModelReply:
+        with self._lock:
+            pending = [
+                i
+                for i in range(len(self._entries))
+                if i not in self._used and (goal is None or self._entries[i][2] == goal)
+            ]
+            if not pending:
+                raise CassetteError(
+                    f"Cassette {self.path} erschöpft – keine weitere Antwort aufgezeichnet."
+                )
+            index = next(
+                (i for i in pending if self._entries[i][0] == key),
+                None if goal is not None else pending[0],
+            )
+            if index is None:
+                raise CassetteError(
+                    f"Cassette {self.path}: keine Antwort für Ziel {goal} mit diesem Anfrage-Hash."
+                )
+            self._used.add(index)
+            return ModelReply.from_dict(self._entries[index][1])
+
+    def for_goal(self, goal: int) -> "_GoalCassette":
+        """Sicht für ein Batch-Ziel: nimmt mit Zielindex auf bzw. spielt nur dessen Antworten ab."""
+
+        return _GoalCassette(self, goal)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _GoalCassette:
+    def __init__(self, cassette: Cassette, goal: int) -> None:
+        self.cassette = cassette
+        self.goal = goal
+        self.mode = cassette.mode
+
+    def record(self, key: str, reply: ModelReply) -> None:
+        self.cassette.record(key, reply, goal=self.goal)
+
+    def replay(self, key: str) -> ModelReply:
+        return self.cassette.replay(key, goal=self.goal)
+
+
+def _lookup_reply(
+    sess: Session, request: Dict[str, Any]
+) -> Tuple[str, Optional[ModelReply]]:
+    """Bedient eine Anfrage aus Cassette oder Antwort-Cache, falls möglich."""
+
+    key = request_key(request)
+    if sess.cassette is not None and sess.cassette.mode == "replay":
+        return key, sess.cassette.replay(key)
+    if sess.response_cache is not None:
+        return key, sess.response_cache.get(key)
+    return key, None
+
+
+def _store_reply(sess: Session, key: str, reply: ModelReply) -> None:
+    if sess.cassette is not None and sess.cassette.mode == "record":
+        sess.cassette.record(key, reply)
+    if sess.response_cache is not None:
+        sess.response_cache.put(key, reply)
+
+
+def _reply_from_completion(resp: Any) -> ModelReply:
+    message = resp.choices[0].message
+    calls = [
+        _tool_call_from_raw(c.id, c.function.name, c.function.arguments)
+        for c in (getattr(message, "tool_calls", None) or [])
+    ]
+    return _finish_reply(
+        message.content or "", calls, usage=_usage_dict(getattr(resp, "usage", None))
+    )
+
+
+def _model_span(sess: Session, model: str, route: str):
+    return sess.tracer.span(
+        "model",
+        model,
+        route=route,
+        messages=len(sess.messages),
+        history_bytes=_history_size(sess.messages),
+    )
+
+
+def run_model(sess: Session) -> ModelReply:
+    """Ein Modellschritt; ``sess.router`` wählt das Modell und eskaliert bei Bedarf."""
+
+    model, route = sess.router.choose(sess)
+    reply = _run_model_as(sess, model, route)
+    if route == "fast" and sess.router.needs_escalation(reply):
+        reply = _run_model_as(sess, sess.model, "escalated")
+    return reply
+
+
+def _run_model_as(sess: Session, model: str, route: str) -> ModelReply:
+    with _model_span(sess, model, route) as span:
+        request = _build_request(sess, model)
+        key, cached = _lookup_reply(sess, request)
+        if cached is not None:
+            span["cached"] = True
+            return cached
+        if sess.stream:
+            reply = _run_model_streaming(sess, request)
+        else:
+            reply = _reply_from_completion(
+                sess.client.chat.completions.create(**request)
+            )
+        sess.track_usage(reply.usage)
+        span.update(reply.usage or {})
+        _store_reply(sess, key, reply)
+        return reply
+
+
+async def run_model_async(sess: Session) -> ModelReply:
+    """Wie ``run_model``, aber über den asynchronen Client (``sess.async_client``)."""
+
+    model, route = sess.router.choose(sess)
+    reply = await _run_model_as_async(sess, model, route)
+    if route == "fast" and sess.router.needs_escalation(reply):
+        reply = await _run_model_as_async(sess, sess.model, "escalated")
+    return reply
+
+
+async def _run_model_as_async(sess: Session, model: str, route: str) -> ModelReply:
+    with _model_span(sess, model, route) as span:
+        reply = await _complete_async(sess, span, model)
+        if not span.get("cached"):
+            span.update(reply.usage or {})
+        return reply
+
+
+async def _complete_async(
+    sess: Session, span: Dict[str, Any], model: str
+) -> ModelReply:
+    import asyncio
+
+    if sess.context.summarize:
+        # Zusammenfassungen laufen über den synchronen Client – nicht im Event-Loop blockieren.
+        request = await asyncio.to_thread(_build_request, sess, model)
+    else:
+        request = _build_request(sess, model)
+    key, cached = _lookup_reply(sess, request)
+    if cached is not None:
+        span["cached"] = True
+        return cached
+    if sess.rate_limiter is not None:
+        await sess.rate_limiter.acquire()
+    client = sess.async_client
+    if not sess.stream:
+        reply = _reply_from_completion(await client.chat.completions.create(**request))
+        sess.track_usage(reply.usage)
+        _store_reply(sess, key, reply)
+        return reply
+    stream = await client.chat.completions.create(
+        **request, stream=True, stream_options={"include_usage": True}
+    )
+    assembler = _StreamAssembler(cutoff=sess.stream_cutoff)
+    try:
+        async for chunk in stream:
+            if assembler.feed(chunk):
+                break
+    finally:
+        close = getattr(stream, "close", None)
+        if callable(close):
+            await close()
+    reply = assembler.finish()
+    sess.track_usage(reply.usage)
+    _store_reply(sess, key, reply)
+    return reply
+
+
+def show_reply(reply: ModelReply) -> None:
+    """Gibt eine Modellantwort aus, sofern sie nicht bereits gestreamt wurde."""
+
+    if reply.text.strip() and not reply.streamed:
+        print(reply.text.strip())
+
+
+INDEX_DIR = CONFIG_DIR / "index"
+SEARCH_MAX_FILE_BYTES = 2 * 1024 * 1024
+SEARCH_POOL_MIN_FILES = 400
+SEARCH_POOL_TIMEOUT = float(
+    os.getenv("GPTCODE_SEARCH_TIMEOUT", "30")
+)  # Sekunden bis zum Rückfall
+_ALWAYS_SKIPPED = {".git", ".hg", ".svn"}
+
+
+def _gitignore_regex(pattern: str) -> "re.Pattern[str]":
+    """Übersetzt ein .gitignore-Muster (ohne ``!``/``/``-Suffix) in einen Regex über relative Pfade."""
+
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    out, i = [], 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+        if ch == "*":
+            out.append("[^/]*")
+        elif ch == "?":
+            out.append("[^/]")
+        elif ch == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                out.append(re.escape(ch))
+            else:
+                body = pattern[i + 1 : end].replace("\\", "\\\\")
+                out.append(
+                    "[" + ("^" + body[1:] if body.startswith("!") else body) + "]"
+                )
+                i = end
+        else:
+            out.append(re.escape(ch))
+        i += 1
+    prefix = "" if anchored else "(?:.*/)?"
+    return re.compile(f"^{prefix}{''.join(out)}$")
+
+
+def _parse_gitignore(
+    lines: List[str], base: str
+) -> Tuple[Tuple[str, "re.Pattern[str]", bool, bool], ...]:
+    rules = []
+    for raw in lines:
+        line = raw.rstrip("\n").rstrip()
+        if not line or line.startswith("#"):
+            continue
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if line:
+            rules.append((base, _gitignore_regex(line), negate, dir_only))
+    return tuple(rules)
+
+
+def _is_ignored(
+    rules: Tuple[Tuple[str, "re.Pattern[str]", bool, bool], ...], rel: str, is_dir: bool
+) -> bool:
+    """Git-Semantik light: die letzte passende Regel gewinnt."""
+
+    ignored = False
+    for base, regex, negate, dir_only in rules:
+        if dir_only and not is_dir:
+            continue
+        if base:
+            if not rel.startswith(base + "/"):
+                continue
+            sub = rel[len(base) + 1 :]
+        else:
+            sub = rel
+        if regex.match(sub):
+            ignored = not negate
+    return ignored
+
+
+def _read_ignore_file(
+    path: str, known: Optional[Tuple[int, List[str]]] = None
+) -> Tuple[int, List[str]]:
+    """(mtime, Zeilen) einer Ignore-Datei; bei unveränderter mtime wird ``known`` wiederverwendet."""
+
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        if known is not None and known[0] == mtime:
+            return known
+        with open(path, encoding="utf-8", errors="replace") as fh:
+            return mtime, fh.read().splitlines()
+    except OSError:
+        return 0, []
+
+
+class ProjectIndex:
+    """Dateiliste eines Projekts, die .gitignore beachtet und inkrementell aktualisiert wird.
+
+    Pro Verzeichnis werden mtime, Ignore-Muster und Einträge gespeichert. Beim
+    Refresh wird ein Verzeichnis nur neu gelesen, wenn sich seine mtime oder
+    seine .gitignore geändert hat; der Stand wird unter ``INDEX_DIR`` persistiert.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = os.path.realpath(root)
+        self.dirs: Dict[str, Dict[str, Any]] = {}
+        self._files: Optional[List[str]] = None
+        self._lock = threading.Lock()
+
+    @property
+    def store_path(self) -> Path:
+        return INDEX_DIR / (
+            hashlib.sha1(self.root.encode("utf-8")).hexdigest()[:16] + ".json"
+        )
+
+    def load(self) -> None:
+        try:
+            data = json.loads(self.store_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+        if data.get("root") == self.root and isinstance(data.get("dirs"), dict):
+            self.dirs = data["dirs"]
+            self._files = None
+
+    def save(self) -> None:
+        try:
+            INDEX_DIR.mkdir(parents=True, exist_ok=True)
+            tmp = self.store_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            tmp.write_text(
+                json.dumps({"root": self.root, "dirs": self.dirs}), encoding="utf-8"
+            )
+            os.replace(tmp, self.store_path)
+        except OSError:
+            pass  # Index bleibt dann nur für diesen Prozess erhalten
+
+    def refresh(self) -> bool:
+        """Gleicht den Index mit dem Dateisystem ab; liefert True bei Änderungen."""
+
+        with self._lock:
+            _, base_lines = _read_ignore_file(
+                os.path.join(self.root, ".git", "info", "exclude")
+            )
+            seen: Dict[str, Dict[str, Any]] = {}
+            changed = self._refresh_dir(
+                "", _parse_gitignore(base_lines, ""), "\n".join(base_lines), seen
+            )
+            if set(seen) != set(self.dirs):
+                changed = True
+            self.dirs = seen
+            if changed:
+                self._files = None
+            return changed
+
+    def _refresh_dir(
+        self,
+        rel: str,
+        rules: Tuple[Any, ...],
+        sig: str,
+        seen: Dict[str, Dict[str, Any]],
+    ) -> bool:
+        path = os.path.join(self.root, rel) if rel else self.root
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return True
+        entry = self.dirs.get(rel)
+        known = (entry["ignore_mtime"], entry["ignore"]) if entry is not None else None
+        ignore_mtime, ignore_lines = _read_ignore_file(
+            os.path.join(path, ".gitignore"), known
+        )
+        rules = rules + _parse_gitignore(ignore_lines, rel)
+        # Die Signatur deckt alle geerbten Regeln ab: ändert sich eine .gitignore weiter oben,
+        # werden auch unveränderte Unterverzeichnisse neu gefiltert.
+        sig = hashlib.sha1(
+            f"{sig}\0{rel}\0{chr(10).join(ignore_lines)}".encode("utf-8")
+        ).hexdigest()
+        changed = False
+        if entry is None or entry["mtime"] != mtime or entry.get("sig") != sig:
+            files, subdirs = [], []
+            try:
+                with os.scandir(path) as it:
+                    for item in it:
+                        if item.name in _ALWAYS_SKIPPED:
+                            continue
+                        child = f"{rel}/{item.name}" if rel else item.name
+                        try:
+                            is_dir = item.is_dir(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        if _is_ignored(rules, child, is_dir):
+                            continue
+                        (subdirs if is_dir else files).append(item.name)
+            except OSError:
+                pass
+            entry = {
+                "mtime": mtime,
+                "ignore_mtime": ignore_mtime,
+                "ignore": ignore_lines,
+                "sig": sig,
+                "files": sorted(files),
+                "dirs": sorted(subdirs),
+            }
+            changed = True
+        seen[rel] = entry
+        for name in entry["dirs"]:
+            changed = (
+                self._refresh_dir(f"{rel}/{name}" if rel else name, rules, sig, seen)
+                or changed
+            )
+        return changed
+
+    def files(self) -> List[str]:
+        """Alle indexierten Dateien als relative Pfade (sortiert, gecacht bis zur nächsten Änderung)."""
+
+        with self._lock:
+            if self._files is None:
+                self._files = sorted(
+                    f"{rel}/{name}" if rel else name
+                    for rel, entry in self.dirs.items()
+                    for name in entry["files"]
+                )
+            return self._files
+
+
+_PROJECT_INDEXES: Dict[str, ProjectIndex] = {}
+_PROJECT_INDEX_LOCK = threading.Lock()
+
+
+def project_index(root: str) -> ProjectIndex:
+    """Liefert den aktualisierten Index für ``root`` (pro Prozess gecacht, auf der Platte persistiert)."""
+
+    real = os.path.realpath(root)
+    with _PROJECT_INDEX_LOCK:
+        index = _PROJECT_INDEXES.get(real)
+        if index is None:
+            index = _PROJECT_INDEXES[real] = ProjectIndex(real)
+            index.load()
+    if index.refresh():
+        index.save()
+    return index
+
+
+def _index_scope(sess, path: Optional[str]) -> Tuple[ProjectIndex, str]:
+    """Index des Arbeitsverzeichnisses plus relativer Unterpfad; Pfade außerhalb bekommen einen eigenen Index."""
+
+    root = os.path.realpath(sess.workdir)
+    target = os.path.realpath(sess.resolve(path or "."))
+    if target == root or target.startswith(root + os.sep):
+        rel = os.path.relpath(target, root).replace(os.sep, "/")
+        return project_index(root), "" if rel == "." else rel
+    return project_index(target), ""
+
+
+def _in_scope(rel: str, prefix: str) -> bool:
+    return not prefix or rel == prefix or rel.startswith(prefix + "/")
+
+
+def find_files(
+    index: ProjectIndex, pattern: str, prefix: str = "", limit: int = 50
+) -> str:
+    started = time.monotonic()
+    needle = pattern.strip().lower()
+    is_glob = any(ch in needle for ch in "*?[")
+    glob_re = _gitignore_regex(needle) if is_glob else None
+    ranked = []
+    for rel in index.files():
+        if not _in_scope(rel, prefix):
+            continue
+        low = rel.lower()
+        base = low.rsplit("/", 1)[-1]
+        if glob_re is not None:
+            if not glob_re.match(low):
+                continue
+            rank = 0
+        elif base == needle:
+            rank = 0
+        elif base.startswith(needle):
+            rank = 1
+        elif needle in base:
+            rank = 2
+        elif needle in low:
+            rank = 3
+        else:
+            continue
+        ranked.append((rank, len(rel), rel))
+    ranked.sort()
+    shown = [rel for _, _, rel in ranked[:limit]]
+    ms = (time.monotonic() - started) * 1000
+    head = f"[find_files] '{pattern}' – {len(ranked)} Treffer ({ms:.0f} ms)"
+    if len(ranked) > limit:
+        head += f", zeige {limit}"
+    return head + ("\n" + "\n".join(shown) if shown else "")
+
+
+def _definition_regex(query: str) -> Optional["re.Pattern[str]"]:
+    if not re.fullmatch(r"[A-Za-z_][\w$]*", query):
+        return None
+    word = re.escape(query)
+    return re.compile(
+        rf"^\s*(?:(?:export|pub|public|private|static|async|default)\s+)*"
+        rf"(?:def|class|function|func|fn|interface|type|struct|enum|trait|const|let|var)\s+{word}\b"
+        rf"|^\s*{word}\s*(?::[^=]*)?=(?!=)"
+    )
+
+
+def _search_chunk(
+    root: str,
+    rels: List[str],
+    source: str,
+    flags: int,
+    context: int,
+    per_file: int,
+    definition: Optional[str],
+) -> List[Tuple[str, int, List[Tuple[int, List[str]]]]]:
+    """Durchsucht einen Teil der Dateien (läuft im Prozess-Pool, daher nur einfache Typen)."""
+
+    regex = re.compile(source, flags)
+    def_re = re.compile(definition) if definition else None
+    found = []
+    for rel in rels:
+        path = os.path.join(root, rel)
+        try:
+            if os.path.getsize(path) > SEARCH_MAX_FILE_BYTES:
+                continue
+            with open(path, "rb") as fh:
+                data = fh.read()
+        except OSError:
+            continue
+        if b"\0" in data[:8192]:
+            continue
+        text = data.decode("utf-8", errors="replace")
+        if not regex.search(text):
+            continue
+        lines = text.splitlines()
+        hits, score = [], 0
+        for no, line in enumerate(lines):
+            if not regex.search(line):
+                continue
+            score += 1
+            if def_re is not None and def_re.search(line):
+                score += 20
+            if len(hits) < per_file:
+                lo, hi = max(0, no - context), min(len(lines), no + context + 1)
+                hits.append((no + 1, [line[:300] for line in lines[lo:hi]]))
+        if hits:
+            found.append((rel, score, hits))
+    return found
+
+
+SEARCH_WORKERS = max(1, min(8, os.cpu_count() or 1))
+_SEARCH_POOL: Optional["ProcessPoolExecutor"] = None
+_SEARCH_POOL_LOCK = threading.Lock()
+
+
+def _search_pool() -> "ProcessPoolExecutor":
+    """Prozess-Pool für große Suchen, per forkserver/spawn gestartet.
+
+    Der Pool entsteht aus einem Tool-Thread, während Pump- und Pool-Threads
+    laufen – ``fork`` könnte dabei gehaltene Locks in die Kinder kopieren.
+    """
+
+    global _SEARCH_POOL
+    import multiprocessing  # lädt multiprocessing erst bei Bedarf
+    from concurrent.futures import ProcessPoolExecutor
+
+    with _SEARCH_POOL_LOCK:
+        if _SEARCH_POOL is None:
+            method = (
+                "forkserver"
+                if "forkserver" in multiprocessing.get_all_start_methods()
+                else "spawn"
+            )
+            _SEARCH_POOL = ProcessPoolExecutor(
+                max_workers=SEARCH_WORKERS,
+                mp_context=multiprocessing.get_context(method),
+            )
+            atexit.register(_shutdown_search_pool)
+        return _SEARCH_POOL
+
+
+def _shutdown_search_pool() -> None:
+    global _SEARCH_POOL
+    with _SEARCH_POOL_LOCK:
+        pool, _SEARCH_POOL = _SEARCH_POOL, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _discard_search_pool(pool: Any) -> None:
+    """Verwirft einen Pool mit hängendem Worker; die nächste Suche startet einen neuen."""
+
+    global _SEARCH_POOL
+    with _SEARCH_POOL_LOCK:
+        if _SEARCH_POOL is pool:
+            _SEARCH_POOL = None
+    for proc in list((getattr(pool, "_processes", None) or {}).values()):
+        proc.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def search_files(
+    index: ProjectIndex,
+    query: str,
+    prefix: str = "",
+    regex: bool = False,
+    case_sensitive: bool = False,
+    glob: Optional[str] = None,
+    context: int = 2,
+    max_results: int = 50,
+) -> str:
+    """Volltextsuche über den Index; Treffer in Definitionen und dichten Dateien zuerst."""
+
+    started = time.monotonic()
+    source = query if regex else re.escape(query)
+    flags = 0 if case_sensitive else re.IGNORECASE
+    try:
+        re.compile(source, flags)
+    except re.error as e:
+        return f"[search] Ungültiger Regex: {e}"
+    glob_re = _gitignore_regex(glob) if glob else None
+    rels = [
+        rel
+        for rel in index.files()
+        if _in_scope(rel, prefix) and (glob_re is None or glob_re.match(rel))
+    ]
+    def_re = None if regex else _definition_regex(query)
+    definition = def_re.pattern if def_re is not None else None
+    context = max(0, min(int(context), 10))
+    per_file = max(1, min(max_results, 20))
+    found: Optional[List[Tuple[str, int, List[Tuple[int, List[str]]]]]] = None
+    if len(rels) >= SEARCH_POOL_MIN_FILES and SEARCH_WORKERS > 1:
+        size = max(50, len(rels) // (SEARCH_WORKERS * 4))
+        try:
+            pool = _search_pool()
+            futures = [
+                pool.submit(
+                    _search_chunk,
+                    index.root,
+                    rels[i : i + size],
+                    source,
+                    flags,
+                    context,
+                    per_file,
+                    definition,
+                )
+                for i in range(0, len(rels), size)
+            ]
+            deadline = time.monotonic() + SEARCH_POOL_TIMEOUT
+            found = [
+                item
+                for future in futures
+                for item in future.result(timeout=max(0.0, deadline - time.monotonic()))
+            ]
+        except FutureTimeoutError:
+            _discard_search_pool(pool)
+            found = None  # hängender Worker (z. B. Netzlaufwerk) – im eigenen Prozess suchen
+        except Exception:
+            found = None  # Pool nicht nutzbar – im eigenen Prozess suchen
+    if found is None:
+        found = _search_chunk(
+            index.root, rels, source, flags, context, per_file, definition
+        )
+    found.sort(key=lambda item: (-item[1], len(item[0]), item[0]))
+
+    blocks, total = [], 0
+    for rel, _, hits in found:
+        for lineno, lines in hits:
+            if total >= max_results:
+                break
+            first = lineno - min(context, lineno - 1)
+            rows = []
+            for offset, line in enumerate(lines):
+                no = first + offset
+                rows.append(
+                    f"{rel}{':' if no == lineno else '-'}{no}{':' if no == lineno else '-'}{line}"
+                )
+            blocks.append("\n".join(rows))
+            total += 1
+    matches = sum(len(hits) for _, _, hits in found)
+    ms = (time.monotonic() - started) * 1000
+    head = f"[search] '{query}' – {len(found)} Dateien mit Treffern, {len(rels)} durchsucht ({ms:.0f} ms)"
+    if matches > total:
+        head += f", zeige {total} Treffer"
+    return head + ("\n" + "\n--\n".join(blocks) if blocks else "")
+
+
+LIST_DIR_SKIP = {
+    ".git",
+    ".hg",
+    ".svn",
+    "node_modules",
+    "__pycache__",
+    ".venv",
+    "venv",
+    ".tox",
+    ".mypy_cache",
+    ".pytest_cache",
+    ".ruff_cache",
+}
+LIST_DIR_MAX_ENTRIES = 50
+_IGNORE_FILES: Dict[str, Tuple[int, List[str]]] = {}
+
+
+def _human_size(size: int) -> str:
+    for unit in ("B", "K", "M", "G"):
+        if size < 1024 or unit == "G":
+            return f"{size}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024  # type: ignore[assignment]
+    return f"{size}B"
+
+
+def _ignore_lines(path: str) -> List[str]:
+    known = _IGNORE_FILES.get(path)
+    current = _read_ignore_file(path, known)
+    _IGNORE_FILES[path] = current
+    return current[1]
+
+
+def _scan_dir(
+    path: str, cache: Optional[Dict[str, Tuple[int, List[Tuple[str, bool, int]]]]]
+) -> List[Tuple[str, bool, int]]:
+    """(Name, ist_Verzeichnis, Größe) aller Einträge; gecacht, solange sich die mtime nicht ändert."""
+
+    mtime = os.stat(path).st_mtime_ns
+    hit = cache.get(path) if cache is not None else None
+    if hit is not None and hit[0] == mtime:
+        return hit[1]
+    entries = []
+    with os.scandir(path) as it:
+        for item in it:
+            try:
+                is_dir = item.is_dir(follow_symlinks=False)
+                size = 0 if is_dir else item.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+            entries.append((item.name, is_dir, size))
+    entries.sort(key=lambda e: (not e[1], e[0]))  # Verzeichnisse zuerst
+    if cache is not None:
+        cache[path] = (mtime, entries)
+    return entries
+
+
+def _repo_ignore_rules(path: str) -> Tuple[str, Tuple[Any, ...]]:
+    """Repo-Wurzel (oder ``path``) und die bis ``path`` geerbten Ignore-Regeln."""
+
+    root = path
+    probe = path
+    while True:
+        if os.path.exists(os.path.join(probe, ".git")):
+            root = probe
+            break
+        parent = os.path.dirname(probe)
+        if parent == probe:
+            break
+        probe = parent
+    rules = _parse_gitignore(
+        _ignore_lines(os.path.join(root, ".git", "info", "exclude")), ""
+    )
+    rel = os.path.relpath(path, root).replace(os.sep, "/")
+    parts = [] if rel == "." else rel.split("/")
+    for i in range(len(parts)):  # .gitignore von path selbst liest der Walk
+        base = "/".join(parts[:i])
+        rules = rules + _parse_gitignore(
+            _ignore_lines(os.path.join(root, *parts[:i], ".gitignore")), base
+        )
+    return ("" if rel == "." else rel), rules
+
+
+def list_dir(
+    path: str,
+    depth: int = 1,
+    glob: Optional[str] = None,
+    show_all: bool = False,
+    max_entries: int = LIST_DIR_MAX_ENTRIES,
+    cache: Optional[Dict[str, Tuple[int, List[Tuple[str, bool, int]]]]] = None,
+) -> str:
+    """Kompakte Baumansicht bis ``depth`` Ebenen, optional per Glob gefiltert.
+
+    Beachtet .gitignore, blendet VCS-, node_modules- und venv-Ordner aus (außer
+    ``show_all``) und zeigt pro Verzeichnis höchstens ``max_entries`` Einträge.
+    """
+
+    p = Path(path).expanduser().resolve()
+    if not p.exists():
+        return f"[list_dir] Pfad existiert nicht: {p}"
+    if p.is_file():
+        return f"[list_dir] {p} ist eine Datei"
+    depth = max(1, int(depth))
+    glob_re = _gitignore_regex(glob) if glob else None
+    base_rel, rules = _repo_ignore_rules(str(p)) if not show_all else ("", ())
+    hidden = [0]
+
+    def walk(abs_path: str, rel: str, level: int, rules: Tuple[Any, ...]) -> List[str]:
+        try:
+            entries = _scan_dir(abs_path, cache)
+        except OSError as e:
+            return [f"{'  ' * level}[Fehler: {e.strerror}]"]
+        if not show_all and any(name == ".gitignore" for name, _, _ in entries):
+            rules = rules + _parse_gitignore(
+                _ignore_lines(os.path.join(abs_path, ".gitignore")), rel
+            )
+        indent = "  " * level
+        rows, shown, more = [], 0, 0
+        for name, is_dir, size in entries:
+            child = f"{rel}/{name}" if rel else name
+            if not show_all and (
+                (is_dir and name in LIST_DIR_SKIP) or _is_ignored(rules, child, is_dir)
+            ):
+                hidden[0] += 1
+                continue
+            if is_dir:
+                sub = (
+                    walk(os.path.join(abs_path, name), child, level + 1, rules)
+                    if level + 1 < depth
+                    else []
+                )
+                if glob_re is not None and not sub:
+                    continue
+                block = [f"{indent}{name}/"] + sub
+            else:
+                if glob_re is not None and not glob_re.match(
+                    child[len(base_rel) + 1 :] if base_rel else child
+                ):
+                    continue
+                block = [f"{indent}{name}  {_human_size(size)}"]
+            if shown >= max_entries:
+                more += 1
+                continue
+            rows.extend(block)
+            shown += 1
+        if more:
+            rows.append(f"{indent}… {more} weitere Einträge")
+        return rows
+
+    rows = walk(str(p), base_rel, 0, rules)
+    head = f"[list_dir] {p}"
+    if hidden[0]:
+        head += f" ({hidden[0]} ignoriert)"
+    return head + ("\n" + "\n".join(rows) if rows else "")
+
+
+READ_FILE_MAX_BYTES = int(os.getenv("GPTCODE_READ_MAX_BYTES", str(64 * 1024)))
+READ_FILE_MMAP_THRESHOLD = 1024 * 1024
+_LINE_INDEX_CACHE: "OrderedDict[Tuple[str, int, int], array]" = OrderedDict()
+_LINE_INDEX_CACHE_SIZE = 16
+_LINE_INDEX_LOCK = threading.Lock()
+_LINE_INDEX_BLOCK = 64 * 1024  # Auflösung des dünnen Zeilenindex
+_COUNT_CHUNK = 16 * 1024 * 1024
+
+
+class _FileView:
+    """Einheitlicher Byte-Zugriff auf kleine (gelesen) und große (mmap) Dateien."""
+
+    def __init__(self, p: Path, size: int) -> None:
+        self._file = p.open("rb")
+        self._map: Optional[mmap.mmap] = None
+        if size >= READ_FILE_MMAP_THRESHOLD:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data: Any = self._map
+        else:
+            self.data = self._file.read()
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self) -> "_FileView":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+
+def _line_index(key: Tuple[str, int, int], data: Any) -> array:
+    """Dünner Zeilenindex: Anzahl Zeilenumbrüche vor jedem 64-KiB-Block; gecacht pro (Pfad, mtime, Größe)."""
+
+    with _LINE_INDEX_LOCK:
+        cached = _LINE_INDEX_CACHE.get(key)
+        if cached is not None:
+            _LINE_INDEX_CACHE.move_to_end(key)
+            return cached
+    size = key[2]
+    counts = array("q", [0])
+    for pos in range(0, size, _LINE_INDEX_BLOCK):
+        counts.append(counts[-1] + data[pos : pos + _LINE_INDEX_BLOCK].count(b"\n"))
+    with _LINE_INDEX_LOCK:
+        _LINE_INDEX_CACHE[key] = counts
+        while len(_LINE_INDEX_CACHE) > _LINE_INDEX_CACHE_SIZE:
+            _LINE_INDEX_CACHE.popitem(last=False)
+    return counts
+
+
+def _line_offset(data: Any, counts: array, line: int) -> int:
+    """Byte-Offset des Anfangs von ``line`` (1-basiert): Block per Bisektion, darin ``split`` in C."""
+
+    n = line - 1
+    if n <= 0:
+        return 0
+    block = bisect_left(counts, n) - 1
+    k = n - counts[block]
+    base = block * _LINE_INDEX_BLOCK
+    parts = data[base : base + _LINE_INDEX_BLOCK].split(b"\n", k)[:k]
+    return base + sum(map(len, parts)) + k
+
+
+def _total_lines(data: Any, size: int, newlines: int) -> int:
+    return newlines + 1 if size and data[size - 1 : size] != b"\n" else newlines
+
+
+def _count_newlines(data: Any, size: int) -> int:
+    return sum(
+        data[pos : pos + _COUNT_CHUNK].count(b"\n")
+        for pos in range(0, size, _COUNT_CHUNK)
+    )
+
+
+def _cut_at_newline(chunk: bytes) -> bytes:
+    cut = chunk.rfind(b"\n")
+    return chunk[: cut + 1] if cut != -1 else chunk
+
+
+def read_file(
+    path: str,
+    start_line: Optional[int] = None,
+    end_line: Optional[int] = None,
+    offset: Optional[int] = None,
+    length: Optional[int] = None,
+    max_bytes: int = READ_FILE_MAX_BYTES,
+) -> str:
+    """Liest eine Datei vollständig, zeilen- oder byteweise – höchstens ``max_bytes``.
+
+    Zeilen sind 1-basiert und inklusive. Große Dateien werden per mmap gelesen.
+    Ohne Bereich genügt der Anfang der Datei plus eine Zählung der Umbrüche;
+    für Zeilenbereiche wird ein dünner Index pro (Pfad, mtime, Größe) gecacht.
+    """
+
+    p = Path(path).expanduser().resolve()
+    if not p.exists() or not p.is_file():
+        return f"[read_file] Datei nicht gefunden: {p}"
+    try:
+        st = p.stat()
+        size = st.st_size
+        ranged = start_line is not None or end_line is not None
+        if not ranged and offset is None and length is None and size <= max_bytes:
+            return p.read_text(encoding="utf-8", errors="ignore")
+        key = (str(p), st.st_mtime_ns, size)
+        with _FileView(p, size) as view:
+            data = view.data
+            if offset is not None or length is not None:
+                start = max(0, int(offset or 0))
+                want = int(length) if length is not None else size - start
+                stop = min(size, start + max(0, min(want, max_bytes)))
+                chunk = bytes(data[start:stop])
+                header = f"[read_file] {p} Bytes {start}–{stop} von {size}"
+                if stop < min(size, start + want):
+                    header += f" (gekürzt, Limit {max_bytes}B)"
+                return header + "\n" + chunk.decode("utf-8", errors="ignore")
+
+            if ranged:
+                counts = _line_index(key, data)
+                total = _total_lines(data, size, counts[-1])
+            else:
+                total = _total_lines(data, size, _count_newlines(data, size))
+            first = max(1, int(start_line or 1))
+            last = min(total, int(end_line)) if end_line is not None else total
+            if first > last:
+                return f"[read_file] {p}: Zeilenbereich {first}–{last} leer (Datei hat {total} Zeilen)"
+            begin = _line_offset(data, counts, first) if ranged else 0
+            end = (
+                _line_offset(data, counts, last + 1)
+                if ranged and last < total
+                else size
+            )
+            chunk = bytes(data[begin : min(end, begin + max_bytes)])
+            shown_last = last
+            if end - begin > max_bytes:
+                chunk = _cut_at_newline(chunk)
+                shown_last = first - 1 + chunk.count(b"\n")
+                if shown_last < first:
+                    shown_last = first
+            text = chunk.decode("utf-8", errors="ignore")
+            remaining = last - shown_last
+            marker = ""
+            if remaining > 0:
+                marker = (
+                    f"\n… [gekürzt: noch {remaining} Zeilen bis Zeile {last}; "
+                    f"weiter mit start_line={shown_last + 1}]"
+                )
+            if not ranged:
+                return text + marker
+            return f"[read_file] {p} Zeilen {first}–{shown_last} von {total}\n{text}{marker}"
+    except Exception as e:
+        return f"[read_file] Fehler: {e}"
+
+
+def write_file(path: str, content: str, dry: bool = False) -> str:
+    p = Path(path).expanduser().resolve()
+    if dry:
+        return f"[write_file:DRYRUN] Würde schreiben: {p} (len={len(content)}B)"
+    p.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        old = p.read_text(encoding="utf-8", errors="ignore") if p.exists() else None
+        p.write_text(content, encoding="utf-8")
+        return f"[write_file] Geschrieben: {p} (alt: {len(old or '')}B, neu: {len(content)}B)"
+    except Exception as e:
+        return f"[write_file] Fehler: {e}"
+
+
+EDIT_FUZZY_THRESHOLD = 0.85
+EDIT_DIFF_MAX_LINES = 120
+
+
+def _atomic_write(p: Path, content: str) -> None:
+    """Schreibt über eine Temp-Datei im Zielordner plus ``os.replace`` (Rechte bleiben erhalten)."""
+
+    fd, tmp = tempfile.mkstemp(prefix=f".{p.name}.", suffix=".tmp", dir=str(p.parent))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as fh:
+            fh.write(content)
+        if p.exists():
+            os.chmod(tmp, p.stat().st_mode & 0o7777)
+        os.replace(tmp, p)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _reindent(block: str, old: str, new: str) -> str:
+    if old == new:
+        return block
+    lines = block.splitlines(keepends=True)
+    if not all(line.startswith(old) or not line.strip() for line in lines):
+        return block
+    return "".join(new + line[len(old) :] if line.strip() else line for line in lines)
+
+
+def _locate_block(text: str, search: str) -> Tuple[int, int, str, str]:
+    """Findet ``search`` eindeutig in ``text``: exakt, whitespace-tolerant oder unscharf.
+
+    Liefert (start, ende, Art, Einrückungskorrektur) oder wirft ``ValueError``.
+    """
+
+    count = text.count(search)
+    if count == 1:
+        start = text.index(search)
+        return start, start + len(search), "exakt", ""
+    if count > 1:
+        raise ValueError(
+            f"Suchblock ist mehrdeutig ({count} Treffer) – mehr Kontext angeben"
+        )
+    lines = text.splitlines(keepends=True)
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+    wanted = [line.strip() for line in search.strip("\n").splitlines()]
+    n = len(wanted)
+    if not n or n > len(lines):
+        raise ValueError("Suchblock nicht gefunden")
+    stripped = [line.strip() for line in lines]
+    matches = [i for i in range(len(lines) - n + 1) if stripped[i : i + n] == wanted]
+    kind = "whitespace"
+    if not matches:
+        target = "\n".join(wanted)
+        scored = []
+        for i in range(len(lines) - n + 1):
+            matcher = difflib.SequenceMatcher(
+                None, "\n".join(stripped[i : i + n]), target, autojunk=False
+            )
+            if (
+                matcher.real_quick_ratio() >= EDIT_FUZZY_THRESHOLD
+                and matcher.quick_ratio() >= EDIT_FUZZY_THRESHOLD
+            ):
+                ratio = matcher.ratio()
+                if ratio >= EDIT_FUZZY_THRESHOLD:
+                    scored.append((ratio, i))
+        if not scored:
+            raise ValueError("Suchblock nicht gefunden (auch nicht unscharf)")
+        scored.sort(reverse=True)
+        if len(scored) > 1 and scored[1][0] >= scored[0][0] - 0.01:
+            raise ValueError("Suchblock unscharf mehrdeutig – mehr Kontext angeben")
+        matches, kind = [scored[0][1]], f"unscharf {scored[0][0]:.0%}"
+    if len(matches) > 1:
+        raise ValueError(
+            f"Suchblock ist mehrdeutig ({len(matches)} Treffer) – mehr Kontext angeben"
+        )
+    i = matches[0]
+    first = search.strip("\n").splitlines()[0]
+    old_indent = first[: len(first) - len(first.lstrip())]
+    new_indent = lines[i][: len(lines[i]) - len(lines[i].lstrip())]
+    end = offsets[i + n]
+    if not search.endswith("\n") and lines[i + n - 1].endswith("\n"):
+        end -= len(lines[i + n - 1]) - len(lines[i + n - 1].rstrip("\r\n"))
+    return offsets[i], end, kind, f"{old_indent}\0{new_indent}"
+
+
+def edit_file(path: str, edits: List[Dict[str, Any]], dry: bool = False) -> str:
+    """Wendet Such/Ersetz- bzw. Zeilenbereichs-Edits im Speicher an und schreibt atomar.
+
+    Alle Edits beziehen sich auf den ursprünglichen Inhalt und dürfen sich nicht
+    überlappen; schlägt einer fehl, bleibt die Datei unverändert. Zurück kommt
+    nur ein kompakter Diff.
+    """
+
+    p = Path(path).expanduser().resolve()
+    if not p.is_file():
+        return f"[edit_file] Datei existiert nicht: {p} (neue Dateien mit write_file anlegen)"
+    if not isinstance(edits, list) or not edits:
+        return "[edit_file] Keine Edits angegeben."
+    try:
+        with p.open(encoding="utf-8", newline="") as fh:
+            text = fh.read()
+    except (OSError, UnicodeDecodeError) as e:
+        return f"[edit_file] Fehler beim Lesen: {e}"
+    newline = "\r\n" if "\r\n" in text else "\n"
+    line_starts = [0]
+    for line in text.splitlines(keepends=True):
+        line_starts.append(line_starts[-1] + len(line))
+    spans, notes = [], []
+    for no, edit in enumerate(edits, 1):
+        if not isinstance(edit, dict):
+            return f"[edit_file] Edit {no}: muss ein Objekt sein."
+        replace = str(edit.get("replace", "")).replace("\r\n", "\n")
+        if newline != "\n":
+            replace = replace.replace("\n", newline)
+        if "search" in edit:
+            search = str(edit["search"]).replace("\r\n", "\n")
+            if newline != "\n":
+                search = search.replace("\n", newline)
+            if not search.strip():
+                return f"[edit_file] Edit {no}: leerer Suchblock."
+            try:
+                start, end, kind, indent = _locate_block(text, search)
+            except ValueError as e:
+                return f"[edit_file] Edit {no}: {e}. Datei unverändert."
+            if kind != "exakt":
+                old, new = indent.split("\0")
+                replace = _reindent(replace, old, new)
+                notes.append(f"Edit {no}: {kind}")
+        elif "start_line" in edit:
+            first, last = int(edit["start_line"]), int(
+                edit.get("end_line", edit["start_line"])
+            )
+            total = len(line_starts) - 1
+            if first < 1 or last < first - 1 or last > total:
+                return f"[edit_file] Edit {no}: Zeilenbereich {first}-{last} ungültig (Datei hat {total} Zeilen)."
+            start, end = line_starts[first - 1], line_starts[last]
+            if (
+                replace
+                and not replace.endswith(newline)
+                and end > start
+                and text[end - 1 : end] == "\n"
+            ):
+                replace += newline
+        else:
+            return f"[edit_file] Edit {no}: braucht 'search' oder 'start_line'."
+        spans.append((start, end, replace, no))
+    spans.sort()
+    for (s1, e1, _, a), (s2, _, _, b) in zip(spans, spans[1:]):
+        if s2 < e1:
+            return f"[edit_file] Edits {a} und {b} überlappen. Datei unverändert."
+    parts, pos = [], 0
+    for start, end, replace, _ in spans:
+        parts.append(text[pos:start])
+        parts.append(replace)
+        pos = end
+    parts.append(text[pos:])
+    updated = "".join(parts)
+    if updated == text:
+        return f"[edit_file] {p}: keine Änderung."
+    diff = list(
+        difflib.unified_diff(text.splitlines(), updated.splitlines(), lineterm="", n=2)
+    )[2:]
+    added = sum(1 for row in diff if row.startswith("+"))
+    removed = sum(1 for row in diff if row.startswith("-"))
+    if len(diff) > EDIT_DIFF_MAX_LINES:
+        diff = diff[:EDIT_DIFF_MAX_LINES] + [
+            f"… {len(diff) - EDIT_DIFF_MAX_LINES} Diff-Zeilen ausgelassen"
+        ]
+    head = f"{p}: {len(spans)} Edit(s), +{added}/-{removed}" + (
+        f" ({'; '.join(notes)})" if notes else ""
+    )
+    if dry:
+        return f"[edit_file:DRYRUN] {head}\n" + "\n".join(diff)
+    try:
+        _atomic_write(p, updated)
+    except OSError as e:
+        return f"[edit_file] Fehler beim Schreiben: {e}"
+    return f"[edit_file] {head}\n" + "\n".join(diff)
+
+
+PATCH_MAX_FUZZ = 2
+_HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+@dataclass
+class PatchHunk:
+    header: str
+    old_start: int
+    lines: List[Tuple[str, str]] = field(
+        default_factory=list
+    )  # (" "|"-"|"+", Zeile inkl. Umbruch)
+
+    def old_lines(self) -> List[str]:
+        return [text for tag, text in self.lines if tag != "+"]
+
+
+@dataclass
+class FilePatch:
+    old_path: Optional[str]
+    new_path: Optional[str]
+    hunks: List[PatchHunk] = field(default_factory=list)
+
+    @property
+    def path(self) -> str:
+        return self.new_path or self.old_path or ""
+
+
+def _patch_name(raw: str) -> Optional[str]:
+    name = raw[4:].split("\t", 1)[0].strip()
+    return None if name == "/dev/null" else name
+
+
+def parse_patch(patch_text: str) -> List[FilePatch]:
+    """Zerlegt einen Unified-Diff in Dateien und Hunks; wirft ``ValueError`` bei kaputten Hunks."""
+
+    files: List[FilePatch] = []
+    current: Optional[FilePatch] = None
+    hunk: Optional[PatchHunk] = None
+    remaining = [0, 0]
+    lines = patch_text.splitlines(keepends=True)
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if hunk is not None and (remaining[0] > 0 or remaining[1] > 0):
+            tag = (
+                line[:1]
+                if line[:1] in " -+"
+                else (" " if line in ("\n", "\r\n") else "")
+            )
+            if line.startswith("\\"):
+                i += 1
+                continue
+            if not tag:
+                raise ValueError(
+                    f"{current.path if current else '?'}: {hunk.header.strip()} endet vorzeitig"
+                )
+            text = line[1:] if line[:1] in " -+" else line
+            hunk.lines.append((tag, text))
+            if tag != "+":
+                remaining[0] -= 1
+            if tag != "-":
+                remaining[1] -= 1
+            if i + 1 < len(lines) and lines[i + 1].startswith("\\"):
+                hunk.lines[-1] = (tag, text.rstrip("\r\n"))
+            i += 1
+            continue
+        if (
+            line.startswith("--- ")
+            and i + 1 < len(lines)
+            and lines[i + 1].startswith("+++ ")
+        ):
+            current = FilePatch(_patch_name(line), _patch_name(lines[i + 1]))
+            files.append(current)
+            hunk = None
+            i += 2
+            continue
+        match = _HUNK_HEADER.match(line)
+        if match and current is not None:
+            old_len = int(match.group(2)) if match.group(2) is not None else 1
+            new_len = int(match.group(4)) if match.group(4) is not None else 1
+            hunk = PatchHunk(header=line.rstrip("\r\n"), old_start=int(match.group(1)))
+            current.hunks.append(hunk)
+            remaining = [old_len, new_len]
+        i += 1
+    if hunk is not None and (remaining[0] > 0 or remaining[1] > 0):
+        raise ValueError(
+            f"{current.path if current else '?'}: {hunk.header} endet vorzeitig"
+        )
+    return [f for f in files if f.hunks]
+
+
+def _strip_git_prefix(fp: FilePatch, base: Path) -> Tuple[Optional[str], Optional[str]]:
+    """``a/``/``b/``-Präfixe von git-Diffs entfernen, wenn der Pfad sonst nicht passt (-p0 bleibt Standard)."""
+
+    old, new = fp.old_path, fp.new_path
+    prefixed = (old is None or old.startswith("a/")) and (
+        new is None or new.startswith("b/")
+    )
+    if prefixed and not (old and (base / old).exists()):
+        old = old[2:] if old else None
+        new = new[2:] if new else None
+    return old, new
+
+
+def _find_hunk(lines: List[str], old: List[str], expected: int) -> Optional[int]:
+    """Sucht ``old`` ab der erwarteten Position, dann abwechselnd davor/dahinter."""
+
+    n = len(old)
+    limit = len(lines) - n
+    if limit < 0:
+        return None
+    expected = min(max(expected, 0), limit)
+    for delta in range(0, limit + 1):
+        for pos in ((expected - delta, expected + delta) if delta else (expected,)):
+            if 0 <= pos <= limit and lines[pos : pos + n] == old:
+                return pos
+    return None
+
+
+def _closest_mismatch(lines: List[str], old: List[str], expected: int) -> str:
+    if not old:
+        return ""
+    expected = min(max(expected, 0), max(len(lines) - 1, 0))
+    for k, want in enumerate(old):
+        pos = expected + k
+        got = lines[pos] if pos < len(lines) else "<Dateiende>"
+        if got != want:
+            return f"; an Zeile {pos+1} erwartet {want.rstrip()!r}, gefunden {got.rstrip()!r}"
+    return ""
+
+
+def _lf(line: str) -> str:
+    return line[:-2] + "\n" if line.endswith("\r\n") else line
+
+
+def _apply_hunks(
+    lines: List[str], hunks: List[PatchHunk], label: str, newline: str = "\n"
+) -> Tuple[List[str], List[str], List[str]]:
+    """Wendet Hunks im Speicher an: exakt, mit Offset, mit Fuzz (Kontext kürzen) oder whitespace-tolerant.
+
+    Verglichen wird ohne ``\\r``; Kontextzeilen bleiben wie in der Datei, neue
+    Zeilen erhalten deren Zeilenende ``newline``. Liefert (neue Zeilen, Hinweise,
+    Fehler); bei Fehlern bleibt das Ergebnis unbrauchbar.
+    """
+
+    result = list(lines)
+    notes, errors = [], []
+    shift = 0
+    for no, hunk in enumerate(hunks, 1):
+        old = [_lf(line) for line in hunk.old_lines()]
+        expected = (hunk.old_start - 1 if old else hunk.old_start) + shift
+        pos, fuzz, lenient = None, 0, False
+        view = [_lf(line) for line in result]
+        for fuzz in range(0, PATCH_MAX_FUZZ + 1):
+            lead = min(fuzz, _leading_context(hunk))
+            trail = min(fuzz, _trailing_context(hunk))
+            cand_old = old[lead : len(old) - trail]
+            if fuzz and not (lead or trail):
+                continue
+            pos = _find_hunk(view, cand_old, expected + lead)
+            if pos is None:
+                stripped = [line.rstrip() for line in view]
+                found = _find_hunk(
+                    stripped, [line.rstrip() for line in cand_old], expected + lead
+                )
+                if found is not None:
+                    pos, lenient = found, True
+            if pos is not None:
+                new_part, at = [], pos
+                for tag, text in hunk.lines[lead : len(hunk.lines) - trail]:
+                    if tag == "+":
+                        new_part.append(
+                            text[:-1].rstrip("\r") + newline
+                            if text.endswith("\n")
+                            else text
+                        )
+                        continue
+                    if tag == " ":
+                        new_part.append(result[at])
+                    at += 1
+                result[pos : pos + len(cand_old)] = new_part
+                offset = pos - lead - expected
+                shift += len(new_part) - len(cand_old) + offset
+                detail = []
+                if offset:
+                    detail.append(f"Offset {offset:+d}")
+                if fuzz:
+                    detail.append(f"Fuzz {fuzz}")
+                if lenient:
+                    detail.append("Whitespace ignoriert")
+                if detail:
+                    notes.append(f"{label} Hunk {no}: {', '.join(detail)}")
+                break
+        if pos is None:
+            errors.append(
+                f"{label} Hunk {no} ({hunk.header}): Kontext nicht gefunden"
+                f"{_closest_mismatch(view, old, expected)}"
+            )
+    return result, notes, errors
+
+
+def _leading_context(hunk: PatchHunk) -> int:
+    count = 0
+    for tag, _ in hunk.lines:
+        if tag != " ":
+            break
+        count += 1
+    return count
+
+
+def _trailing_context(hunk: PatchHunk) -> int:
+    count = 0
+    for tag, _ in reversed(hunk.lines):
+        if tag != " ":
+            break
+        count += 1
+    return count
+
+
+def apply_patch(patch_text: str, dry: bool = False, cwd: Optional[str] = None) -> str:
+    """Wendet einen Unified-Diff im Prozess an: erst alle Hunks aller Dateien prüfen, dann atomar schreiben.
+
+    Pfade gelten wie bei ``-p0`` relativ zu ``cwd`` (``a/``/``b/``-Präfixe werden
+    erkannt). Im Dry-Run wird die tatsächliche Anwendbarkeit pro Hunk gemeldet.
+    """
+
+    base = Path(cwd or os.getcwd())
+    try:
+        files = parse_patch(patch_text or "")
+    except ValueError as e:
+        return f"[apply_patch] Ungültiger Patch: {e}"
+    if not files:
+        return "[apply_patch] Keine Hunks im Patch gefunden."
+
+    planned: List[Tuple[Path, Optional[str], Optional[Path]]] = (
+        []
+    )  # (Ziel, Inhalt/None=löschen, Quelle)
+    notes, errors, summary = [], [], []
+    for fp in files:
+        old, new = _strip_git_prefix(fp, base)
+        source = (base / old) if old else None
+        target = (base / new) if new else source
+        label = new or old or "?"
+        if source is not None and not source.is_file():
+            errors.append(f"{label}: Datei existiert nicht")
+            continue
+        if source is None and target is not None and target.exists():
+            errors.append(f"{label}: soll neu angelegt werden, existiert aber bereits")
+            continue
+        try:
+            original = ""
+            if source is not None:
+                with source.open(
+                    encoding="utf-8", newline=""
+                ) as fh:  # Zeilenenden unverändert lassen
+                    original = fh.read()
+        except (OSError, UnicodeDecodeError) as e:
+            errors.append(f"{label}: nicht lesbar ({e})")
+            continue
+        newline = "\r\n" if "\r\n" in original else "\n"
+        lines = [line + "\n" for line in original.split("\n")]
+        lines[-1] = lines[-1][:-1]
+        if not lines[-1]:
+            lines.pop()
+        lines, file_notes, file_errors = _apply_hunks(lines, fp.hunks, label, newline)
+        notes.extend(file_notes)
+        errors.extend(file_errors)
+        if file_errors:
+            continue
+        added = sum(1 for h in fp.hunks for tag, _ in h.lines if tag == "+")
+        removed = sum(1 for h in fp.hunks for tag, _ in h.lines if tag == "-")
+        summary.append(f"{label} (+{added}/-{removed}, {len(fp.hunks)} Hunk(s))")
+        content = None if new is None else "".join(lines)
+        planned.append(
+            (
+                target,
+                content,
+                source if source is not None and source != target else None,
+            )
+        )
+
+    note_text = ("\n" + "\n".join(notes)) if notes else ""
+    if errors:
+        prefix = "[apply_patch:DRYRUN]" if dry else "[apply_patch]"
+        return (
+            f"{prefix} Patch nicht anwendbar, nichts geschrieben:\n"
+            + "\n".join(errors)
+            + note_text
+        )
+    if dry:
+        return "[apply_patch:DRYRUN] Patch anwendbar: " + ", ".join(summary) + note_text
+
+    # Vorher-Zustand sichern, damit ein Fehler mitten im Schreiben zurückgerollt werden kann.
+    backups = [
+        (p, p.read_bytes() if p.exists() else None)
+        for t, _, s in planned
+        for p in (t, s)
+        if p is not None
+    ]
+    try:
+        for target, content, moved_from in planned:
+            if content is None:
+                target.unlink()
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            _atomic_write(target, content)
+            if moved_from is not None:
+                moved_from.unlink()
+    except OSError as e:
+        for path, data in backups:
+            try:
+                if data is None:
+                    if path.exists():
+                        path.unlink()
+                else:
+                    path.write_bytes(data)
+            except OSError:
+                pass
+        return f"[apply_patch] Fehler beim Schreiben ({e}) – Änderungen zurückgerollt."
+    return "[apply_patch] Patch angewendet: " + ", ".join(summary) + note_text
+
+
+CAPTURE_HEAD_BYTES = int(os.getenv("GPTCODE_CAPTURE_HEAD_BYTES", str(8 * 1024)))
+CAPTURE_TAIL_BYTES = int(os.getenv("GPTCODE_CAPTURE_TAIL_BYTES", str(24 * 1024)))
+_ECHO_LOCK = threading.Lock()
+# Überschreibt die TTY-Erkennung für Live-Ausgaben, z. B. im Batch-Betrieb (pro Task/Thread).
+_TOOL_ECHO: "contextvars.ContextVar[Optional[bool]]" = contextvars.ContextVar(
+    "gptcode_tool_echo", default=None
+)
+
+
+def _resolve_echo(echo: Optional[bool]) -> bool:
+    if echo is None:
+        echo = _TOOL_ECHO.get()
+    return sys.stderr.isatty() if echo is None else echo
+
+
+class _BoundedCapture:
+    """Behält Kopf und Ende eines Ausgabestroms; alles dazwischen wird nur gezählt."""
+
+    def __init__(
+        self, head_bytes: int = CAPTURE_HEAD_BYTES, tail_bytes: int = CAPTURE_TAIL_BYTES
+    ) -> None:
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.head = bytearray()
+        self.tail: "deque[bytes]" = deque()
+        self.tail_size = 0
+        self.dropped_bytes = 0
+        self.dropped_lines = 0
+
+    def write(self, data: bytes) -> None:
+        room = self.head_bytes - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if not data:
+            return
+        self.tail.append(data)
+        self.tail_size += len(data)
+        while self.tail_size > self.tail_bytes:
+            excess = self.tail_size - self.tail_bytes
+            first = self.tail[0]
+            cut = first[:excess]
+            if len(first) <= excess:
+                self.tail.popleft()
+            else:
+                self.tail[0] = first[excess:]
+            self.tail_size -= len(cut)
+            self.dropped_bytes += len(cut)
+            self.dropped_lines += cut.count(b"\n")
+
+    def text(self) -> str:
+        head = bytes(self.head).decode("utf-8", errors="ignore")
+        tail = b"".join(self.tail).decode("utf-8", errors="ignore")
+        if not self.dropped_bytes:
+            return head + tail
+        return (
+            f"{head}\n… [{self.dropped_bytes} Bytes / {self.dropped_lines} Zeilen ausgelassen] …\n"
+            f"{tail}"
+        )
+
+
+@dataclass
+class ProcessResult:
+    returncode: Optional[int]
+    stdout: str
+    stderr: str
+    timed_out: bool = False
+    duration: float = 0.0
+    matched: bool = False
+
+    def format(self, label: str) -> str:
+        return f"[{label}] rc={self.returncode}\nSTDOUT:\n{self.stdout}\nSTDERR:\n{self.stderr}"
+
+
+@dataclass
+class ProcessSpec:
+    """Beschreibt den Subprozess eines Tools, damit sync- und async-Engine ihn gleich ausführen."""
+
+    label: str
+    cmd: Union[str, List[str]]
+    shell: bool = False
+    timeout: Optional[float] = None
+    env: Optional[Dict[str, str]] = None
+    cwd: Optional[str] = None
+    timeout_note: str = "."
+    missing_note: str = ""
+    echo: Optional[bool] = None
+    until: Optional["re.Pattern[str]"] = None
+    postprocess: Optional[Callable[[ProcessResult], str]] = None
+
+    def render(self, result: ProcessResult) -> str:
+        if self.postprocess is not None:
+            return self.postprocess(result)
+        if result.timed_out:
+            return (
+                f"[{self.label}] Timeout nach {self.timeout}s{self.timeout_note}\n"
+                f"STDOUT:\n{result.stdout}\nSTDERR:\n{result.stderr}"
+            )
+        return result.format(self.label)
+
+    def render_error(self, exc: Exception) -> str:
+        if isinstance(exc, FileNotFoundError) and self.missing_note:
+            return self.missing_note
+        return f"[{self.label}] Fehler: {exc}"
+
+
+@dataclass
+class ProcessGroup:
+    """Mehrere unabhängige Subprozesse (z. B. Test-Shards), deren Ergebnisse gemeinsam ausgewertet werden.
+
+    ``build`` und ``combine`` erhalten ein temporäres Verzeichnis (z. B. für Reports), das erst
+    beim Ausführen angelegt und danach wieder entfernt wird.
+    """
+
+    label: str
+    build: Callable[[str], List[ProcessSpec]]
+    combine: Callable[
+        [str, List[Tuple[ProcessSpec, Union[ProcessResult, Exception]]]], str
+    ]
+
+
+def _spawn_spec(spec: ProcessSpec) -> Union[ProcessResult, Exception]:
+    try:
+        return run_process(
+            spec.cmd,
+            shell=spec.shell,
+            timeout=spec.timeout,
+            env=spec.env,
+            cwd=spec.cwd,
+            echo=spec.echo,
+            until=spec.until,
+        )
+    except Exception as e:
+        return e
+
+
+async def _spawn_spec_async(spec: ProcessSpec) -> Union[ProcessResult, Exception]:
+    try:
+        return await run_process_async(
+            spec.cmd,
+            shell=spec.shell,
+            timeout=spec.timeout,
+            env=spec.env,
+            cwd=spec.cwd,
+            echo=spec.echo,
+            until=spec.until,
+        )
+    except Exception as e:
+        return e
+
+
+def execute_process(plan: Union[str, ProcessSpec, ProcessGroup]) -> str:
+    if isinstance(plan, str):
+        return plan
+    if isinstance(plan, ProcessGroup):
+        with tempfile.TemporaryDirectory(prefix=f"gptcode-{plan.label}-") as tmpdir:
+            specs = plan.build(tmpdir)
+            with ThreadPoolExecutor(
+                max_workers=max(1, len(specs)), thread_name_prefix="gptcode-shard"
+            ) as pool:
+                outcomes = list(pool.map(_spawn_spec, specs))
+            return plan.combine(tmpdir, list(zip(specs, outcomes)))
+    outcome = _spawn_spec(plan)
+    return (
+        plan.render_error(outcome)
+        if isinstance(outcome, Exception)
+        else plan.render(outcome)
+    )
+
+
+async def execute_process_async(plan: Union[str, ProcessSpec, ProcessGroup]) -> str:
+    import asyncio
+
+    if isinstance(plan, str):
+        return plan
+    if isinstance(plan, ProcessGroup):
+        with tempfile.TemporaryDirectory(prefix=f"gptcode-{plan.label}-") as tmpdir:
+            specs = plan.build(tmpdir)
+            outcomes = await asyncio.gather(
+                *(_spawn_spec_async(spec) for spec in specs)
+            )
+            return plan.combine(tmpdir, list(zip(specs, outcomes)))
+    outcome = await _spawn_spec_async(plan)
+    if isinstance(outcome, Exception):
+        return plan.render_error(outcome)
+    if plan.postprocess is not None:
+        # Nachbearbeitung darf blockieren (z. B. Folgeaufruf von systemctl status) – nicht im Event-Loop.
+        return await asyncio.to_thread(plan.render, outcome)
+    return plan.render(outcome)
+
+
+def _kill_process_tree(proc: subprocess.Popen) -> None:
+    """Beendet den Prozess samt Kindern (eigene Prozessgruppe), notfalls per SIGKILL."""
+
+    try:
+        if os.name == "posix":
+            os.killpg(proc.pid, signal.SIGTERM)
+        else:
+            proc.terminate()
+        proc.wait(timeout=2)
+    except (ProcessLookupError, PermissionError):
+        pass
+    except subprocess.TimeoutExpired:
+        try:
+            if os.name == "posix":
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+        except (ProcessLookupError, PermissionError):
+            pass
+        proc.wait()
+
+
+class _LineWatcher:
+    """Prüft gestreamte Ausgabe zeilenweise gegen ein Muster (für ``until``)."""
+
+    def __init__(self, pattern: "re.Pattern[str]") -> None:
+        self.pattern = pattern
+        self._partial = b""
+
+    def feed(self, data: bytes) -> bool:
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()[-65536:]
+        return any(
+            self.pattern.search(line.decode("utf-8", errors="replace"))
+            for line in lines
+        )
+
+
+def _pump(
+    stream: Any,
+    capture: _BoundedCapture,
+    echo: Optional[Any],
+    watcher: Optional[_LineWatcher] = None,
+    on_match: Optional[Callable[[], None]] = None,
+) -> None:
+    fd = stream.fileno()
+    while True:
+        try:
+            data = os.read(fd, 65536)
+        except OSError:
+            break
+        if not data:
+            break
+        capture.write(data)
+        if echo is not None:
+            with _ECHO_LOCK:
+                echo.write(data.decode("utf-8", errors="replace"))
+                echo.flush()
+        if watcher is not None and on_match is not None and watcher.feed(data):
+            on_match()
+            watcher = None
+
+
+def run_process(
+    cmd: Union[str, List[str]],
+    *,
+    shell: bool = False,
+    timeout: Optional[float] = None,
+    env: Optional[Dict[str, str]] = None,
+    input: Optional[bytes] = None,
+    cwd: Optional[str] = None,
+    echo: Optional[bool] = None,
+    until: Optional["re.Pattern[str]"] = None,
+) -> ProcessResult:
+    """Gemeinsamer Subprozess-Runner für die Tools.
+
+    Die Ausgabe wird inkrementell gelesen, optional live ins Terminal (stderr)
+    gespiegelt und pro Stream nur als begrenzter Kopf+Ende-Puffer behalten.
+    Das Timeout greift während des Streamings und beendet die ganze Prozessgruppe;
+    ebenso eine Ausgabezeile, auf die ``until`` passt (``matched`` im Ergebnis).
+    """
+
+    echo = _resolve_echo(echo)
+    started = time.monotonic()
+    proc = subprocess.Popen(
+        cmd,
+        shell=shell,
+        stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
+        cwd=cwd,
+        start_new_session=(os.name == "posix"),
+    )
+    out, err = _BoundedCapture(), _BoundedCapture()
+    sink = sys.stderr if echo else None
+    matched = threading.Event()
+
+    def on_match() -> None:
+        if not matched.is_set():
+            matched.set()
+            _kill_process_tree(proc)
+
+    pumps = [
+        threading.Thread(
+            target=_pump,
+            args=(
+                stream,
+                capture,
+                sink,
+                _LineWatcher(until) if until else None,
+                on_match,
+            ),
+            daemon=True,
+        )
+        for stream, capture in ((proc.stdout, out), (proc.stderr, err))
+    ]
+    for t in pumps:
+        t.start()
+    if input is not None and proc.stdin is not None:
+        try:
+            proc.stdin.write(input)
+        except BrokenPipeError:
+            pass
+        finally:
+            proc.stdin.close()
+    timed_out = False
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        _kill_process_tree(proc)
+    for t in pumps:
+        # Hintergrundprozesse können die Pipes offen halten – nicht ewig warten.
+        t.join(timeout=1)
+    for stream in (proc.stdout, proc.stderr):
+        try:
+            stream.close()
+        except Exception:
+            pass
+    return ProcessResult(
+        returncode=proc.returncode,
+        stdout=out.text(),
+        stderr=err.text(),
+        timed_out=timed_out and not matched.is_set(),
+        duration=time.monotonic() - started,
+        matched=matched.is_set(),
+    )
+
+
+async def _terminate_async(proc: Any) -> None:
+    """Beendet einen asyncio-Subprozess samt Prozessgruppe, notfalls per SIGKILL."""
+
+    import asyncio
+
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            if os.name == "posix":
+                os.killpg(proc.pid, sig)
+            elif sig == signal.SIGTERM:
+                proc.terminate()
+            else:
+                proc.kill()
+        except (ProcessLookupError, PermissionError):
+            pass
+        try:
+            await asyncio.wait_for(proc.wait(), timeout=2)
+            return
+        except asyncio.TimeoutError:
+            continue
+
+
+async def run_process_async(
+    cmd: Union[str, List[str]],
+    *,
+    shell: bool = False,
+    timeout: Optional[float] = None,
+    env: Optional[Dict[str, str]] = None,
+    input: Optional[bytes] = None,
+    cwd: Optional[str] = None,
+    echo: Optional[bool] = None,
+    until: Optional["re.Pattern[str]"] = None,
+) -> ProcessResult:
+    """Asyncio-Gegenstück zu ``run_process`` mit denselben Puffergrenzen.
+
+    Timeout und Abbruch (``CancelledError``) beenden die gesamte Prozessgruppe.
+    """
+
+    import asyncio
+
+    echo = _resolve_echo(echo)
+    sink = sys.stderr if echo else None
+    started = time.monotonic()
+    kwargs = dict(
+        stdin=(
+            asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL
+        ),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env=env,
+        cwd=cwd,
+        start_new_session=(os.name == "posix"),
+    )
+    if shell:
+        proc = await asyncio.create_subprocess_shell(cmd, **kwargs)  # type: ignore[arg-type]
+    else:
+        proc = await asyncio.create_subprocess_exec(*cmd, **kwargs)  # type: ignore[arg-type]
+    out, err = _BoundedCapture(), _BoundedCapture()
+    matched = []
+
+    async def pump(reader: Any, capture: _BoundedCapture) -> None:
+        watcher = _LineWatcher(until) if until else None
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            capture.write(data)
+            if sink is not None:
+                with _ECHO_LOCK:
+                    sink.write(data.decode("utf-8", errors="replace"))
+                    sink.flush()
+            if watcher is not None and watcher.feed(data):
+                watcher = None
+                if not matched:
+                    matched.append(True)
+                    await _terminate_async(proc)
+
+    pumps = [
+        asyncio.ensure_future(pump(proc.stdout, out)),
+        asyncio.ensure_future(pump(proc.stderr, err)),
+    ]
+    timed_out = False
+    try:
+        if input is not None and proc.stdin is not None:
+            proc.stdin.write(input)
+            try:
+                await proc.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            proc.stdin.close()
+        await asyncio.wait_for(proc.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        await _terminate_async(proc)
+    except asyncio.CancelledError:
+        await _terminate_async(proc)
+        for task in pumps:
+            task.cancel()
+        raise
+    _, still_running = await asyncio.wait(pumps, timeout=1)
+    for task in still_running:
+        task.cancel()
+    return ProcessResult(
+        returncode=proc.returncode,
+        stdout=out.text(),
+        stderr=err.text(),
+        timed_out=timed_out and not matched,
+        duration=time.monotonic() - started,
+        matched=bool(matched),
+    )
+
+
+def _run_spec(
+    cmd: str,
+    timeout: int = DEFAULT_TIMEOUT,
+    env: Optional[dict] = None,
+    cwd: Optional[str] = None,
+) -> ProcessSpec:
+    full_env = os.environ.copy()
+    if env:
+        for k, v in env.items():
+            if isinstance(v, str):
+                full_env[k] = v
+    return ProcessSpec(
+        label="run",
+        cmd=cmd,
+        shell=True,
+        timeout=timeout,
+        env=full_env,
+        cwd=cwd,
+        timeout_note=f": {cmd}",
+    )
+
+
+def run(cmd: str, timeout: int = DEFAULT_TIMEOUT, env: Optional[dict] = None) -> str:
+    return execute_process(_run_spec(cmd, timeout=timeout, env=env))
+
+
+class _SentinelStream:
+    """Sammelt Ausgabe eines Streams bis zur Sentinel-Zeile des aktuellen Befehls."""
+
+    def __init__(self) -> None:
+        self.capture = _BoundedCapture()
+        self.marker = b""
+        self.pending = bytearray()
+        self.done = threading.Event()
+        self.trailer = b""
+        self.echo: Optional[Any] = None
+
+    def reset(self, marker: bytes, echo: Optional[Any]) -> None:
+        self.capture = _BoundedCapture()
+        self.marker = b"\n" + marker
+        self.pending = bytearray()
+        self.trailer = b""
+        self.echo = echo
+        self.done.clear()
+
+    def _emit(self, data: bytes) -> None:
+        if not data:
+            return
+        self.capture.write(data)
+        if self.echo is not None:
+            with _ECHO_LOCK:
+                self.echo.write(data.decode("utf-8", errors="replace"))
+                self.echo.flush()
+
+    def feed(self, data: bytes) -> None:
+        if self.done.is_set() or not self.marker:
+            return
+        self.pending += data
+        idx = self.pending.find(self.marker)
+        if idx != -1:
+            self._emit(bytes(self.pending[:idx]))
+            self.trailer = bytes(self.pending[idx + len(self.marker) :])
+            self.pending = bytearray()
+            self.done.set()
+            return
+        # Nur ein Ende zurückhalten, das der Anfang des Markers sein könnte.
+        keep = 0
+        for size in range(min(len(self.marker) - 1, len(self.pending)), 0, -1):
+            if self.pending.endswith(self.marker[:size]):
+                keep = size
+                break
+        cut = len(self.pending) - keep
+        self._emit(bytes(self.pending[:cut]))
+        del self.pending[:cut]
+
+    def flush(self) -> None:
+        self._emit(bytes(self.pending))
+        self.pending = bytearray()
+
+
+class ShellWorker:
+    """Langlebige bash-Instanz für das ``run``-Tool.
+
+    Befehle laufen per ``eval`` in derselben Shell, sodass ``cd``, exportierte
+    Variablen und aktivierte venvs erhalten bleiben. Befehlsgrenzen und Exit-Codes
+    werden über Sentinel-Zeilen auf stdout/stderr erkannt; bei Timeout wird die
+    Shell samt Kindern beendet und beim nächsten Befehl neu gestartet.
+    """
+
+    def __init__(
+        self, cwd: Optional[str] = None, env: Optional[Dict[str, str]] = None
+    ) -> None:
+        self.cwd = cwd
+        self.env = env
+        self.proc: Optional[subprocess.Popen] = None
+        self._lock = threading.Lock()
+        self._out = _SentinelStream()
+        self._err = _SentinelStream()
+
+    @property
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def _start(self) -> None:
+        # Frische Stream-Objekte, damit Reader eines beendeten Prozesses nichts mehr einspeisen.
+        self._out = _SentinelStream()
+        self._err = _SentinelStream()
+        shell = shutil.which("bash")
+        argv = [shell, "--noprofile", "--norc"] if shell else ["/bin/sh"]
+        self.proc = subprocess.Popen(
+            argv,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=self.cwd,
+            env=self.env,
+            start_new_session=(os.name == "posix"),
+        )
+        for stream, target in (
+            (self.proc.stdout, self._out),
+            (self.proc.stderr, self._err),
+        ):
+            threading.Thread(
+                target=self._reader, args=(stream, target), daemon=True
+            ).start()
+
+    @staticmethod
+    def _reader(stream: Any, target: _SentinelStream) -> None:
+        fd = stream.fileno()
+        while True:
+            try:
+                data = os.read(fd, 65536)
+            except OSError:
+                break
+            if not data:
+                break
+            target.feed(data)
+        target.done.set()
+
+    def run(
+        self,
+        cmd: str,
+        timeout: Optional[float] = DEFAULT_TIMEOUT,
+        env: Optional[Dict[str, str]] = None,
+        echo: Optional[bool] = None,
+    ) -> ProcessResult:
+        with self._lock:
+            restarted = False
+            if not self.alive:
+                restarted = self.proc is not None
+                self._start()
+            echo = _resolve_echo(echo)
+            sink = sys.stderr if echo else None
+            token = f"__GPTCODE_{uuid.uuid4().hex}__"
+            self._out.reset(token.encode(), sink)
+            self._err.reset(token.encode(), sink)
+            exports = "".join(
+                f"export {k}={shlex.quote(v)}\n" for k, v in (env or {}).items()
+            )
+            script = (
+                f"{exports}eval \"$(cat <<'{token}'\n{cmd}\n{token}\n)\" </dev/null\n"
+                f"__gptcode_rc=$?; printf '\\n%s %d\\n' '{token}' \"$__gptcode_rc\"; "
+                f"printf '\\n%s\\n' '{token}' >&2\n"
+            )
+            started = time.monotonic()
+            assert self.proc is not None and self.proc.stdin is not None
+            try:
+                self.proc.stdin.write(script.encode())
+                self.proc.stdin.flush()
+            except BrokenPipeError:
+                pass
+            deadline = None if timeout is None else started + timeout
+            timed_out = False
+            for stream in (self._out, self._err):
+                remaining = (
+                    None if deadline is None else max(0.0, deadline - time.monotonic())
+                )
+                if not stream.done.wait(remaining):
+                    timed_out = True
+                    break
+            if timed_out:
+                self.close()
+                self._out.flush()
+                self._err.flush()
+            rc: Optional[int] = None
+            trailer = self._out.trailer.split(b"\n", 1)[0].strip()
+            if trailer.lstrip(b"-").isdigit():
+                rc = int(trailer)
+            elif not timed_out and not self.alive:
+                rc = self.proc.wait()
+            stdout = self._out.capture.text()
+            if restarted:
+                stdout = (
+                    "[shell] Persistente Shell wurde neu gestartet (vorheriger Zustand verloren).\n"
+                    + stdout
+                )
+            return ProcessResult(
+                returncode=rc,
+                stdout=stdout,
+                stderr=self._err.capture.text(),
+                timed_out=timed_out,
+                duration=time.monotonic() - started,
+            )
+
+    def close(self) -> None:
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            _kill_process_tree(self.proc)
+        for stream in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            try:
+                if stream is not None:
+                    stream.close()
+            except Exception:
+                pass
+
+
+def run_in_shell(
+    worker: ShellWorker,
+    cmd: str,
+    timeout: int = DEFAULT_TIMEOUT,
+    env: Optional[dict] = None,
+) -> str:
+    try:
+        clean_env = {k: v for k, v in (env or {}).items() if isinstance(v, str)}
+        proc = worker.run(cmd, timeout=timeout, env=clean_env)
+        if proc.timed_out:
+            return (
+                f"[run] Timeout nach {timeout}s: {cmd} (persistente Shell beendet)\n"
+                f"STDOUT:\n{proc.stdout}\nSTDERR:\n{proc.stderr}"
+            )
+        return proc.format("run")
+    except Exception as e:
+        return f"[run] Fehler: {e}"
+
+
+TAIL_BLOCK_SIZE = 64 * 1024
+TAIL_FOLLOW_MAX_BYTES = 1024 * 1024
+
+
+def _read_last_lines(f, end: int, lines: int) -> bytes:
+    """Liest rückwärts blockweise ab ``end``, bis ``lines`` vollständige Zeilen vorliegen."""
+
+    if lines <= 0 or end <= 0:
+        return b""
+    blocks: List[bytes] = []
+    newlines = 0
+    pos = end
+    while pos > 0 and newlines <= lines:
+        size = min(TAIL_BLOCK_SIZE, pos)
+        pos -= size
+        f.seek(pos)
+        block = f.read(size)
+        blocks.append(block)
+        newlines += block.count(b"\n")
+    data = b"".join(reversed(blocks))
+    parts = data.split(b"\n")
+    trailing = parts[-1] == b""
+    if trailing:
+        parts.pop()
+    return b"\n".join(parts[-lines:]) + (b"\n" if trailing else b"")
+
+
+def tail_file(
+    path: str,
+    lines: int = 200,
+    follow: bool = False,
+    cursors: Optional[Dict[str, Tuple[int, int]]] = None,
+) -> str:
+    """Letzte ``lines`` Zeilen ohne die ganze Datei zu laden.
+
+    Mit ``follow`` und einem Cursor-Dict (``{pfad: (offset, inode)}``) liefert der
+    Aufruf nur die seit dem letzten Aufruf angehängten Bytes.
+    """
+
+    p = Path(path).expanduser().resolve()
+    if not p.exists() or not p.is_file():
+        return f"[tail_file] Datei nicht gefunden: {p}"
+    key = str(p)
+    try:
+        with p.open("rb") as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            cursor = cursors.get(key) if cursors is not None else None
+            note = ""
+            if follow and cursor is not None:
+                offset, inode = cursor
+                if inode == st.st_ino and size >= offset:
+                    if size == offset:
+                        return (
+                            f"[tail_file] Keine neuen Daten seit letztem Aufruf ({p})"
+                        )
+                    start = max(offset, size - TAIL_FOLLOW_MAX_BYTES)
+                    f.seek(start)
+                    data = f.read(size - start)
+                    cursors[key] = (size, st.st_ino)
+                    if start > offset:
+                        note = f"[tail_file] {start - offset}B neuer Daten übersprungen (Limit {TAIL_FOLLOW_MAX_BYTES}B)\n"
+                    return note + data.decode("utf-8", errors="ignore")
+                note = f"[tail_file] Datei wurde rotiert oder gekürzt, lese neu: {p}\n"
+            data = _read_last_lines(f, size, lines)
+            if cursors is not None:
+                cursors[key] = (size, st.st_ino)
+        return note + data.decode("utf-8", errors="ignore")
+    except Exception as e:
+        return f"[tail_file] Fehler: {e}"
+
+
+SYSTEMCTL_PROPERTIES = (
+    "Id",
+    "LoadState",
+    "ActiveState",
+    "SubState",
+    "MainPID",
+    "ExecMainStatus",
+    "Result",
+    "UnitFileState",
+)
+SYSTEMCTL_STATUS_LINES = 15
+_SYSTEMCTL_COLUMNS = (
+    ("UNIT", "Id"),
+    ("LOAD", "LoadState"),
+    ("ACTIVE", "ActiveState"),
+    ("SUB", "SubState"),
+    ("PID", "MainPID"),
+    ("EXIT", "ExecMainStatus"),
+    ("RESULT", "Result"),
+    ("ENABLED", "UnitFileState"),
+)
+
+
+def _parse_systemctl_show(text: str) -> List[Dict[str, str]]:
+    units, current = [], {}
+    for line in text.splitlines():
+        if not line.strip():
+            if current:
+                units.append(current)
+                current = {}
+            continue
+        key, sep, value = line.partition("=")
+        if sep:
+            current[key] = value
+    if current:
+        units.append(current)
+    return units
+
+
+def _unit_failed(unit: Dict[str, str]) -> bool:
+    return (
+        unit.get("ActiveState") == "failed"
+        or unit.get("LoadState") not in (None, "loaded")
+        or unit.get("Result", "success") not in ("success", "")
+    )
+
+
+def _render_systemctl_table(
+    result: ProcessResult, timeout: Optional[float] = DEFAULT_TIMEOUT
+) -> str:
+    """Kompakte Tabelle aller Units; nur für fehlerhafte Units folgt ``systemctl status``."""
+
+    if result.timed_out or (
+        result.returncode not in (0, None) and not result.stdout.strip()
+    ):
+        return result.format("systemctl")
+    units = _parse_systemctl_show(result.stdout)
+    if not units:
+        return "[systemctl] Keine passenden Units gefunden."
+    rows = [[unit.get(key) or "-" for _, key in _SYSTEMCTL_COLUMNS] for unit in units]
+    widths = [
+        max(len(title), *(len(row[i]) for row in rows))
+        for i, (title, _) in enumerate(_SYSTEMCTL_COLUMNS)
+    ]
+    table = [
+        "  ".join(
+            title.ljust(w) for (title, _), w in zip(_SYSTEMCTL_COLUMNS, widths)
+        ).rstrip()
+    ]
+    table += [
+        "  ".join(cell.ljust(w) for cell, w in zip(row, widths)).rstrip()
+        for row in rows
+    ]
+    failed = [unit for unit in units if _unit_failed(unit)]
+    out = [f"[systemctl] {len(units)} Unit(s), {len(failed)} fehlerhaft"] + table
+    # Nicht geladene Units (z. B. Tippfehler) haben keinen Status – die Tabelle reicht.
+    details = [
+        unit["Id"]
+        for unit in failed
+        if unit.get("Id") and unit.get("LoadState") == "loaded"
+    ]
+    if details:
+        status = run_process(
+            [
+                "systemctl",
+                "status",
+                "--no-pager",
+                "--lines",
+                str(SYSTEMCTL_STATUS_LINES),
+                "--",
+            ]
+            + details,
+            timeout=timeout,
+            echo=False,
+        )
+        out += [
+            "",
+            "Status der fehlerhaften Units:",
+            status.stdout.rstrip() or status.stderr.rstrip(),
+        ]
+    return "\n".join(out)
+
+
+def _systemctl_units(
+    unit: Optional[str], units: Optional[List[str]] = None
+) -> List[str]:
+    names = list(units or [])
+    if unit:
+        names += unit.split()
+    return [n for n in dict.fromkeys(str(n).strip() for n in names) if n]
+
+
+def _systemctl_spec(
+    action: str, unit: Optional[str], units: Optional[List[str]] = None
+) -> Union[str, ProcessSpec]:
+    if action not in {"status", "restart", "stop", "start", "daemon-reload"}:
+        return f"[systemctl] Ungültige Action: {action}"
+    names = _systemctl_units(unit, units)
+    if any(n.startswith("-") for n in names):
+        return "[systemctl] Unit-Namen dürfen nicht mit '-' beginnen."
+    if action == "daemon-reload":
+        return ProcessSpec(
+            label="systemctl", cmd=["systemctl", action], timeout=DEFAULT_TIMEOUT
+        )
+    if action == "status":
+        if not names:
+            return "[systemctl] status braucht mindestens eine Unit oder ein Muster (z. B. 'nginx*')."
+        cmd = [
+            "systemctl",
+            "show",
+            "--no-pager",
+            "-p",
+            ",".join(SYSTEMCTL_PROPERTIES),
+            "--",
+        ] + names
+        return ProcessSpec(
+            label="systemctl",
+            cmd=cmd,
+            timeout=DEFAULT_TIMEOUT,
+            postprocess=_render_systemctl_table,
+        )
+    return ProcessSpec(
+        label="systemctl",
+        cmd=["systemctl", action, "--"] + names,
+        timeout=DEFAULT_TIMEOUT,
+    )
+
+
+def systemctl(
+    action: str, unit: Optional[str], units: Optional[List[str]] = None
+) -> str:
+    return execute_process(_systemctl_spec(action, unit, units))
+
+
+def _detect_docker_compose() -> List[str]:
+    legacy_override = os.getenv(DOCKER_LEGACY_ENV)
+    if legacy_override:
+        candidate = legacy_override.strip()
+        if candidate and (shutil.which(candidate) or Path(candidate).exists()):
+            return [candidate]
+
+    try:
+        proc = subprocess.run(
+            ["docker", "compose", "version"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        if proc.returncode == 0:
+            return ["docker", "compose"]
+    except FileNotFoundError:
+        pass
+
+    legacy = shutil.which("docker-compose")
+    if legacy:
+        return [legacy]
+    return ["docker", "compose"]
+
+
+def resolve_docker_compose_base() -> List[str]:
+    """Bestimmt die Compose-Basisbefehle und cached das Ergebnis (auch in ``PROBE_FILE``)."""
+
+    global _DOCKER_COMPOSE_CMD
+    if _DOCKER_COMPOSE_CMD is None:
+        _DOCKER_COMPOSE_CMD = _detect_docker_compose()
+        if _PROBE is not None and _PROBE_FILE is not None:
+            # Spart beim nächsten Start den Fork von `docker compose version`.
+            _PROBE["compose"] = _DOCKER_COMPOSE_CMD
+            _save_probe()
+    return _DOCKER_COMPOSE_CMD
+
+
+DOCKER_LOGS_TAIL = 200
+DOCKER_FOLLOW_MAX_SECONDS = 600
+_LOG_TIMESTAMP = re.compile(
+    r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d+)?(?:Z|[+-]\d\d:\d\d)) ?(.*)$"
+)
+
+
+def _timestamp_key(ts: str) -> Tuple[str, str]:
+    """Vergleichbarer Schlüssel für RFC3339-Zeitstempel mit unterschiedlich vielen Nachkommastellen."""
+
+    base, _, rest = ts.partition(".")
+    frac = "".join(ch for ch in rest if ch.isdigit())
+    return base[:19], frac.ljust(9, "0")
+
+
+def _render_docker_logs(
+    result: ProcessResult,
+    service: Optional[str],
+    cursors: Dict[str, Tuple[str, int]],
+    key: str,
+    cursor: Optional[Tuple[str, int]],
+    follow: bool,
+    timeout: Optional[float],
+    until: Optional[str],
+) -> str:
+    """Filtert bereits gesehene Zeilen heraus, entfernt Zeitstempel und rückt den Cursor vor.
+
+    Der Cursor ist (Zeitstempel, Zahl der bereits gelieferten Zeilen mit genau diesem
+    Zeitstempel): ``--since`` liefert diese Zeilen erneut, übersprungen werden nur so
+    viele, wie schon gezeigt wurden.
+    """
+
+    since, seen = cursor if cursor is not None else (None, 0)
+    since_key = _timestamp_key(since) if since is not None else None
+    lines, newest, newest_count, at_since = [], since, seen, 0
+    for raw in result.stdout.splitlines():
+        match = _LOG_TIMESTAMP.match(raw)
+        if match is None:
+            lines.append(raw)  # z. B. Kürzungshinweis des Capture-Puffers
+            continue
+        ts, text = match.groups()
+        ts_key = _timestamp_key(ts)
+        if since_key is not None and ts_key <= since_key:
+            if ts_key < since_key:
+                continue
+            at_since += 1
+            if at_since <= seen:
+                continue
+        lines.append(text)
+        if newest is None or ts_key > _timestamp_key(newest):
+            newest, newest_count = ts, 1
+        elif ts_key == _timestamp_key(newest):
+            newest_count += 1
+    if (
+        newest is not None
+        and result.returncode is not None
+        and (result.returncode == 0 or follow)
+    ):
+        cursors[key] = (newest, newest_count)
+    label = f"[docker] logs {service or '(alle)'}"
+    if follow:
+        if result.matched:
+            label += f": Muster {until!r} gefunden nach {result.duration:.1f}s"
+        elif until:
+            label += f": Muster {until!r} nach {timeout:g}s nicht gefunden"
+        else:
+            label += f": {timeout:g}s verfolgt"
+    elif result.returncode not in (0, None):
+        return result.format("docker")
+    head = f"{label}, {len(lines)} neue Zeile(n)" + (f" seit {since}" if since else "")
+    body = "\n".join(lines)
+    if result.stderr.strip() and not lines:
+        body = f"STDERR:\n{result.stderr}"
+    return head + ("\n" + body if body else "")
+
+
+def _docker_logs_spec(
+    base: List[str],
+    service: Optional[str],
+    cwd: Optional[str],
+    cursors: Dict[str, Tuple[str, int]],
+    follow_seconds: Optional[float] = None,
+    until: Optional[str] = None,
+) -> Union[str, ProcessSpec]:
+    key = f"{cwd or os.getcwd()}::{service or ''}"
+    cursor = cursors.get(key)
+    since = cursor[0] if cursor is not None else None
+    follow = bool(follow_seconds or until)
+    try:
+        pattern = re.compile(until) if until else None
+    except re.error as e:
+        return f"[docker] Ungültiges until-Muster: {e}"
+    cmd = base + ["logs", "--no-log-prefix", "--timestamps"]
+    cmd += ["--since", since] if since else ["--tail", str(DOCKER_LOGS_TAIL)]
+    timeout: Optional[float] = None
+    if follow:
+        timeout = min(float(follow_seconds or 30), DOCKER_FOLLOW_MAX_SECONDS)
+        cmd.append("--follow")
+    cmd += [service] if service else []
+    return ProcessSpec(
+        label="docker",
+        cmd=cmd,
+        cwd=cwd,
+        timeout=timeout,
+        until=pattern,
+        postprocess=lambda result: _render_docker_logs(
+            result, service, cursors, key, cursor, follow, timeout, until
+        ),
+    )
+
+
+def _docker_compose_spec(
+    action: str,
+    service: Optional[str] = None,
+    cwd: Optional[str] = None,
+    cursors: Optional[Dict[str, Tuple[str, int]]] = None,
+    follow_seconds: Optional[float] = None,
+    until: Optional[str] = None,
+) -> Union[str, ProcessSpec]:
+    if action not in {"up", "down", "build", "logs"}:
+        return f"[docker] Ungültige Action: {action}"
+    if not docker_features_available():
+        return (
+            "[docker] Docker-Unterstützung ist deaktiviert, weil kein ausführbares `docker`/`docker-compose` gefunden wurde. "
+            "Installiere Docker Engine inkl. Compose Plugin oder ein Legacy-`docker-compose`-Binary."
+        )
+    base = resolve_docker_compose_base()
+    if action == "up":
+        cmd = base + ["up", "-d"] + ([service] if service else [])
+    elif action == "down":
+        cmd = base + ["down"]
+    elif action == "build":
+        cmd = base + ["build"] + ([service] if service else [])
+    else:
+        # Ohne Session-Cursor (Direktaufruf) startet jeder Abruf bei den letzten DOCKER_LOGS_TAIL Zeilen.
+        return _docker_logs_spec(
+            base,
+            service,
+            cwd,
+            cursors if cursors is not None else {},
+            follow_seconds=follow_seconds,
+            until=until,
+        )
+    return ProcessSpec(label="docker", cmd=cmd, cwd=cwd)
+
+
+def docker_compose(action: str, service: Optional[str] = None) -> str:
+    return execute_process(_docker_compose_spec(action, service))
+
+
+PYTEST_MAX_SHARDS = int(os.getenv("GPTCODE_PYTEST_SHARDS", "0")) or min(
+    8, os.cpu_count() or 1
+)
+PYTEST_FAILURE_LINES = 6
+_IMPORT_CACHE: Dict[str, Tuple[int, int, Tuple[Tuple[str, ...], Tuple[str, ...]]]] = {}
+
+
+def _is_test_file(rel: str) -> bool:
+    name = rel.rsplit("/", 1)[-1]
+    return name.endswith(".py") and (
+        name.startswith("test_") or name.endswith("_test.py")
+    )
+
+
+def _python_refs(root: str, rel: str) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """Importierte Modulnamen und referenzierte ``*.py``-Dateinamen einer Datei (gecacht per mtime/Größe)."""
+
+    path = os.path.join(root, rel)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (), ()
+    hit = _IMPORT_CACHE.get(path)
+    if hit is not None and hit[:2] == (st.st_mtime_ns, st.st_size):
+        return hit[2]
+    modules: List[str] = []
+    files: List[str] = []
+    try:
+        tree = ast.parse(Path(path).read_bytes(), filename=path)
+    except (OSError, SyntaxError, ValueError):
+        tree = None
+    package = rel[:-3].split("/")[:-1]
+    for node in ast.walk(tree) if tree is not None else ():
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module or ""
+            if node.level:
+                parent = (
+                    package[: len(package) - (node.level - 1)]
+                    if node.level > 1
+                    else package
+                )
+                base = ".".join(parent + ([base] if base else []))
+            if base:
+                modules.append(base)
+            modules.extend(
+                f"{base}.{alias.name}" if base else alias.name for alias in node.names
+            )
+        elif (
+            isinstance(node, ast.Constant)
+            and isinstance(node.value, str)
+            and node.value.endswith(".py")
+        ):
+            # z. B. Tests, die ein Skript per importlib aus einer Datei laden
+            files.append(node.value.rsplit("/", 1)[-1])
+    refs = (tuple(modules), tuple(files))
+    _IMPORT_CACHE[path] = (st.st_mtime_ns, st.st_size, refs)
+    return refs
+
+
+def affected_tests(index: ProjectIndex, touched: List[str]) -> List[str]:
+    """Testdateien, die (transitiv) eine der geänderten Dateien importieren.
+
+    Modulnamen werden über alle Pfad-Suffixe aufgelöst (``src/pkg/core.py`` ist
+    ``src.pkg.core``, ``pkg.core`` und ``core``), damit src-Layouts ohne
+    Konfiguration funktionieren; Mehrdeutigkeiten führen eher zu mehr Tests.
+    """
+
+    py_files = [rel for rel in index.files() if rel.endswith(".py")]
+    by_module: Dict[str, List[str]] = {}
+    by_name: Dict[str, List[str]] = {}
+    for rel in py_files:
+        parts = rel[:-3].split("/")
+        if parts[-1] == "__init__":
+            parts = parts[:-1]
+        for i in range(len(parts)):
+            by_module.setdefault(".".join(parts[i:]), []).append(rel)
+        by_name.setdefault(rel.rsplit("/", 1)[-1], []).append(rel)
+    importers: Dict[str, Set[str]] = {}
+    for rel in py_files:
+        modules, files = _python_refs(index.root, rel)
+        targets = {t for m in modules for t in by_module.get(m, ())}
+        targets.update(t for f in files for t in by_name.get(f, ()))
+        for target in targets - {rel}:
+            importers.setdefault(target, set()).add(rel)
+
+    changed = set()
+    for path in touched:
+        rel = os.path.relpath(os.path.realpath(path), index.root).replace(os.sep, "/")
+        if rel.startswith("../"):
+            continue
+        if rel.rsplit("/", 1)[-1] == "conftest.py":
+            scope = rel.rsplit("/", 1)[0] + "/" if "/" in rel else ""
+            changed.update(
+                t for t in py_files if t.startswith(scope) and _is_test_file(t)
+            )
+        changed.add(rel)
+    seen, queue = set(changed), deque(changed)
+    while queue:
+        for importer in importers.get(queue.popleft(), ()):
+            if importer not in seen:
+                seen.add(importer)
+                queue.append(importer)
+    return sorted(
+        rel
+        for rel in seen
+        if _is_test_file(rel) and rel in by_name.get(rel.rsplit("/", 1)[-1], ())
+    )
+
+
+def _shard_files(root: str, files: List[str], shards: int) -> List[List[str]]:
+    """Verteilt Testdateien nach Größe gierig auf ``shards`` Gruppen."""
+
+    buckets: List[Tuple[int, List[str]]] = [
+        (0, []) for _ in range(max(1, min(shards, len(files))))
+    ]
+    sizes = []
+    for rel in files:
+        try:
+            sizes.append((os.path.getsize(os.path.join(root, rel)), rel))
+        except OSError:
+            sizes.append((0, rel))
+    for size, rel in sorted(sizes, reverse=True):
+        load, members = min(buckets, key=lambda b: b[0])
+        buckets.remove((load, members))
+        members.append(rel)
+        buckets.append((load + size + 1, members))
+    return [sorted(members) for _, members in buckets if members]
+
+
+def _junit_summary(xml_path: str, cwd: str) -> Optional[Dict[str, Any]]:
+    """Zählt Ergebnisse und sammelt Fehlschläge aus einer JUnit-XML-Datei von pytest."""
+
+    from xml.etree import ElementTree  # nur für pytest-Reports gebraucht
+
+    try:
+        tree = ElementTree.parse(xml_path)
+    except (OSError, ElementTree.ParseError):
+        return None
+    summary: Dict[str, Any] = {
+        "tests": 0,
+        "failures": 0,
+        "errors": 0,
+        "skipped": 0,
+        "time": 0.0,
+        "failed": [],
+    }
+    for case in tree.iter("testcase"):
+        summary["tests"] += 1
+        summary["time"] += float(case.get("time") or 0)
+        for tag, kind in (
+            ("failure", "FEHLGESCHLAGEN"),
+            ("error", "FEHLER"),
+            ("skipped", None),
+        ):
+            node = case.find(tag)
+            if node is None:
+                continue
+            if kind is None:
+                summary["skipped"] += 1
+                break
+            summary["failures" if tag == "failure" else "errors"] += 1
+            text = (node.get("message") or "").strip() or (node.text or "").strip()
+            lines = [line for line in text.splitlines() if line.strip()][
+                :PYTEST_FAILURE_LINES
+            ]
+            summary["failed"].append((kind, _junit_nodeid(case, cwd), lines))
+            break
+    return summary
+
+
+def _junit_nodeid(case: Any, cwd: str) -> str:
+    parts = (case.get("classname") or "").split(".")
+    for i in range(len(parts), 0, -1):
+        candidate = "/".join(parts[:i]) + ".py"
+        if os.path.isfile(os.path.join(cwd, candidate)):
+            return "::".join([candidate] + parts[i:] + [case.get("name") or "?"])
+    return f"{case.get('classname')}::{case.get('name')}"
+
+
+def _pytest_spec(
+    path: str = ".",
+    k: Optional[str] = None,
+    timeout: int = DEFAULT_TIMEOUT,
+    cwd: Optional[str] = None,
+    files: Optional[List[str]] = None,
+    junit: Optional[str] = None,
+) -> ProcessSpec:
+    cmd = ["pytest", "-q"]
+    if junit:
+        cmd += [
+            "-p",
+            "no:cacheprovider",
+            f"--junitxml={junit}",
+            "-o",
+            "junit_family=xunit1",
+        ]
+    cmd += files if files else [path]
+    if k:
+        cmd += ["-k", k]
+    return ProcessSpec(
+        label="pytest",
+        cmd=cmd,
+        timeout=timeout,
+        cwd=cwd,
+        echo=False if junit else None,
+        missing_note="[pytest] nicht gefunden. `pip install pytest` im Projekt/venv.",
+    )
+
+
+def _combine_pytest(
+    outcomes: List[Tuple[ProcessSpec, Union[ProcessResult, Exception]]],
+    junits: List[str],
+    cwd: str,
+    note: str,
+) -> str:
+    """Fasst Shard-Ergebnisse zusammen: Zählwerte plus nur die Fehlschläge."""
+
+    total = {"tests": 0, "failures": 0, "errors": 0, "skipped": 0}
+    failed, raw, wall = [], [], 0.0
+    for (spec, outcome), junit in zip(outcomes, junits):
+        summary = _junit_summary(junit, cwd)
+        if isinstance(outcome, Exception):
+            raw.append(spec.render_error(outcome))
+            continue
+        wall = max(wall, outcome.duration)
+        if summary is None or outcome.timed_out or outcome.returncode not in (0, 1):
+            if outcome.returncode == 5 and summary is not None:
+                continue  # keine Tests im Shard gesammelt
+            raw.append(spec.render(outcome))
+        if summary is not None:
+            for key in total:
+                total[key] += summary[key]
+            failed.extend(summary["failed"])
+    passed = total["tests"] - total["failures"] - total["errors"] - total["skipped"]
+    head = (
+        f"[pytest] {len(outcomes)} Shard(s), {total['tests']} Tests in {wall:.1f}s: {passed} bestanden, "
+        f"{total['failures']} fehlgeschlagen, {total['errors']} Fehler, {total['skipped']} übersprungen{note}"
+    )
+    rows = [head]
+    for kind, nodeid, lines in failed:
+        rows.append(f"{kind} {nodeid}")
+        rows.extend(f"  {line}" for line in lines)
+    rows.extend(raw)
+    return "\n".join(rows)
+
+
+def plan_pytest(
+    path: str = ".",
+    k: Optional[str] = None,
+    timeout: int = DEFAULT_TIMEOUT,
+    cwd: Optional[str] = None,
+    shards: Optional[int] = None,
+    affected: Optional[List[str]] = None,
+) -> Union[str, ProcessSpec, ProcessGroup]:
+    """Plant einen pytest-Lauf; nur mit ``affected`` oder ``shards`` verteilt auf Shards.
+
+    Ohne beides bleibt es bei einem einfachen ``pytest <path>``, sodass die pytest-Konfiguration
+    (``testpaths``, ``python_files``, Doctests, …) unverändert greift. Jeder Shard ist ein
+    eigener pytest-Prozess mit JUnit-Report; das Ergebnis ist eine Zusammenfassung mit
+    Fehlschlägen statt der Rohausgabe.
+    """
+
+    cwd = cwd or os.getcwd()
+    if affected is None and not shards:
+        return _pytest_spec(path, k, timeout=timeout, cwd=cwd)
+    target = os.path.realpath(os.path.join(cwd, path))
+    index = project_index(cwd)
+    note = ""
+    if affected is not None:
+        files = affected_tests(index, affected)
+        scope = os.path.relpath(target, index.root).replace(os.sep, "/")
+        if scope != ".":
+            files = [f for f in files if _in_scope(f, scope)]
+        if not files:
+            return "[pytest] Keine betroffenen Tests für die in dieser Sitzung geänderten Dateien."
+        note = f" (betroffen: {len(files)} Testdatei(en))"
+    elif os.path.isdir(target):
+        scope = os.path.relpath(target, index.root).replace(os.sep, "/")
+        files = [
+            f
+            for f in index.files()
+            if _is_test_file(f) and _in_scope(f, "" if scope == "." else scope)
+        ]
+    else:
+        files = []
+    count = shards if shards else PYTEST_MAX_SHARDS
+    groups = _shard_files(index.root, files, count) if files else [[]]
+
+    def junits(tmpdir: str) -> List[str]:
+        return [os.path.join(tmpdir, f"shard-{i}.xml") for i in range(len(groups))]
+
+    def build(tmpdir: str) -> List[ProcessSpec]:
+        return [
+            _pytest_spec(
+                path,
+                k,
+                timeout=timeout,
+                cwd=index.root if group else cwd,
+                files=group or None,
+                junit=junit,
+            )
+            for group, junit in zip(groups, junits(tmpdir))
+        ]
+
+    def combine(
+        tmpdir: str, outcomes: List[Tuple[ProcessSpec, Union[ProcessResult, Exception]]]
+    ) -> str:
+        return _combine_pytest(
+            outcomes, junits(tmpdir), index.root if files else cwd, note
+        )
+
+    return ProcessGroup(label="pytest", build=build, combine=combine)
+
+
+def pytest_run(
+    path: str = ".", k: Optional[str] = None, timeout: int = DEFAULT_TIMEOUT
+) -> str:
+    return execute_process(plan_pytest(path, k, timeout=timeout))
+
+
+def maybe_parse_json(s: str):
+    s = s.strip()
+    if not (s.startswith("{") and s.endswith("}")):
+        return None
+    try:
+        return json.loads(s)
+    except json.JSONDecodeError:
+        return None
+
+
+def parse_text_tool_calls(text: str) -> List[ToolCall]:
+    """Liest Tool-Calls im JSON-im-Text-Protokoll (``{"tool":..,"args":..}``)."""
+
+    parsed = maybe_parse_json(text or "")
+    if not parsed or "tool" not in parsed:
+        return []
+    args = parsed.get("args", {})
+    return [
+        ToolCall(
+            name=str(parsed.get("tool", "")),
+            args=args if isinstance(args, dict) else {},
+        )
+    ]
+
+
+@dataclass
+class ToolSpec:
+    name: str
+    description: str
+    parameters: Dict[str, Any]
+    handler: Callable[[Any, Dict[str, Any]], str]
+    read_only: Union[bool, Callable[[Dict[str, Any]], bool]] = False
+    lock_keys: Optional[Callable[[Any, Dict[str, Any]], List[str]]] = None
+    max_concurrency: int = 0  # 0 = unbegrenzt
+    process: Optional[
+        Callable[[Any, Dict[str, Any]], Optional[Union[str, "ProcessSpec"]]]
+    ] = None
+    speculative: Union[None, bool, Callable[[Dict[str, Any]], bool]] = (
+        None  # None = wie read_only
+    )
+
+    def is_read_only(self, args: Dict[str, Any]) -> bool:
+        return (
+            bool(self.read_only(args)) if callable(self.read_only) else self.read_only
+        )
+
+    def is_speculative(self, args: Dict[str, Any]) -> bool:
+        """Darf vor der Bestätigung laufen: nur lesend und ohne Sitzungszustand (Cursor) zu verändern."""
+
+        if self.speculative is None:
+            return self.is_read_only(args)
+        return (
+            bool(self.speculative(args))
+            if callable(self.speculative)
+            else self.speculative
+        )
+
+    def keys(self, sess: Any, args: Dict[str, Any]) -> List[str]:
+        if self.lock_keys is None:
+            return []
+        try:
+            return list(self.lock_keys(sess, args))
+        except Exception:
+            return []
+
+
+TOOLS: Dict[str, ToolSpec] = {}
+_TOOL_SCHEMAS: Optional[List[Dict[str, Any]]] = None
+_TOOL_SEMAPHORES: Dict[str, threading.BoundedSemaphore] = {}
+_PATH_LOCKS: Dict[str, threading.Lock] = {}
+_LOCK_REGISTRY_GUARD = threading.Lock()
+
+
+def register_tool(
+    name: str,
+    description: str,
+    properties: Dict[str, Any],
+    required: Tuple[str, ...] = (),
+    read_only: Union[bool, Callable[[Dict[str, Any]], bool]] = False,
+    lock_keys: Optional[Callable[[Any, Dict[str, Any]], List[str]]] = None,
+    max_concurrency: int = 0,
+    process: Optional[
+        Callable[
+            [Any, Dict[str, Any]], Optional[Union[str, "ProcessSpec", "ProcessGroup"]]
+        ]
+    ] = None,
+    speculative: Union[None, bool, Callable[[Dict[str, Any]], bool]] = None,
+) -> Callable:
+    """Registriert einen Tool-Handler ``(sess, args) -> str`` samt JSON-Schema.
+
+    ``read_only`` und ``lock_keys`` steuern die parallele Ausführung: Aufrufe mit
+    gemeinsamen Schlüsseln laufen nacheinander, sobald einer davon schreibt.
+    ``max_concurrency`` begrenzt gleichzeitige Läufe desselben Tools.
+    ``process`` plant optional einen Subprozess (``ProcessSpec``), den die
+    async-Engine ohne Thread ausführen kann. ``speculative`` legt fest, ob ein
+    Aufruf schon vor ``:yes`` vorab laufen darf (Standard: wie ``read_only``).
+    """
+
+    def decorator(handler: Callable[[Any, Dict[str, Any]], str]):
+        global _TOOL_SCHEMAS
+        TOOLS[name] = ToolSpec(
+            name=name,
+            description=description,
+            parameters={
+                "type": "object",
+                "properties": properties,
+                "required": list(required),
+            },
+            handler=handler,
+            read_only=read_only,
+            lock_keys=lock_keys,
+            max_concurrency=max_concurrency,
+            process=process,
+            speculative=speculative,
+        )
+        _TOOL_SCHEMAS = None
+        return handler
+
+    return decorator
+
+
+def tool_schemas() -> List[Dict[str, Any]]:
+    """Tool-Definitionen im Function-Calling-Format der Chat-Completions-API."""
+
+    global _TOOL_SCHEMAS
+    if _TOOL_SCHEMAS is None:
+        _TOOL_SCHEMAS = [
+            {
+                "type": "function",
+                "function": {
+                    "name": spec.name,
+                    "description": spec.description,
+                    "parameters": spec.parameters,
+                },
+            }
+            for spec in TOOLS.values()
+        ]
+    return _TOOL_SCHEMAS
+
+
+def text_protocol_hint() -> str:
+    """Kurzbeschreibung der Tools für das JSON-im-Text-Protokoll, z. B. ``run:{cmd,timeout?}``."""
+
+    parts = []
+    for spec in TOOLS.values():
+        required = set(spec.parameters.get("required", []))
+        names = [
+            k if k in required else f"{k}?"
+            for k in spec.parameters.get("properties", {})
+        ]
+        parts.append(f"{spec.name}:{{{','.join(names)}}}")
+    return ", ".join(parts)
+
+
+_STR = {"type": "string"}
+_INT = {"type": "integer"}
+
+
+def _path_key(sess, args: Dict[str, Any]) -> List[str]:
+    path = args.get("path")
+    return [sess.resolve(path)] if path else []
+
+
+def _patch_paths(patch_text: str) -> List[str]:
+    """Alle Dateipfade aus den ``---``/``+++``-Kopfzeilen eines Unified-Diffs (auch ohne ``a/``/``b/``)."""
+
+    paths = []
+    for line in (patch_text or "").splitlines():
+        if line.startswith(("--- ", "+++ ")):
+            name = _patch_name(line)
+            for candidate in (
+                name,
+                name[2:] if name and name.startswith(("a/", "b/")) else None,
+            ):
+                if candidate and candidate not in paths:
+                    paths.append(candidate)
+    return paths
+
+
+@register_tool(
+    "list_dir",
+    "Zeigt ein Verzeichnis als Baum (depth Ebenen, optional glob-Filter); "
+    ".gitignore, VCS-Ordner, node_modules und venvs bleiben ausgeblendet, außer all=true.",
+    {
+        "path": _STR,
+        "depth": _INT,
+        "glob": _STR,
+        "all": {"type": "boolean"},
+        "max_entries": _INT,
+    },
+    read_only=True,
+)
+def _tool_list_dir(sess, args: dict) -> str:
+    return list_dir(
+        sess.resolve(args.get("path", ".")),
+        depth=int(args.get("depth", 1)),
+        glob=args.get("glob"),
+        show_all=bool(args.get("all", False)),
+        max_entries=int(args.get("max_entries", LIST_DIR_MAX_ENTRIES)),
+        cache=sess.listing_cache,
+    )
+
+
+@register_tool(
+    "find_files",
+    "Findet Dateien im Projekt nach Name, Teilpfad oder Glob (beachtet .gitignore).",
+    {"pattern": _STR, "path": _STR, "limit": _INT},
+    required=("pattern",),
+    read_only=True,
+)
+def _tool_find_files(sess, args: dict) -> str:
+    index, prefix = _index_scope(sess, args.get("path"))
+    return find_files(
+        index, args.get("pattern", ""), prefix=prefix, limit=int(args.get("limit", 50))
+    )
+
+
+@register_tool(
+    "search",
+    "Durchsucht Projektdateien nach Text oder Regex; liefert gerankte Treffer mit Kontextzeilen.",
+    {
+        "query": _STR,
+        "path": _STR,
+        "regex": {"type": "boolean"},
+        "case_sensitive": {"type": "boolean"},
+        "glob": _STR,
+        "context": _INT,
+        "max_results": _INT,
+    },
+    required=("query",),
+    read_only=True,
+)
+def _tool_search(sess, args: dict) -> str:
+    index, prefix = _index_scope(sess, args.get("path"))
+    return search_files(
+        index,
+        args.get("query", ""),
+        prefix=prefix,
+        regex=bool(args.get("regex", False)),
+        case_sensitive=bool(args.get("case_sensitive", False)),
+        glob=args.get("glob"),
+        context=int(args.get("context", 2)),
+        max_results=int(args.get("max_results", 50)),
+    )
+
+
+@register_tool(
+    "read_file",
+    "Liest eine Textdatei (optional nur Zeilen start_line–end_line oder Bytes ab offset); "
+    "große Dateien werden gekürzt.",
+    {
+        "path": _STR,
+        "start_line": _INT,
+        "end_line": _INT,
+        "offset": _INT,
+        "length": _INT,
+    },
+    required=("path",),
+    read_only=True,
+    lock_keys=_path_key,
+)
+def _tool_read_file(sess, args: dict) -> str:
+    return read_file(
+        sess.resolve(args.get("path", "")),
+        start_line=args.get("start_line"),
+        end_line=args.get("end_line"),
+        offset=args.get("offset"),
+        length=args.get("length"),
+    )
+
+
+@register_tool(
+    "write_file",
+    "Schreibt eine Datei vollständig neu.",
+    {"path": _STR, "content": _STR},
+    required=("path", "content"),
+    lock_keys=_path_key,
+)
+def _tool_write_file(sess, args: dict) -> str:
+    path = sess.resolve(args.get("path", ""))
+    # Überschreiben ändert die Verzeichnis-mtime nicht – gecachte Größen verwerfen.
+    sess.listing_cache.pop(os.path.dirname(path), None)
+    if not sess.dryrun:
+        sess.touched.add(path)
+    return write_file(path, args.get("content", ""), dry=sess.dryrun)
+
+
+_EDIT_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "search": _STR,
+            "replace": _STR,
+            "start_line": _INT,
+            "end_line": _INT,
+        },
+    },
+}
+
+
+@register_tool(
+    "edit_file",
+    "Ändert Teile einer Datei: edits=[{search, replace}] (eindeutiger Ankertext, tolerant gegenüber "
+    "Einrückung) oder [{start_line, end_line, replace}]; liefert nur den Diff.",
+    {"path": _STR, "edits": _EDIT_SCHEMA},
+    required=("path", "edits"),
+    lock_keys=_path_key,
+)
+def _tool_edit_file(sess, args: dict) -> str:
+    path = sess.resolve(args.get("path", ""))
+    sess.listing_cache.pop(os.path.dirname(path), None)
+    if not sess.dryrun:
+        sess.touched.add(path)
+    return edit_file(path, args.get("edits") or [], dry=sess.dryrun)
+
+
+@register_tool(
+    "apply_patch",
+    "Wendet einen Unified-Diff (-p0, mehrere Dateien) an; prüft alle Hunks vorab und schreibt atomar.",
+    {"patch": _STR},
+    required=("patch",),
+    lock_keys=lambda sess, args: [
+        sess.resolve(p) for p in _patch_paths(args.get("patch", ""))
+    ],
+)
+def _tool_apply_patch(sess, args: dict) -> str:
+    result = apply_patch(args.get("patch", ""), dry=sess.dryrun, cwd=sess.workdir)
+    for path in map(sess.resolve, _patch_paths(args.get("patch", ""))):
+        sess.listing_cache.pop(os.path.dirname(path), None)
+        if not sess.dryrun and os.path.isfile(path):
+            sess.touched.add(path)
+    return result
+
+
+def _plan_run(sess, args: dict) -> Optional[Union[str, ProcessSpec]]:
+    t = int(args.get("timeout", DEFAULT_TIMEOUT))
+    env = args.get("env") if isinstance(args.get("env"), dict) else None
+    if sess.dryrun:
+        return f"[run:DRYRUN] Würde ausführen: {args.get('cmd','')} (timeout={t})"
+    if sess.persistent_shell:
+        return None  # läuft über den ShellWorker der Session
+    return _run_spec(args.get("cmd", ""), timeout=t, env=env, cwd=sess.workdir)
+
+
+@register_tool(
+    "run",
+    "Führt einen Shell-Befehl aus.",
+    {
+        "cmd": _STR,
+        "timeout": _INT,
+        "env": {"type": "object", "additionalProperties": _STR},
+    },
+    required=("cmd",),
+    max_concurrency=4,
+    lock_keys=lambda sess, args: ["persistent-shell"] if sess.persistent_shell else [],
+    process=_plan_run,
+)
+def _tool_run(sess, args: dict) -> str:
+    plan = _plan_run(sess, args)
+    if plan is None:
+        env = args.get("env") if isinstance(args.get("env"), dict) else None
+        return run_in_shell(
+            sess.shell(),
+            args.get("cmd", ""),
+            timeout=int(args.get("timeout", DEFAULT_TIMEOUT)),
+            env=env,
+        )
+    return execute_process(plan)
+
+
+@register_tool(
+    "tail_file",
+    "Zeigt die letzten Zeilen einer Datei; follow=true liefert nur seit dem letzten Aufruf neue Daten.",
+    {"path": _STR, "lines": _INT, "follow": {"type": "boolean"}},
+    required=("path",),
+    read_only=True,
+    lock_keys=_path_key,
+    speculative=lambda args: not args.get("follow"),
+)
+def _tool_tail_file(sess, args: dict) -> str:
+    return tail_file(
+        sess.resolve(args.get("path", "")),
+        int(args.get("lines", 200)),
+        follow=bool(args.get("follow", False)),
+        cursors=sess.tail_cursors,
+    )
+
+
+def _plan_systemctl(sess, args: dict) -> Union[str, ProcessSpec]:
+    units = args.get("units") if isinstance(args.get("units"), list) else None
+    if sess.dryrun:
+        names = " ".join(_systemctl_units(args.get("unit"), units))
+        return f"[systemctl:DRYRUN] Würde ausführen: systemctl {args.get('action')} {names}"
+    return _systemctl_spec(args.get("action", "status"), args.get("unit", ""), units)
+
+
+@register_tool(
+    "systemctl",
+    "Steuert systemd-Units. status nimmt mehrere Units/Glob-Muster (units) und liefert eine "
+    "kompakte Tabelle; ausführlicher Status nur für fehlerhafte Units.",
+    {
+        "action": {
+            "type": "string",
+            "enum": ["status", "restart", "start", "stop", "daemon-reload"],
+        },
+        "unit": _STR,
+        "units": {"type": "array", "items": _STR},
+    },
+    required=("action",),
+    read_only=lambda args: args.get("action", "status") == "status",
+    lock_keys=lambda sess, args: ["systemd"],
+    process=_plan_systemctl,
+)
+def _tool_systemctl(sess, args: dict) -> str:
+    return execute_process(_plan_systemctl(sess, args))
+
+
+def _plan_docker(sess, args: dict) -> Union[str, ProcessSpec]:
+    if sess.dryrun:
+        return f"[docker:DRYRUN] Würde docker compose {args.get('action')} {args.get('service','')}"
+    return _docker_compose_spec(
+        args.get("action", "logs"),
+        args.get("service"),
+        cwd=sess.workdir,
+        cursors=sess.log_cursors,
+        follow_seconds=args.get("follow_seconds"),
+        until=args.get("until"),
+    )
+
+
+@register_tool(
+    "docker",
+    "Bedient docker compose im aktuellen Projekt. logs liefert nur seit dem letzten Abruf neue Zeilen; "
+    "follow_seconds/until verfolgen die Logs begrenzt bzw. bis eine Zeile auf den Regex passt.",
+    {
+        "action": {"type": "string", "enum": ["up", "down", "build", "logs"]},
+        "service": _STR,
+        "follow_seconds": _INT,
+        "until": _STR,
+    },
+    required=("action",),
+    read_only=lambda args: args.get("action") == "logs",
+    lock_keys=lambda sess, args: ["docker-compose"],
+    max_concurrency=2,
+    process=_plan_docker,
+    speculative=False,
+)  # logs bewegen den Cursor bzw. warten bis zu follow_seconds
+def _tool_docker(sess, args: dict) -> str:
+    return execute_process(_plan_docker(sess, args))
+
+
+def _plan_pytest(sess, args: dict) -> Union[str, ProcessSpec, ProcessGroup]:
+    if sess.dryrun:
+        return "[pytest:DRYRUN] Würde pytest ausführen."
+    affected = sorted(sess.touched) if args.get("affected") else None
+    return plan_pytest(
+        args.get("path", "."),
+        args.get("k"),
+        timeout=int(args.get("timeout", DEFAULT_TIMEOUT)),
+        cwd=sess.workdir,
+        shards=int(args.get("shards") or 0),
+        affected=affected,
+    )
+
+
+@register_tool(
+    "pytest",
+    "Startet pytest. affected=true führt nur Tests aus, die in dieser Sitzung geänderte Dateien "
+    "importieren; affected bzw. shards verteilen die Testdateien auf Shards und melden nur "
+    "Zählwerte und Fehlschläge.",
+    {
+        "path": _STR,
+        "k": _STR,
+        "affected": {"type": "boolean"},
+        "shards": _INT,
+        "timeout": _INT,
+    },
+    max_concurrency=1,
+    process=_plan_pytest,
+)
+def _tool_pytest(sess, args: dict) -> str:
+    return execute_process(_plan_pytest(sess, args))
+
+
+def _tool_span(sess, tool: str, args: dict):
+    return sess.tracer.span(
+        "tool",
+        tool,
+        bytes_in=len(json.dumps(args, ensure_ascii=False, default=str).encode()),
+    )
+
+
+def dispatch_tool(sess, tool: str, args: dict) -> str:
+    spec = TOOLS.get(tool)
+    if spec is None:
+        return f"Unbekanntes Tool: {tool}"
+    args = args if isinstance(args, dict) else {}
+    with _tool_span(sess, tool, args) as span:
+        result = spec.handler(sess, args)
+        span["bytes_out"] = len(result.encode())
+    return result
+
+
+def _tool_semaphore(spec: ToolSpec) -> Optional[threading.BoundedSemaphore]:
+    if spec.max_concurrency <= 0:
+        return None
+    with _LOCK_REGISTRY_GUARD:
+        sem = _TOOL_SEMAPHORES.get(spec.name)
+        if sem is None:
+            sem = _TOOL_SEMAPHORES[spec.name] = threading.BoundedSemaphore(
+                spec.max_concurrency
+            )
+        return sem
+
+
+def _path_lock(key: str) -> threading.Lock:
+    with _LOCK_REGISTRY_GUARD:
+        lock = _PATH_LOCKS.get(key)
+        if lock is None:
+            lock = _PATH_LOCKS[key] = threading.Lock()
+        return lock
+
+
+def _execute_call(sess, call: ToolCall) -> str:
+    """Führt einen Tool-Call unter Tool-Semaphore und Pfad-Locks aus."""
+
+    if call.error:
+        return f"[{call.name}] {call.error}"
+    spec = TOOLS.get(call.name)
+    if spec is None:
+        return dispatch_tool(sess, call.name, call.args)
+    with ExitStack() as stack:
+        sem = _tool_semaphore(spec)
+        if sem is not None:
+            stack.enter_context(sem)
+        if not spec.is_read_only(call.args):
+            for key in sorted(set(spec.keys(sess, call.args))):
+                stack.enter_context(_path_lock(key))
+        try:
+            return dispatch_tool(sess, call.name, call.args)
+        except Exception as e:
+            return f"[{call.name}] Fehler: {e}"
+
+
+def _call_dependencies(sess, calls: List[ToolCall]) -> List[Set[int]]:
+    """Frühere Calls, auf die ein Call warten muss (gemeinsamer Schlüssel + Schreibzugriff).
+
+    Schreibende Calls ohne Schlüssel (``run``, ``pytest``) können den ganzen
+    Arbeitsbereich verändern und wirken als Barriere: Sie warten auf alle
+    früheren Calls, alle späteren warten auf sie.
+    """
+
+    plans = []
+    for call in calls:
+        spec = TOOLS.get(call.name)
+        if spec is None or call.error:
+            plans.append((True, set()))
+        else:
+            plans.append(
+                (spec.is_read_only(call.args), set(spec.keys(sess, call.args)))
+            )
+    barriers = {
+        i for i, (read_only, keys) in enumerate(plans) if not read_only and not keys
+    }
+    deps: List[Set[int]] = []
+    for i, (read_only, keys) in enumerate(plans):
+        deps.append(
+            {
+                j
+                for j, (other_ro, other_keys) in enumerate(plans[:i])
+                if i in barriers
+                or j in barriers
+                or (keys & other_keys and not (read_only and other_ro))
+            }
+        )
+    return deps
+
+
+def dispatch_tools(
+    sess, calls: List[ToolCall], prefetched: Optional[Dict[int, "Future[str]"]] = None
+) -> List[str]:
+    """Führt mehrere Tool-Calls aus und liefert die Ergebnisse in Aufrufreihenfolge.
+
+    Unabhängige Calls laufen parallel im Thread-Pool der Session; Calls mit
+    Konflikten (z. B. Lesen und Schreiben derselben Datei) in Aufrufreihenfolge.
+    ``prefetched`` enthält bereits gestartete Calls (Index → Future, siehe
+    ``Prefetch``); abhängige Calls warten auf deren Ende.
+    """
+
+    prefetched = prefetched or {}
+    if len(calls) <= 1 or sess.tool_workers <= 1:
+        return [
+            prefetched[i].result() if i in prefetched else _execute_call(sess, call)
+            for i, call in enumerate(calls)
+        ]
+
+    deps = _call_dependencies(sess, calls)
+    results: List[Optional[str]] = [None] * len(calls)
+    pending = [i for i in range(len(calls)) if i not in prefetched]
+    done: Set[int] = set()
+    running: Dict[Any, int] = {future: i for i, future in prefetched.items()}
+    pool = sess.tool_pool()
+    while pending or running:
+        for i in [i for i in pending if deps[i] <= done]:
+            running[pool.submit(_execute_call, sess, calls[i])] = i
+            pending.remove(i)
+        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in finished:
+            i = running.pop(future)
+            results[i] = future.result()
+            done.add(i)
+    return [r or "" for r in results]
+
+
+_ASYNC_SEMAPHORES: "weakref.WeakKeyDictionary[Any, Dict[str, asyncio.Semaphore]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _async_tool_semaphore(spec: ToolSpec) -> Optional["asyncio.Semaphore"]:
+    import asyncio
+
+    if spec.max_concurrency <= 0:
+        return None
+    per_loop = _ASYNC_SEMAPHORES.setdefault(asyncio.get_running_loop(), {})
+    sem = per_loop.get(spec.name)
+    if sem is None:
+        sem = per_loop[spec.name] = asyncio.Semaphore(spec.max_concurrency)
+    return sem
+
+
+async def _execute_call_async(sess, call: ToolCall) -> str:
+    """Subprozess-Tools laufen als asyncio-Subprozess, alle anderen im Default-Executor."""
+
+    import asyncio
+
+    spec = TOOLS.get(call.name)
+    plan = (
+        spec.process(sess, call.args)
+        if spec is not None and spec.process and not call.error
+        else None
+    )
+    if plan is None:
+        return await asyncio.to_thread(_execute_call, sess, call)
+    sem = _async_tool_semaphore(spec)  # type: ignore[arg-type]
+    if sem is None:
+        return await _execute_plan_traced(sess, call, plan)
+    async with sem:
+        return await _execute_plan_traced(sess, call, plan)
+
+
+async def _execute_plan_traced(
+    sess, call: ToolCall, plan: Union[str, ProcessSpec, ProcessGroup]
+) -> str:
+    with _tool_span(sess, call.name, call.args) as span:
+        result = await execute_process_async(plan)
+        span["bytes_out"] = len(result.encode())
+    return result
+
+
+async def dispatch_tools_async(sess, calls: List[ToolCall]) -> List[str]:
+    """Async-Variante von ``dispatch_tools`` mit denselben Abhängigkeitsregeln."""
+
+    import asyncio
+
+    deps = _call_dependencies(sess, calls)
+    tasks: List["asyncio.Future[str]"] = []
+    for i, call in enumerate(calls):
+
+        async def runner(i: int = i, call: ToolCall = call) -> str:
+            if deps[i]:
+                await asyncio.gather(*(tasks[j] for j in deps[i]))
+            return await _execute_call_async(sess, call)
+
+        tasks.append(asyncio.ensure_future(runner()))
+    try:
+        return list(await asyncio.gather(*tasks))
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+READ_ONLY_POLICIES = ("confirm", "prefetch", "auto")
+READ_ONLY_AUTO_STEPS = 10  # max. automatisch freigegebene Lese-Schritte in Folge
+
+
+def _speculative_calls(sess, calls: List[ToolCall]) -> Set[int]:
+    """Calls, die vorab laufen dürfen: lesend, ohne Cursor-Effekt und ohne Abhängigkeit von Schreibern."""
+
+    deps = _call_dependencies(sess, calls)
+    out: Set[int] = set()
+    for i, call in enumerate(calls):
+        spec = TOOLS.get(call.name)
+        if (
+            spec is not None
+            and not call.error
+            and spec.is_speculative(call.args)
+            and deps[i] <= out
+        ):
+            out.add(i)
+    return out
+
+
+class Prefetch:
+    """Führt lesende Tool-Calls einer vorgeschlagenen Antwort aus, während ``:yes`` aussteht.
+
+    Nur die Tools laufen vorab; der nächste Modellaufruf startet erst nach ``:yes``,
+    damit keine Tool-Ergebnisse ohne Freigabe an die API gehen. Bei ``:yes`` werden
+    die Ergebnisse übernommen, bei ``:no`` verworfen.
+    """
+
+    def __init__(self, sess, reply: ModelReply) -> None:
+        self.reply = reply
+        pool = sess.tool_pool()
+        self.futures: Dict[int, "Future[str]"] = {
+            i: pool.submit(_execute_call, sess, reply.tool_calls[i])
+            for i in sorted(_speculative_calls(sess, reply.tool_calls))
+        }
+
+    def results(self, sess) -> List[str]:
+        """Vorab berechnete Ergebnisse plus die jetzt erst ausgeführten schreibenden Calls.
+
+        Schreibende Calls warten dabei auf vorab gestartete Calls, von denen sie abhängen.
+        """
+
+        return dispatch_tools(sess, self.reply.tool_calls, self.futures)
+
+    def discard(self) -> None:
+        for future in self.futures.values():
+            future.cancel()
+
+
+def execute_reply(sess, reply: ModelReply, prefetch: Optional[Prefetch] = None) -> None:
+    """Führt alle Tool-Calls einer Antwort aus, zeigt und protokolliert die Ergebnisse."""
+
+    results = (
+        prefetch.results(sess)
+        if prefetch is not None
+        else dispatch_tools(sess, reply.tool_calls)
+    )
+    for result in results:
+        print(result)
+    sess.record_tool_results(reply, results)
+
+
+def describe_tool_calls(reply: ModelReply) -> str:
+    return json.dumps(
+        [{"tool": c.name, "args": c.args} for c in reply.tool_calls], ensure_ascii=False
+    )
+
+
+def decline_reply(sess, reply: ModelReply) -> None:
+    """Verwirft vorgeschlagene Tool-Calls; native Calls brauchen trotzdem eine Antwort."""
+
+    if sess.prefetch is not None:
+        sess.prefetch.discard()
+        sess.prefetch = None
+    if reply.native:
+        sess.record_tool_results(
+            reply, ["Aktion vom Nutzer abgelehnt."] * len(reply.tool_calls)
+        )
+
+
+def confirm_reply(sess, reply: ModelReply) -> None:
+    """``:yes``: Tool-Calls ausführen (bzw. Vorab-Ergebnisse übernehmen) und weitermachen."""
+
+    prefetch, sess.prefetch = sess.prefetch, None
+    execute_reply(sess, reply, prefetch)
+    handle_reply(sess, run_model(sess))
+
+
+def handle_reply(sess, reply: ModelReply) -> None:
+    """Interaktiver Modus: Tool-Calls ausführen (auto) oder zur Bestätigung vormerken.
+
+    ``read_only_policy`` entscheidet über rein lesende Antworten: ``auto`` gibt sie
+    ohne Rückfrage frei, ``prefetch`` führt sie schon während der Rückfrage aus.
+    """
+
+    for _ in range(READ_ONLY_AUTO_STEPS):
+        show_reply(reply)
+        if not reply.tool_calls:
+            sess.add("assistant", reply.text)
+            return
+        if sess.auto:
+            execute_reply(sess, reply)
+            return
+        if sess.read_only_policy != "auto" or len(
+            _speculative_calls(sess, reply.tool_calls)
+        ) < len(reply.tool_calls):
+            break
+        print("[auto] Nur lesende Aktionen →", describe_tool_calls(reply))
+        execute_reply(sess, reply)
+        reply = run_model(sess)
+    else:
+        show_reply(reply)
+    sess.pending_action = reply
+    if sess.prefetch is not None:
+        sess.prefetch.discard()
+    sess.prefetch = (
+        Prefetch(sess, reply) if sess.read_only_policy in ("prefetch", "auto") else None
+    )
+    print("AI möchte ausführen →", describe_tool_calls(reply))
+    print("Bestätigen? (:yes / :no)")
+
+
+def headless_loop(sess, goal: str, max_steps: int = 30):
+    sess.add(
+        "user",
+        f"Ziel: {goal}. Lege los, arbeite iterativ bis abgeschlossen. Melde Fortschritt kurz.",
+    )
+    for step in range(1, max_steps + 1):
+        sess.tracer.step = step
+        with sess.tracer.span("step", f"#{step}"):
+            reply = run_model(sess)
+            if reply.tool_calls:
+                show_reply(reply)
+                execute_reply(sess, reply)
+                continue
+            txt = reply.text.strip().lower()
+            show_reply(reply)
+            sess.add("assistant", reply.text)
+        if any(k in txt for k in ["fertig", "abgeschlossen", "done", "final"]):
+            print("[headless] Fertig gemeldet nach", step, "Schritten.")
+            break
+    else:
+        print("[headless] Max Steps erreicht.")
+    print(sess.tracer.summary())
+
+
+@dataclass
+class HeadlessResult:
+    status: str  # "done", "max_steps" oder "timeout"
+    steps: int
+
+
+async def headless_loop_async(
+    sess,
+    goal: str,
+    max_steps: int = 30,
+    timeout: Optional[float] = None,
+    echo: bool = True,
+) -> HeadlessResult:
+    """Headless-Engine auf asyncio-Basis.
+
+    Modellaufrufe laufen über ``sess.async_client``, Subprozess-Tools als
+    asyncio-Subprozesse. Die Ausgabe eines Schritts wird im Hintergrund
+    geschrieben, während bereits die nächste Completion läuft. ``timeout``
+    begrenzt den gesamten Lauf; beim Abbruch werden laufende Kindprozesse beendet.
+    Mit ``echo=False`` (Batch-Betrieb) bleiben Terminalausgaben aus.
+    """
+
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    # Ein Thread für Ausgaben hält die Reihenfolge, blockiert aber nie den Event-Loop.
+    output = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gptcode-out")
+    writers: List["asyncio.Future[None]"] = []
+    progress = {"steps": 0}
+    if not echo:
+        _TOOL_ECHO.set(False)
+
+    def emit(text: str) -> None:
+        if text and echo:
+            writers.append(loop.run_in_executor(output, print, text))
+
+    async def steps() -> HeadlessResult:
+        sess.add(
+            "user",
+            f"Ziel: {goal}. Lege los, arbeite iterativ bis abgeschlossen. Melde Fortschritt kurz.",
+        )
+        for step in range(1, max_steps + 1):
+            progress["steps"] = sess.tracer.step = step
+            with sess.tracer.span("step", f"#{step}"):
+                reply = await run_model_async(sess)
+                if reply.tool_calls:
+                    if not reply.streamed:
+                        emit(reply.text.strip())
+                    results = await dispatch_tools_async(sess, reply.tool_calls)
+                    sess.record_tool_results(reply, results)
+                    emit("\n".join(results))
+                    continue
+                if not reply.streamed:
+                    emit(reply.text.strip())
+                sess.add("assistant", reply.text)
+            if any(
+                k in reply.text.strip().lower()
+                for k in ["fertig", "abgeschlossen", "done", "final"]
+            ):
+                emit(f"[headless] Fertig gemeldet nach {step} Schritten.")
+                return HeadlessResult("done", step)
+        emit("[headless] Max Steps erreicht.")
+        return HeadlessResult("max_steps", max_steps)
+
+    try:
+        return await asyncio.wait_for(steps(), timeout=timeout)
+    except asyncio.TimeoutError:
+        emit(f"[headless] Zeitlimit von {timeout}s erreicht – Lauf abgebrochen.")
+        return HeadlessResult("timeout", progress["steps"])
+    finally:
+        emit(sess.tracer.summary())
+        if writers:
+            await asyncio.gather(*writers)
+        output.shutdown(wait=False)
+
+
+class AsyncRateLimiter:
+    """Verteilt höchstens ``per_minute`` Modellanfragen gleichmäßig über die Zeit."""
+
+    def __init__(self, per_minute: float) -> None:
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self._next = 0.0
+        self._lock: Optional["asyncio.Lock"] = None
+
+    async def acquire(self) -> None:
+        import asyncio
+
+        if self.interval <= 0:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            now = time.monotonic()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+                now = time.monotonic()
+            self._next = max(now, self._next) + self.interval
+
+
+def load_goals_file(path: str) -> List[Dict[str, Any]]:
+    """Liest ein Goals-File (JSONL: goal, cwd, model, dryrun, max_steps)."""
+
+    goals = []
+    for lineno, line in enumerate(
+        Path(path).expanduser().read_text(encoding="utf-8").splitlines(), 1
+    ):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{path}:{lineno}: ungültiges JSON ({e})") from None
+        if not isinstance(entry, dict) or not str(entry.get("goal", "")).strip():
+            raise ValueError(f"{path}:{lineno}: Feld 'goal' fehlt")
+        goals.append(entry)
+    return goals
+
+
+async def run_goals_batch(
+    goals: List[Dict[str, Any]],
+    make_session: Callable[[Dict[str, Any]], Any],
+    concurrency: int = 4,
+    rate_per_minute: float = 0,
+    max_steps: int = 30,
+    timeout: Optional[float] = None,
+    out: Any = None,
+) -> List[Dict[str, Any]]:
+    """Führt viele Headless-Ziele nebenläufig in einem Event-Loop aus.
+
+    Jedes Ziel erhält über ``make_session`` eine eigene Session mit eigenem
+    Arbeitsverzeichnis. ``concurrency`` begrenzt gleichzeitige Ziele,
+    ``rate_per_minute`` die Modellanfragen aller Ziele zusammen. Pro Ziel wird
+    eine JSON-Zeile (Status, Schritte, Tokens, Modell-/Toolzeit, Laufzeit) nach ``out`` geschrieben.
+    """
+
+    import asyncio
+
+    out = out if out is not None else sys.stdout
+    gate = asyncio.Semaphore(max(1, concurrency))
+    limiter = AsyncRateLimiter(rate_per_minute)
+    results: List[Optional[Dict[str, Any]]] = [None] * len(goals)
+
+    async def run_one(index: int, entry: Dict[str, Any]) -> None:
+        async with gate:
+            started = time.monotonic()
+            record: Dict[str, Any] = {
+                "index": index,
+                "goal": entry["goal"],
+                "cwd": entry.get("cwd", "."),
+            }
+            sess = None
+            try:
+                sess = make_session(entry)
+                sess.rate_limiter = limiter
+                sess.tracer.label = sess.tracer.label or str(index)
+                record["cwd"] = sess.workdir
+                record["model"] = sess.model
+                if not Path(sess.workdir).is_dir():
+                    raise FileNotFoundError(f"Arbeitsverzeichnis fehlt: {sess.workdir}")
+                outcome = await headless_loop_async(
+                    sess,
+                    entry["goal"],
+                    max_steps=int(entry.get("max_steps", max_steps)),
+                    timeout=timeout,
+                    echo=False,
+                )
+                record.update(status=outcome.status, steps=outcome.steps)
+            except Exception as e:
+                record.update(status="error", steps=0, error=f"{type(e).__name__}: {e}")
+            finally:
+                if sess is not None:
+                    record.update(sess.usage)
+                    record["model_time"] = round(
+                        sess.tracer.totals("model")["total"], 3
+                    )
+                    record["tool_time"] = round(sess.tracer.totals("tool")["total"], 3)
+                    sess.close()
+                record["wall_time"] = round(time.monotonic() - started, 3)
+            results[index] = record
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+
+    await asyncio.gather(*(run_one(i, entry) for i, entry in enumerate(goals)))
+    return [r for r in results if r is not None]
+
+
+def determine_session_settings(
+    cfg: Dict[str, Any],
+    model_override: Optional[str] = None,
+    dryrun_override: Optional[bool] = None,
+) -> Tuple[str, bool]:
+    model = model_override or cfg.get("model") or DEFAULT_MODEL
+    dryrun = (
+        dryrun_override
+        if dryrun_override is not None
+        else bool(cfg.get("dryrun", False))
+    )
+    return model, dryrun
+
+
+def open_response_sources(
+    cfg: Dict[str, Any],
+    cache_override: Optional[bool] = None,
+    record: Optional[str] = None,
+    replay: Optional[str] = None,
+) -> Tuple[Optional[ResponseCache], Optional[Cassette]]:
+    """Antwort-Cache und Cassette aus Konfiguration und CLI-Flags bestimmen."""
+
+    if cache_override is not None:
+        cfg = dict(
+            cfg,
+            response_cache=dict(
+                cfg.get("response_cache") or {}, enabled=cache_override
+            ),
+        )
+    cache = ResponseCache.from_config(cfg)
+    cassette = None
+    if replay:
+        try:
+            cassette = Cassette(replay, "replay")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[FEHLER] Cassette nicht lesbar: {e}", file=sys.stderr)
+            sys.exit(1)
+    elif record:
+        cassette = Cassette(record, "record")
+    return cache, cassette
+
+
+def open_trace(path: Optional[str]) -> Optional[Any]:
+    """Öffnet die Trace-Datei (JSONL, wird angehängt) für ``--trace``."""
+
+    if not path:
+        return None
+    try:
+        return open(Path(path).expanduser(), "a", encoding="utf-8")
+    except OSError as e:
+        print(f"[FEHLER] Trace-Datei nicht schreibbar: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+def headless_batch(
+    goals_file: str,
+    model_override: Optional[str] = None,
+    dryrun_override: Optional[bool] = None,
+    concurrency: int = 4,
+    rate_limit: float = 0,
+    results_file: Optional[str] = None,
+    max_steps: int = 30,
+    goal_timeout: Optional[float] = None,
+    cache_override: Optional[bool] = None,
+    record: Optional[str] = None,
+    replay: Optional[str] = None,
+    trace: Optional[str] = None,
+    fast_model_override: Optional[str] = None,
+) -> None:
+    """Batch-Headless: alle Ziele aus ``goals_file`` in einem Event-Loop abarbeiten."""
+
+    import asyncio
+
+    if not openai_installed():
+        print(
+            "[FEHLER] openai-SDK fehlt. Bitte Installer erneut ausführen.",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    try:
+        goals = load_goals_file(goals_file)
+    except (OSError, ValueError) as e:
+        print(f"[FEHLER] Goals-File: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    cfg = load_config()
+    os.environ["OPENAI_API_KEY"] = cfg.get("api_key", "")
+    # Ein gemeinsamer Client pro Art teilt den Verbindungspool über alle Ziele.
+    client, async_client = _LazyClient("OpenAI", cfg.get("http")), _LazyClient(
+        "AsyncOpenAI", cfg.get("http")
+    )
+    cache, cassette = open_response_sources(cfg, cache_override, record, replay)
+    trace_out = open_trace(trace)
+    positions = {id(entry): i for i, entry in enumerate(goals)}
+
+    def make_session(entry: Dict[str, Any]) -> Session:
+        dry = (
+            entry["dryrun"]
+            if isinstance(entry.get("dryrun"), bool)
+            else dryrun_override
+        )
+        model, dryrun = determine_session_settings(
+            cfg,
+            model_override=entry.get("model") or model_override,
+            dryrun_override=dry,
+        )
+        return Session(
+            client=client,
+            model=model,
+            async_client=async_client,
+            dryrun=dryrun,
+            auto=True,
+            native_tools=bool(cfg.get("native_tools", True)),
+            tool_workers=int(cfg.get("tool_workers", 8)),
+            persistent_shell=bool(cfg.get("persistent_shell", False)),
+            cwd=str(Path(entry.get("cwd") or ".").expanduser().resolve()),
+            response_cache=cache,
+            cassette=(
+                cassette.for_goal(positions[id(entry)])
+                if cassette is not None
+                else None
+            ),
+            tracer=Tracer(trace_out),
+            results=ResultStore.from_config(cfg),
+            router=ModelRouter.from_config(cfg, fast_model_override),
+            context=ContextManager.from_config(cfg, model=model),
+        )
+
+    out = open(results_file, "a", encoding="utf-8") if results_file else sys.stdout
+    try:
+        results = asyncio.run(
+            run_goals_batch(
+                goals,
+                make_session,
+                concurrency=concurrency,
+                rate_per_minute=rate_limit,
+                max_steps=max_steps,
+                timeout=goal_timeout,
+                out=out,
+            )
+        )
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if cassette is not None:
+            cassette.close()
+        if trace_out is not None:
+            trace_out.close()
+    done = sum(1 for r in results if r["status"] == "done")
+    print(f"[batch] {done}/{len(results)} Ziele fertig gemeldet.", file=sys.stderr)
+
+
+def repl(
+    headless: bool = False,
+    goal: Optional[str] = None,
+    auto: Optional[bool] = None,
+    model_override: Optional[str] = None,
+    dryrun_override: Optional[bool] = None,
+    stream_override: Optional[bool] = None,
+    engine: Optional[str] = None,
+    max_steps: int = 30,
+    cache_override: Optional[bool] = None,
+    record: Optional[str] = None,
+    replay: Optional[str] = None,
+    trace: Optional[str] = None,
+    fast_model_override: Optional[str] = None,
+):
+    import asyncio
+
+    if not openai_installed():
+        print(
+            "[FEHLER] openai-SDK fehlt. Bitte Installer erneut ausführen.",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    cfg = load_config()
+    os.environ["OPENAI_API_KEY"] = cfg.get("api_key", "")
+    model, dryrun = determine_session_settings(
+        cfg, model_override=model_override, dryrun_override=dryrun_override
+    )
+    client = _LazyClient("OpenAI", cfg.get("http"))
+    cache, cassette = open_response_sources(cfg, cache_override, record, replay)
+    trace_out = open_trace(trace)
+    sess = Session(
+        client=client,
+        model=model,
+        dryrun=dryrun,
+        response_cache=cache,
+        cassette=cassette,
+        tracer=Tracer(trace_out),
+        results=ResultStore.from_config(cfg),
+        router=ModelRouter.from_config(cfg, fast_model_override),
+        native_tools=bool(cfg.get("native_tools", True)),
+        tool_workers=int(cfg.get("tool_workers", 8)),
+        persistent_shell=bool(cfg.get("persistent_shell", False)),
+        context=ContextManager.from_config(cfg, model=model),
+    )
+    if auto is not None:
+        sess.auto = auto
+    sess.stream = (
+        stream_override
+        if stream_override is not None
+        else bool(cfg.get("stream", False))
+    )
+    sess.stream_cutoff = bool(cfg.get("stream_cutoff", True))
+    policy = str(cfg.get("read_only_policy", "prefetch")).lower()
+    sess.read_only_policy = policy if policy in READ_ONLY_POLICIES else "prefetch"
+
+    help_text = (
+        ":help – Hilfe\n"
+        ":cwd – aktuelles Verzeichnis\n"
+        ":cd <pfad> – wechseln\n"
+        ":yes / :no – letzte Aktion erlauben/ablehnen\n"
+        ":dryrun on|off – Schreib/Ausführ-Dry-Run\n"
+        ":auto on|off – Schritte automatisch erlauben\n"
+        ":stream on|off – Antworten live streamen\n"
+        ":shell on|off|reset – persistente Shell für run\n"
+        ":stats – Zeit- und Token-Statistik der Sitzung\n"
+        ":readonly confirm|prefetch|auto – lesende Aktionen bestätigen/vorab/frei\n"
+        ":quit – beenden\n"
+    )
+    dry_info = "on" if sess.dryrun else "off"
+    fast_info = f", schnell: {sess.router.fast_model}" if sess.router.fast_model else ""
+    print(
+        f"GPTCode bereit – Modell: {sess.model}{fast_info} (dryrun={dry_info})\nProjekt: {Path.cwd()}\n\n{help_text}"
+    )
+
+    try:
+        if headless and goal:
+            print("[Headless] Auto-Modus gestartet: ", goal)
+            sess.auto = True
+            if (engine or cfg.get("engine", "sync")) == "async":
+                sess.async_client = _LazyClient("AsyncOpenAI", cfg.get("http"))
+                asyncio.run(headless_loop_async(sess, goal, max_steps=max_steps))
+            else:
+                headless_loop(sess, goal, max_steps=max_steps)
+            return
+
+        while True:
+            try:
+                user = input("you> ").strip()
+            except (EOFError, KeyboardInterrupt):
+                print()
+                break
+            if not user:
+                continue
+
+            if user == ":quit":
+                break
+            if user == ":help":
+                print(HELP)
+                continue
+            if user == ":cwd":
+                print(sess.workdir)
+                continue
+            if user == ":stats":
+                print(sess.tracer.summary())
+                continue
+            if user.startswith(":cd "):
+                target = sess.resolve(user[4:].strip())
+                try:
+                    os.chdir(target)
+                    sess.cwd = target
+                    print(f"OK: {sess.workdir}")
+                except Exception as e:
+                    print(f"Fehler: {e}")
+                continue
+            if user.startswith(":dryrun"):
+                _, _, val = user.partition(" ")
+                val = val.strip().lower()
+                if val in {"on", "off"}:
+                    cfg = load_config()
+                    cfg["dryrun"] = val == "on"
+                    save_config(cfg)
+                    sess.dryrun = val == "on"
+                    print(f"dryrun={sess.dryrun}")
+                else:
+                    print(f"dryrun aktuell: {sess.dryrun}")
+                continue
+            if user.startswith(":auto"):
+                _, _, val = user.partition(" ")
+                val = val.strip().lower()
+                if val in {"on", "off"}:
+                    sess.auto = val == "on"
+                    print(f"auto={sess.auto}")
+                else:
+                    print(f"auto aktuell: {sess.auto}")
+                continue
+            if user.startswith(":readonly"):
+                _, _, val = user.partition(" ")
+                val = val.strip().lower()
+                if val in READ_ONLY_POLICIES:
+                    sess.read_only_policy = val
+                    print(f"readonly={val}")
+                else:
+                    print(f"readonly aktuell: {sess.read_only_policy}")
+                continue
+            if user.startswith(":stream"):
+                _, _, val = user.partition(" ")
+                val = val.strip().lower()
+                if val in {"on", "off"}:
+                    sess.stream = val == "on"
+                    print(f"stream={sess.stream}")
+                else:
+                    print(f"stream aktuell: {sess.stream}")
+                continue
+            if user.startswith(":shell"):
+                _, _, val = user.partition(" ")
+                val = val.strip().lower()
+                if val in {"on", "off"}:
+                    sess.persistent_shell = val == "on"
+                    if not sess.persistent_shell:
+                        sess.reset_shell()
+                    print(f"shell={sess.persistent_shell}")
+                elif val == "reset":
+                    sess.reset_shell()
+                    print("Persistente Shell zurückgesetzt.")
+                else:
+                    print(f"shell aktuell: {sess.persistent_shell}")
+                continue
+            if user in (":yes", ":no"):
+                if not sess.pending_action:
+                    print("Keine ausstehende Aktion.")
+                    continue
+                reply = sess.pending_action
+                sess.pending_action = None
+                if user == ":no":
+                    decline_reply(sess, reply)
+                    print("Aktion verworfen.")
+                    continue
+                sess.tracer.step += 1
+                with sess.tracer.span("step", f"#{sess.tracer.step}"):
+                    confirm_reply(sess, reply)
+                continue
+
+            # Normaler Chat
+            if sess.prefetch is not None:
+                sess.prefetch.discard()
+                sess.prefetch = None
+            sess.add("user", user)
+            sess.tracer.step += 1
+            with sess.tracer.span("step", f"#{sess.tracer.step}"):
+                handle_reply(sess, run_model(sess))
+    except CassetteError as e:
+        print(f"[FEHLER] {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        sess.close()
+        if cassette is not None:
+            cassette.close()
+        if trace_out is not None:
+            trace_out.close()
+
+
+def parse_cli_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="gptcode", description="GPTCode – Chat-first DevOps/Coding Assistent"
+    )
+    parser.add_argument(
+        "--headless", action="store_true", help="Headless-Modus aktivieren"
+    )
+    parser.add_argument(
+        "--goal", metavar="TEXT", help="Zielbeschreibung für Headless-Läufe"
+    )
+    parser.add_argument(
+        "--auto", action="store_true", help="Automatische Freigabe aktivieren"
+    )
+    parser.add_argument(
+        "--model", metavar="NAME", help="Modell nur für diese Sitzung überschreiben"
+    )
+    parser.add_argument(
+        "--fast-model",
+        metavar="NAME",
+        help="Schnelles Modell für mechanische Folgeschritte (off = nur Hauptmodell)",
+    )
+    parser.add_argument(
+        "--dryrun", choices=["on", "off"], help="Dry-Run nur für diese Sitzung setzen"
+    )
+    parser.add_argument(
+        "--stream",
+        choices=["on", "off"],
+        help="Modellantworten live streamen (nur diese Sitzung)",
+    )
+    parser.add_argument(
+        "--engine", choices=["sync", "async"], help="Headless-Engine (Standard: sync)"
+    )
+    parser.add_argument(
+        "--cache",
+        choices=["on", "off"],
+        help="Antwort-Cache auf der Platte (nur diese Sitzung)",
+    )
+    replay_group = parser.add_mutually_exclusive_group()
+    replay_group.add_argument(
+        "--record",
+        metavar="PFAD",
+        help="Modellantworten als Cassette (JSONL) aufzeichnen",
+    )
+    replay_group.add_argument(
+        "--replay",
+        metavar="PFAD",
+        help="Modellantworten ausschließlich aus Cassette liefern",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PFAD",
+        help="Spans (Modell, Tools, Schritte) als JSONL anhängen",
+    )
+    parser.add_argument(
+        "--max-steps",
+        type=int,
+        default=30,
+        metavar="N",
+        help="Maximale Schritte pro Headless-Ziel",
+    )
+    parser.add_argument(
+        "--goals-file",
+        metavar="PFAD",
+        help="Batch: Ziele aus JSONL-Datei abarbeiten (async-Engine)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        metavar="N",
+        help="Batch: gleichzeitig laufende Ziele",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0,
+        metavar="N",
+        help="Batch: höchstens N Modellanfragen pro Minute (0 = unbegrenzt)",
+    )
+    parser.add_argument(
+        "--results-file",
+        metavar="PFAD",
+        help="Batch: JSONL-Ergebnisse anhängen statt auf stdout",
+    )
+    parser.add_argument(
+        "--goal-timeout",
+        type=float,
+        metavar="SEK",
+        help="Batch: Zeitlimit pro Ziel in Sekunden",
+    )
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    cli_args = parse_cli_args(sys.argv[1:])
+    check_runtime_prerequisites()
+    ensure_config()
+    dry_override = None
+    if cli_args.dryrun is not None:
+        dry_override = cli_args.dryrun == "on"
+    auto_flag = True if cli_args.auto else None
+    stream_override = None
+    if cli_args.stream is not None:
+        stream_override = cli_args.stream == "on"
+    cache_override = None
+    if cli_args.cache is not None:
+        cache_override = cli_args.cache == "on"
+    if cli_args.goals_file:
+        headless_batch(
+            cli_args.goals_file,
+            model_override=cli_args.model,
+            dryrun_override=dry_override,
+            concurrency=cli_args.concurrency,
+            rate_limit=cli_args.rate_limit,
+            results_file=cli_args.results_file,
+            max_steps=cli_args.max_steps,
+            goal_timeout=cli_args.goal_timeout,
+            cache_override=cache_override,
+            record=cli_args.record,
+            replay=cli_args.replay,
+            trace=cli_args.trace,
+            fast_model_override=cli_args.fast_model,
+        )
+        return
     repl(
         headless=cli_args.headless,
         goal=cli_args.goal,
         auto=auto_flag,
         model_override=cli_args.model,
         dryrun_override=dry_override,
+        stream_override=stream_override,
+        engine=cli_args.engine,
+        max_steps=cli_args.max_steps,
+        cache_override=cache_override,
+        record=cli_args.record,
+        replay=cli_args.replay,
+        trace=cli_args.trace,
+        fast_model_override=cli_args.fast_model,
     )
 
 
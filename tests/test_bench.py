@@ -0,0 +1,56 @@
+import importlib.util
+from pathlib import Path
+
+
+def load_bench_module():
+    root = Path(__file__).resolve().parent.parent
+    spec = importlib.util.spec_from_file_location(
+        "gptcode_bench", root / "benchmarks" / "bench.py"
+    )
+    assert spec and spec.loader
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)  # type: ignore[assignment]
+    return module
+
+
+bench = load_bench_module()
+
+
+def test_long_session_workload_against_fake_server():
+    metrics = bench.run_workload("long_session", scale=0.05)
+
+    assert metrics["steps"] == 5 and metrics["requests"] == 5
+    assert metrics["wall_s"] > 0 and metrics["peak_rss_mb"] > 0
+    assert metrics["history_kb"] > 0 and metrics["step_overhead_ms"] >= 0
+
+
+def test_compare_flags_only_relevant_regressions():
+    baseline = {
+        "tail_file": {
+            "wall_s": 2.0,
+            "peak_rss_mb": 70.0,
+            "step_overhead_ms": 1.0,
+            "history_kb": 100.0,
+        }
+    }
+    results = {
+        "tail_file": {
+            "wall_s": 3.0,
+            "peak_rss_mb": 72.0,
+            "step_overhead_ms": 3.0,
+            "history_kb": 100.0,
+        }
+    }
+
+    regressions = bench.compare(results, baseline, tolerance=0.25)
+
+    # RSS +3 % und Overhead +2 ms liegen im Rauschen, nur die Wandzeit zählt.
+    assert len(regressions) == 1 and regressions[0].startswith("tail_file.wall_s")
+
+
+def test_flaky_api_workload_retries_rate_limits_on_one_connection():
+    metrics = bench.run_workload("flaky_api", scale=0.05)
+
+    assert metrics["rate_limited"] == 15 and metrics["steps"] == 5
+    assert metrics["connections"] == 1 and metrics["cached_ratio"] >= 0
+    assert metrics["step_p95_ms"] >= metrics["step_p50_ms"] > 0
@@ -1,4 +1,8 @@
 import importlib.util
+import json
+import os
+import subprocess
+import sys
 from pathlib import Path
 
 import pytest
@@ -24,16 +28,18 @@ class DummyResult:
 
 
 def test_parse_cli_args_supports_overrides():
-    args = gptcode.parse_cli_args([
-        "--headless",
-        "--auto",
-        "--goal",
-        "Do stuff",
-        "--model",
-        "gpt-test",
-        "--dryrun",
-        "on",
-    ])
+    args = gptcode.parse_cli_args(
+        [
+            "--headless",
+            "--auto",
+            "--goal",
+            "Do stuff",
+            "--model",
+            "gpt-test",
+            "--dryrun",
+            "on",
+        ]
+    )
     assert args.headless is True
     assert args.auto is True
     assert args.goal == "Do stuff"
@@ -43,7 +49,9 @@ def test_parse_cli_args_supports_overrides():
 
 def test_determine_session_settings_override_priority():
     cfg = {"model": "cfg-model", "dryrun": False}
-    model, dryrun = gptcode.determine_session_settings(cfg, model_override="override", dryrun_override=True)
+    model, dryrun = gptcode.determine_session_settings(
+        cfg, model_override="override", dryrun_override=True
+    )
     assert model == "override"
     assert dryrun is True
 
@@ -70,17 +78,29 @@ def test_docker_compose_resolves_variants(monkeypatch, scenario):
 
     def fake_run(cmd, stdout=None, stderr=None, text=None, **kwargs):
         calls.append(cmd)
-        if scenario == "plugin" and len(cmd) >= 3 and cmd[:3] == ["docker", "compose", "version"]:
-            return DummyResult(returncode=0, stdout="Docker Compose version v2.24.0", stderr="")
+        if (
+            scenario == "plugin"
+            and len(cmd) >= 3
+            and cmd[:3] == ["docker", "compose", "version"]
+        ):
+            return DummyResult(
+                returncode=0, stdout="Docker Compose version v2.24.0", stderr=""
+            )
         return DummyResult(returncode=0, stdout="ok", stderr="")
 
+    def fake_process(cmd, **kwargs):
+        calls.append(cmd)
+        return gptcode.ProcessResult(returncode=0, stdout="ok", stderr="")
+
     monkeypatch.setattr(gptcode.subprocess, "run", fake_run)
+    monkeypatch.setattr(gptcode, "run_process", fake_process)
 
     if scenario == "plugin":
         monkeypatch.setattr(gptcode.shutil, "which", lambda name: None)
         result = gptcode.docker_compose("logs", "web")
         assert calls[0][:3] == ["docker", "compose", "version"]
         assert calls[1][:2] == ["docker", "compose"]
+        assert result.startswith("[docker] logs web")
     else:
         candidate = "/usr/local/bin/docker-compose"
         monkeypatch.setenv("GPTCODE_DOCKER_COMPOSE_LEGACY", candidate)
@@ -93,8 +113,7 @@ def test_docker_compose_resolves_variants(monkeypatch, scenario):
         assert len(calls) == 1
         assert calls[0][0] == candidate
         assert "up" in calls[0]
-
-    assert "[docker] rc=0" in result
+        assert "[docker] rc=0" in result
 
 
 def test_docker_compose_returns_hint_when_disabled(monkeypatch):
@@ -102,3 +121,64 @@ def test_docker_compose_returns_hint_when_disabled(monkeypatch):
     gptcode._DOCKER_COMPOSE_CMD = None
     result = gptcode.docker_compose("logs")
     assert "Docker-Unterstützung ist deaktiviert" in result
+
+
+IMPORT_PROBE = """
+import importlib.util, sys
+path = sys.argv[1]
+spec = importlib.util.spec_from_file_location("gptcode", path)
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print("openai" in sys.modules, "asyncio" in sys.modules, "concurrent.futures.process" in sys.modules)
+"""
+
+
+def test_module_import_keeps_heavy_modules_lazy():
+    # Die Importzeit selbst misst `benchmarks/bench.py --workload startup`.
+    root = Path(__file__).resolve().parent.parent
+    out = subprocess.run(
+        [sys.executable, "-c", IMPORT_PROBE, str(root / "gptcode.py")],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+
+    assert out == ["False", "False", "False"]
+
+
+def test_runtime_probe_is_cached_until_path_changes(tmp_path, monkeypatch):
+    cache = tmp_path / "probe.json"
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    git = bindir / "git"
+    git.write_text("#!/bin/sh\n")
+    git.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bindir))
+    monkeypatch.delenv("GPTCODE_DOCKER_COMPOSE_LEGACY", raising=False)
+    monkeypatch.setattr(gptcode, "_PROBE", None)
+    monkeypatch.setattr(gptcode, "_PROBE_FILE", None)
+
+    first = gptcode.runtime_probe(cache)
+    assert first["binaries"]["git"] == str(git) and first["binaries"]["docker"] is None
+
+    scans = []
+    real_which = gptcode.shutil.which
+    monkeypatch.setattr(
+        gptcode.shutil, "which", lambda name: scans.append(name) or real_which(name)
+    )
+    monkeypatch.setattr(gptcode, "_PROBE", None)
+    assert gptcode.runtime_probe(cache)["binaries"] == first["binaries"]
+    assert scans == []
+
+    # Compose-Erkennung landet im Cache und erspart beim nächsten Start den Fork.
+    monkeypatch.setattr(gptcode, "_DOCKER_COMPOSE_CMD", None)
+    monkeypatch.setattr(
+        gptcode.subprocess, "run", lambda *a, **k: DummyResult(returncode=0)
+    )
+    assert gptcode.resolve_docker_compose_base() == ["docker", "compose"]
+    assert json.loads(cache.read_text())["compose"] == ["docker", "compose"]
+
+    os.utime(git, ns=(0, 0))
+    monkeypatch.setattr(gptcode, "_PROBE", None)
+    assert gptcode.runtime_probe(cache)["compose"] is None
+    assert "git" in scans
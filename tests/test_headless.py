@@ -0,0 +1,224 @@
+import asyncio
+import importlib.util
+import io
+import json
+import os
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+
+def load_gptcode_module():
+    root = Path(__file__).resolve().parent.parent
+    spec = importlib.util.spec_from_file_location("gptcode", root / "gptcode.py")
+    assert spec and spec.loader
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)  # type: ignore[assignment]
+    return module
+
+
+gptcode = load_gptcode_module()
+
+
+def _completion(content=None, tool_calls=(), usage=None):
+    calls = [
+        SimpleNamespace(
+            id=call_id, function=SimpleNamespace(name=name, arguments=arguments)
+        )
+        for call_id, name, arguments in tool_calls
+    ]
+    message = SimpleNamespace(content=content, tool_calls=calls or None)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+class FakeAsyncClient:
+    def __init__(self, *responses, delay=0.0):
+        self.responses = list(responses)
+        self.delay = delay
+        self.calls = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, **kwargs):
+        self.calls.append(kwargs)
+        await asyncio.sleep(self.delay)
+        return self.responses.pop(0)
+
+
+def test_async_headless_runs_subprocess_tools_concurrently(capsys, monkeypatch):
+    # Lesende Subprozess-Tools überlappen; schreibende ``run``-Calls wären Barrieren.
+    monkeypatch.setattr(gptcode, "TOOLS", dict(gptcode.TOOLS))
+    monkeypatch.setattr(gptcode, "_TOOL_SCHEMAS", None)
+
+    def plan(sess, args):
+        return gptcode._run_spec(args["cmd"], cwd=sess.workdir)
+
+    gptcode.register_tool(
+        "probe", "", {"cmd": {"type": "string"}}, read_only=True, process=plan
+    )(lambda sess, args: gptcode.execute_process(plan(sess, args)))
+    client = FakeAsyncClient(
+        _completion(
+            tool_calls=[
+                ("c1", "probe", '{"cmd": "sleep 0.6; echo eins"}'),
+                ("c2", "probe", '{"cmd": "sleep 0.6; echo zwei"}'),
+                ("c3", "list_dir", '{"path": "."}'),
+            ]
+        ),
+        _completion(content="Fertig."),
+    )
+    sess = gptcode.Session(client=None, model="m", async_client=client)
+    started = time.monotonic()
+    result = asyncio.run(gptcode.headless_loop_async(sess, "parallel", max_steps=5))
+    elapsed = time.monotonic() - started
+
+    assert (result.status, result.steps) == ("done", 2)
+    assert elapsed < 1.1
+    tool_messages = [m for m in sess.messages if m["role"] == "tool"]
+    assert [m["tool_call_id"] for m in tool_messages] == ["c1", "c2", "c3"]
+    assert (
+        "eins" in tool_messages[0]["content"] and "zwei" in tool_messages[1]["content"]
+    )
+    out = capsys.readouterr().out
+    assert out.index("eins") < out.index("zwei") < out.index("Fertig gemeldet nach 2")
+
+
+def test_async_headless_timeout_kills_child_processes(tmp_path, capsys):
+    pid_file = tmp_path / "child.pid"
+    client = FakeAsyncClient(
+        _completion(
+            tool_calls=[
+                (
+                    "c1",
+                    "run",
+                    '{"cmd": "sh -c \'echo $$ > %s; exec sleep 30\'"}' % pid_file,
+                )
+            ]
+        ),
+    )
+    sess = gptcode.Session(client=None, model="m", async_client=client)
+    started = time.monotonic()
+    assert (
+        asyncio.run(gptcode.headless_loop_async(sess, "hängt", timeout=1)).status
+        == "timeout"
+    )
+    assert time.monotonic() - started < 8
+    assert "Zeitlimit von 1s erreicht" in capsys.readouterr().out
+    pid = int(pid_file.read_text())
+    for _ in range(50):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.05)
+    else:
+        raise AssertionError("Kindprozess läuft noch")
+
+
+def test_goals_batch_isolates_cwd_and_reports_jsonl(tmp_path):
+    goals_file = tmp_path / "goals.jsonl"
+    dirs = [tmp_path / "a", tmp_path / "b"]
+    for d in dirs:
+        d.mkdir()
+    goals_file.write_text(
+        "# Kommentar\n"
+        + "\n".join(json.dumps({"goal": f"Ziel {d.name}", "cwd": str(d)}) for d in dirs)
+        + "\n"
+        + json.dumps({"goal": "fehlt", "cwd": str(tmp_path / "gibtsnicht")})
+        + "\n",
+        encoding="utf-8",
+    )
+    goals = gptcode.load_goals_file(str(goals_file))
+    usage = SimpleNamespace(prompt_tokens=10, completion_tokens=3)
+
+    def make_session(entry):
+        client = FakeAsyncClient(
+            _completion(
+                tool_calls=[
+                    ("c1", "write_file", '{"path": "marker.txt", "content": "x"}')
+                ],
+                usage=usage,
+            ),
+            _completion(content="Fertig.", usage=usage),
+        )
+        return gptcode.Session(
+            client=None, model="m", async_client=client, auto=True, cwd=entry["cwd"]
+        )
+
+    out = io.StringIO()
+    results = asyncio.run(
+        gptcode.run_goals_batch(goals, make_session, concurrency=2, out=out)
+    )
+
+    assert [r["status"] for r in results] == ["done", "done", "error"]
+    for d in dirs:
+        assert (d / "marker.txt").read_text() == "x"
+    assert not (tmp_path / "marker.txt").exists()
+    records = sorted(
+        (json.loads(line) for line in out.getvalue().splitlines()),
+        key=lambda r: r["index"],
+    )
+    assert records[0]["cwd"] == str(dirs[0]) and records[0]["steps"] == 2
+    assert records[0]["prompt_tokens"] == 20 and records[0]["completion_tokens"] == 6
+    assert "wall_time" in records[2] and "gibtsnicht" in records[2]["error"]
+
+
+def test_load_goals_file_reports_line_numbers(tmp_path):
+    path = tmp_path / "goals.jsonl"
+    path.write_text('{"goal": "ok"}\n{"cwd": "."}\n', encoding="utf-8")
+    try:
+        gptcode.load_goals_file(str(path))
+    except ValueError as e:
+        assert ":2:" in str(e)
+    else:
+        raise AssertionError("ValueError erwartet")
+
+
+def test_headless_loop_writes_trace_and_summary(tmp_path, capsys):
+    usage = SimpleNamespace(
+        prompt_tokens=12,
+        completion_tokens=4,
+        prompt_tokens_details=SimpleNamespace(cached_tokens=6),
+    )
+    responses = [
+        _completion(
+            tool_calls=[
+                ("c1", "read_file", json.dumps({"path": str(tmp_path / "a.txt")}))
+            ],
+            usage=usage,
+        ),
+        _completion(content="Fertig.", usage=usage),
+    ]
+    client = SimpleNamespace(
+        chat=SimpleNamespace(
+            completions=SimpleNamespace(create=lambda **kw: responses.pop(0))
+        )
+    )
+    (tmp_path / "a.txt").write_text("hallo\n", encoding="utf-8")
+    trace = io.StringIO()
+    sess = gptcode.Session(
+        client=client, model="m", auto=True, tracer=gptcode.Tracer(trace)
+    )
+
+    gptcode.headless_loop(sess, "lesen", max_steps=5)
+
+    spans = [json.loads(line) for line in trace.getvalue().splitlines()]
+    assert [(s["kind"], s["step"]) for s in spans] == [
+        ("model", 1),
+        ("tool", 1),
+        ("step", 1),
+        ("model", 2),
+        ("step", 2),
+    ]
+    tool = spans[1]
+    assert (
+        tool["name"] == "read_file" and tool["bytes_in"] > 0 and tool["bytes_out"] > 0
+    )
+    assert (
+        spans[0]["prompt_tokens"] == 12 and spans[3]["messages"] > spans[0]["messages"]
+    )
+    assert all(s["duration"] >= 0 and s["ts"] > 0 for s in spans)
+    out = capsys.readouterr().out
+    assert (
+        "[stats] 2 Schritte" in out
+        and "prompt 24 (50% aus Prompt-Cache), completion 8" in out
+        and "read_file" in out
+    )
@@ -0,0 +1,289 @@
+import importlib.util
+import sys
+import time
+from pathlib import Path
+
+
+def load_gptcode_module():
+    root = Path(__file__).resolve().parent.parent
+    spec = importlib.util.spec_from_file_location("gptcode", root / "gptcode.py")
+    assert spec and spec.loader
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)  # type: ignore[assignment]
+    return module
+
+
+gptcode = load_gptcode_module()
+
+
+def test_bounded_capture_keeps_head_and_tail():
+    capture = gptcode._BoundedCapture(head_bytes=10, tail_bytes=10)
+    for i in range(1000):
+        capture.write(f"{i:04d}\n".encode())
+    text = capture.text()
+    assert text.startswith("0000\n0001\n")
+    assert text.endswith("0998\n0999\n")
+    assert "[4980 Bytes / 996 Zeilen ausgelassen]" in text
+
+
+def test_run_process_streams_and_bounds_chatty_output(capsys):
+    script = "import sys\nfor i in range(200000): sys.stdout.write('x' * 99 + '\\n')\nsys.stderr.write('warn\\n')"
+    result = gptcode.run_process([sys.executable, "-c", script], timeout=30, echo=False)
+    assert result.returncode == 0
+    assert (
+        len(result.stdout)
+        < gptcode.CAPTURE_HEAD_BYTES + gptcode.CAPTURE_TAIL_BYTES + 200
+    )
+    assert "Zeilen ausgelassen" in result.stdout
+    assert result.stderr == "warn\n"
+
+    echoed = gptcode.run_process([sys.executable, "-c", "print('live')"], echo=True)
+    assert echoed.stdout == "live\n"
+    assert "live" in capsys.readouterr().err
+
+
+def test_run_process_enforces_timeout_while_streaming():
+    script = "import time\nprint('start', flush=True)\ntime.sleep(30)"
+    started = time.monotonic()
+    result = gptcode.run_process([sys.executable, "-c", script], timeout=1, echo=False)
+    assert time.monotonic() - started < 10
+    assert result.timed_out is True
+    assert result.stdout == "start\n"
+    assert "Timeout nach 1s" in gptcode.run("sleep 30", timeout=1)
+
+
+def test_shell_worker_keeps_state_between_commands(tmp_path):
+    worker = gptcode.ShellWorker(cwd=str(tmp_path))
+    try:
+        (tmp_path / "sub").mkdir()
+        first = worker.run("cd sub && export GREETING=hallo", echo=False)
+        assert first.returncode == 0
+        second = worker.run('pwd; echo "$GREETING"; echo fehler >&2; false', echo=False)
+        assert second.returncode == 1
+        assert second.stdout == f"{tmp_path / 'sub'}\nhallo\n"
+        assert second.stderr == "fehler\n"
+        assert worker.run("printf 'ohne newline'", echo=False).stdout == "ohne newline"
+        assert worker.run("if then", echo=False).returncode != 0
+        assert worker.run("echo noch da", echo=False).stdout == "noch da\n"
+    finally:
+        worker.close()
+
+
+def test_shell_worker_timeout_kills_and_restarts(tmp_path):
+    worker = gptcode.ShellWorker(cwd=str(tmp_path))
+    try:
+        worker.run("export KEEP=1", echo=False)
+        started = time.monotonic()
+        result = worker.run("echo los; sleep 30", timeout=1, echo=False)
+        assert time.monotonic() - started < 10
+        assert result.timed_out is True
+        assert result.stdout == "los\n"
+        after = worker.run('echo "[$KEEP]"', echo=False)
+        assert after.returncode == 0
+        assert after.stdout.endswith("[]\n")
+        assert "neu gestartet" in after.stdout
+    finally:
+        worker.close()
+
+
+def test_run_tool_uses_persistent_shell_when_enabled(tmp_path):
+    sess = gptcode.Session(client=None, model="m", persistent_shell=True)
+    try:
+        calls = [
+            gptcode.ToolCall("run", {"cmd": f"cd {tmp_path}"}),
+            gptcode.ToolCall("run", {"cmd": "pwd"}),
+        ]
+        results = gptcode.dispatch_tools(sess, calls)
+        assert results[1].startswith("[run] rc=0")
+        assert f"STDOUT:\n{tmp_path}\n" in results[1]
+    finally:
+        sess.close()
+
+
+def test_pytest_tool_runs_only_affected_tests_in_shards(tmp_path, monkeypatch):
+    monkeypatch.setattr(gptcode, "INDEX_DIR", tmp_path / "index")
+    monkeypatch.setattr(gptcode, "_PROJECT_INDEXES", {})
+    root = tmp_path / "proj"
+    (root / "src" / "pkg").mkdir(parents=True)
+    (root / "tests").mkdir()
+    (root / "src" / "pkg" / "__init__.py").write_text("")
+    (root / "src" / "pkg" / "calc.py").write_text("def add(a, b):\n    return a + b\n")
+    (root / "src" / "pkg" / "other.py").write_text("X = 1\n")
+    (root / "tests" / "conftest.py").write_text(
+        "import sys, pathlib\nsys.path.insert(0, str(pathlib.Path(__file__).parents[1] / 'src'))\n"
+    )
+    (root / "tests" / "test_calc.py").write_text(
+        "from pkg.calc import add\n\ndef test_ok():\n    assert add(1, 1) == 2\n\n"
+        "def test_kaputt():\n    assert add(1, 1) == 3\n"
+    )
+    (root / "tests" / "test_wrapper.py").write_text(
+        "from pkg import calc\n\ndef test_wrapped():\n    assert calc.add(2, 2) == 4\n"
+    )
+    (root / "tests" / "test_other.py").write_text(
+        "from pkg.other import X\n\ndef test_other():\n    assert X == 1\n"
+    )
+
+    sess = gptcode.Session(client=None, model="m", cwd=str(root))
+    gptcode.dispatch_tool(
+        sess,
+        "edit_file",
+        {"path": "src/pkg/calc.py", "edits": [{"search": "a + b", "replace": "b + a"}]},
+    )
+    out = gptcode.dispatch_tool(sess, "pytest", {"affected": True, "shards": 2})
+    lines = out.splitlines()
+    assert lines[0].startswith("[pytest] 2 Shard(s), 3 Tests")
+    assert (
+        "2 bestanden, 1 fehlgeschlagen" in lines[0]
+        and "betroffen: 2 Testdatei(en)" in lines[0]
+    )
+    assert lines[1] == "FEHLGESCHLAGEN tests/test_calc.py::test_kaputt"
+    assert "test_other" not in out and "passed" not in out
+
+    assert gptcode.affected_tests(
+        gptcode.project_index(str(root)), [str(root / "tests" / "conftest.py")]
+    ) == ["tests/test_calc.py", "tests/test_other.py", "tests/test_wrapper.py"]
+
+
+def test_pytest_tool_defaults_to_single_plain_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(gptcode, "INDEX_DIR", tmp_path / "index")
+    monkeypatch.setattr(gptcode, "_PROJECT_INDEXES", {})
+    (tmp_path / "check_x.py").write_text("def test_x():\n    assert True\n")
+    (tmp_path / "pytest.ini").write_text("[pytest]\npython_files = check_*.py\n")
+
+    plan = gptcode.plan_pytest(".", cwd=str(tmp_path))
+    assert isinstance(plan, gptcode.ProcessSpec) and plan.cmd == ["pytest", "-q", "."]
+    assert not (tmp_path / "index").exists()
+    sess = gptcode.Session(client=None, model="m", cwd=str(tmp_path))
+    assert gptcode.dispatch_tool(sess, "pytest", {}).startswith("[pytest] rc=0")
+
+
+FAKE_COMPOSE = r"""#!/usr/bin/env python3
+import sys, time
+args = sys.argv[1:]
+log = [l.rstrip("\n") for l in open(sys.argv[0] + ".log")]
+since = args[args.index("--since") + 1] if "--since" in args else None
+tail = int(args[args.index("--tail") + 1]) if "--tail" in args else None
+lines = [l for l in log if since is None or l.split(" ", 1)[0] >= since]
+for line in lines[-tail:] if tail else lines:
+    print(line, flush=True)
+if "--follow" in args:
+    for i in range(3):
+        time.sleep(0.2)
+        print(f"2024-05-01T10:00:0{5 + i}.000000000Z tick {i}", flush=True)
+    print("2024-05-01T10:00:09.000000000Z web is healthy", flush=True)
+    time.sleep(30)
+"""
+
+
+def test_docker_logs_cursor_and_follow_until(tmp_path, monkeypatch):
+    fake = tmp_path / "fake-compose"
+    fake.write_text(FAKE_COMPOSE)
+    fake.chmod(0o755)
+    log = tmp_path / "fake-compose.log"
+    log.write_text(
+        "2024-05-01T10:00:01.000000000Z start\n2024-05-01T10:00:02.500000000Z listening\n"
+    )
+    monkeypatch.setenv("GPTCODE_DOCKER_COMPOSE_LEGACY", str(fake))
+    monkeypatch.setattr(gptcode, "_DOCKER_COMPOSE_CMD", None)
+    monkeypatch.setattr(gptcode, "DOCKER_FEATURES_AVAILABLE", True)
+    sess = gptcode.Session(client=None, model="m", cwd=str(tmp_path))
+
+    first = gptcode.dispatch_tool(sess, "docker", {"action": "logs", "service": "web"})
+    assert first.splitlines() == [
+        "[docker] logs web, 2 neue Zeile(n)",
+        "start",
+        "listening",
+    ]
+    assert gptcode.dispatch_tool(
+        sess, "docker", {"action": "logs", "service": "web"}
+    ).startswith(
+        "[docker] logs web, 0 neue Zeile(n) seit 2024-05-01T10:00:02.500000000Z"
+    )
+
+    with log.open("a") as fh:
+        fh.write("2024-05-01T10:00:03.000000000Z request GET /\n")
+    third = gptcode.dispatch_tool(sess, "docker", {"action": "logs", "service": "web"})
+    assert third.splitlines()[1:] == ["request GET /"]
+
+    # Zeilen im selben Zeitstempel wie der Cursor (--since liefert ihn erneut) gehen nicht verloren.
+    with log.open("a") as fh:
+        fh.write(
+            "2024-05-01T10:00:03.000000000Z request GET /a\n2024-05-01T10:00:03.000000000Z request GET /b\n"
+        )
+    burst = gptcode.dispatch_tool(sess, "docker", {"action": "logs", "service": "web"})
+    assert burst.splitlines()[1:] == ["request GET /a", "request GET /b"]
+    assert sess.log_cursors[f"{tmp_path}::web"] == ("2024-05-01T10:00:03.000000000Z", 3)
+    assert ", 0 neue Zeile(n)" in gptcode.dispatch_tool(
+        sess, "docker", {"action": "logs", "service": "web"}
+    )
+
+    started = time.monotonic()
+    follow = gptcode.dispatch_tool(
+        sess,
+        "docker",
+        {"action": "logs", "service": "web", "until": "healthy", "follow_seconds": 20},
+    )
+    assert time.monotonic() - started < 5
+    assert "Muster 'healthy' gefunden" in follow
+    assert follow.splitlines()[1:] == ["tick 0", "tick 1", "tick 2", "web is healthy"]
+    assert sess.log_cursors[f"{tmp_path}::web"] == ("2024-05-01T10:00:09.000000000Z", 1)
+
+
+FAKE_SYSTEMCTL = r"""#!/bin/sh
+echo "$@" >> "$0.calls"
+if [ "$1" = "show" ]; then
+  printf 'Id=nginx.service\nLoadState=loaded\nActiveState=active\nSubState=running\nMainPID=812\nExecMainStatus=0\nResult=success\nUnitFileState=enabled\n\n'
+  printf 'Id=worker.service\nLoadState=loaded\nActiveState=failed\nSubState=failed\nMainPID=0\nExecMainStatus=1\nResult=exit-code\nUnitFileState=enabled\n\n'
+  printf 'Id=tippfehler.service\nLoadState=not-found\nActiveState=inactive\nSubState=dead\nMainPID=0\nExecMainStatus=0\nResult=success\nUnitFileState=\n'
+else
+  echo "x worker.service - Worker"
+  echo "   Active: failed (Result: exit-code)"
+fi
+"""
+
+
+def test_systemctl_status_renders_table_and_details_only_for_failed(
+    tmp_path, monkeypatch
+):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    fake = bin_dir / "systemctl"
+    fake.write_text(FAKE_SYSTEMCTL)
+    fake.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{gptcode.os.environ['PATH']}")
+    sess = gptcode.Session(client=None, model="m")
+
+    out = gptcode.dispatch_tool(
+        sess,
+        "systemctl",
+        {"action": "status", "units": ["nginx*", "worker.service", "tippfehler"]},
+    )
+    lines = out.splitlines()
+    assert lines[0] == "[systemctl] 3 Unit(s), 2 fehlerhaft"
+    assert lines[1].split() == [
+        "UNIT",
+        "LOAD",
+        "ACTIVE",
+        "SUB",
+        "PID",
+        "EXIT",
+        "RESULT",
+        "ENABLED",
+    ]
+    assert lines[2].split() == [
+        "nginx.service",
+        "loaded",
+        "active",
+        "running",
+        "812",
+        "0",
+        "success",
+        "enabled",
+    ]
+    assert lines[4].split()[:3] == ["tippfehler.service", "not-found", "inactive"]
+    assert "Active: failed" in out
+    calls = (bin_dir / "systemctl.calls").read_text().splitlines()
+    assert calls[0].startswith("show --no-pager -p Id,LoadState,") and calls[
+        0
+    ].endswith("-- nginx* worker.service tippfehler")
+    assert calls[1] == "status --no-pager --lines 15 -- worker.service"
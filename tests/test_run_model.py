@@ -0,0 +1,596 @@
+import importlib.util
+import io
+import json
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+
+def load_gptcode_module():
+    root = Path(__file__).resolve().parent.parent
+    spec = importlib.util.spec_from_file_location("gptcode", root / "gptcode.py")
+    assert spec and spec.loader
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)  # type: ignore[assignment]
+    return module
+
+
+gptcode = load_gptcode_module()
+
+
+def _chunk(text, tool_calls=None):
+    return SimpleNamespace(
+        choices=[
+            SimpleNamespace(delta=SimpleNamespace(content=text, tool_calls=tool_calls))
+        ]
+    )
+
+
+class FakeStream:
+    def __init__(self, pieces):
+        self.pieces = list(pieces)
+        self.consumed = 0
+        self.closed = False
+
+    def __iter__(self):
+        for piece in self.pieces:
+            self.consumed += 1
+            yield piece if isinstance(piece, SimpleNamespace) else _chunk(piece)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClient:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        self.calls.append(kwargs)
+        return self.responses.pop(0)
+
+
+def _completion(content=None, tool_calls=()):
+    calls = [
+        SimpleNamespace(
+            id=call_id, function=SimpleNamespace(name=name, arguments=arguments)
+        )
+        for call_id, name, arguments in tool_calls
+    ]
+    message = SimpleNamespace(content=content, tool_calls=calls or None)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def test_streaming_prints_prose_incrementally(capsys):
+    stream = FakeStream(["Hallo ", "Welt", "!"])
+    sess = gptcode.Session(client=FakeClient(stream), model="m", stream=True)
+    reply = gptcode.run_model(sess)
+    assert reply.text == "Hallo Welt!"
+    assert reply.streamed is True
+    assert capsys.readouterr().out == "Hallo Welt!\n"
+    assert sess.client.calls[0]["stream"] is True
+    gptcode.show_reply(reply)
+    assert capsys.readouterr().out == ""
+
+
+def test_streaming_cuts_off_after_complete_tool_call(capsys):
+    pieces = [
+        '  {"tool": "run", ',
+        '"args": {"cmd": "echo }"}',
+        "}",
+        " Nachtext",
+        " mehr",
+    ]
+    stream = FakeStream(pieces)
+    sess = gptcode.Session(
+        client=FakeClient(stream), model="m", stream=True, native_tools=False
+    )
+    reply = gptcode.run_model(sess)
+    assert [(c.name, c.args) for c in reply.tool_calls] == [("run", {"cmd": "echo }"})]
+    assert stream.consumed == 3
+    assert stream.closed is True
+    assert reply.streamed is False
+    assert capsys.readouterr().out == ""
+
+
+def _history(steps, size=4000):
+    messages = [{"role": "user", "content": "Ziel: Logs prüfen"}]
+    for i in range(steps):
+        messages.append(
+            {
+                "role": "assistant",
+                "content": f'{{"tool": "read_file", "args": {{"path": "f{i}"}}}}',
+            }
+        )
+        messages.append(
+            {"role": "user", "content": "ERGEBNIS (read_file):\n" + ("x" * size)}
+        )
+    return messages
+
+
+def test_context_manager_keeps_request_size_flat():
+    ctx = gptcode.ContextManager(max_tokens=3000, keep_turns=4, tool_output_chars=400)
+    sizes = []
+    for steps in (10, 40, 80):
+        prepared = ctx.prepare(_history(steps))
+        sizes.append(sum(ctx.count(m) for m in prepared))
+        assert prepared[0]["content"] == "Ziel: Logs prüfen"
+        assert prepared[-1]["content"].endswith("x" * 100)
+        assert any("ausgelassen" in m["content"] for m in prepared)
+    assert max(sizes) <= 3000
+    assert max(sizes) - min(sizes) < 600
+
+
+def test_context_manager_caches_counts_and_summarizes_incrementally(monkeypatch):
+    ctx = gptcode.ContextManager(
+        max_tokens=2000, keep_turns=2, tool_output_chars=200, summarize=True
+    )
+    messages = _history(20)
+    calls = []
+    real_tokens = ctx.tokens
+
+    def counting_tokens(text):
+        calls.append(len(text))
+        return real_tokens(text)
+
+    monkeypatch.setattr(ctx, "tokens", counting_tokens)
+    summaries = []
+
+    def summarizer(transcript):
+        summaries.append(transcript)
+        return f"Zusammenfassung {len(summaries)}"
+
+    first = ctx.prepare(messages, summarizer=summarizer)
+    tokenized = len(calls)
+    second = ctx.prepare(messages, summarizer=summarizer)
+    assert len(calls) == tokenized
+    assert first == second
+    assert len(summaries) == 1
+    assert "Zusammenfassung 1" in first[1]["content"]
+
+    messages.extend(_history(3)[1:])
+    ctx.prepare(messages, summarizer=summarizer)
+    assert len(summaries) == 2
+    assert summaries[1].startswith("Bisherige Zusammenfassung:\nZusammenfassung 1")
+
+    # Nur Nachrichten im aktuellen Verlauf bleiben im Cache (kein Wachstum über die Sitzung).
+    del messages[1:-4]
+    ctx.prepare(messages)
+    assert len(ctx._counts) <= len(messages) and len(ctx._truncated) <= len(messages)
+
+
+def test_tool_schemas_are_generated_from_registry():
+    names = [entry["function"]["name"] for entry in gptcode.tool_schemas()]
+    assert {
+        "list_dir",
+        "read_file",
+        "write_file",
+        "apply_patch",
+        "run",
+        "tail_file",
+        "systemctl",
+        "docker",
+        "pytest",
+    } <= set(names)
+    run_schema = next(
+        e for e in gptcode.tool_schemas() if e["function"]["name"] == "run"
+    )
+    assert run_schema["function"]["parameters"]["required"] == ["cmd"]
+    assert "run:{cmd,timeout?,env?}" in gptcode.text_protocol_hint()
+
+
+def test_headless_loop_executes_parallel_native_tool_calls(tmp_path, capsys):
+    for name in ("a.txt", "b.txt"):
+        (tmp_path / name).write_text(f"inhalt {name}")
+    client = FakeClient(
+        _completion(
+            tool_calls=[
+                ("call_1", "read_file", '{"path": "%s"}' % (tmp_path / "a.txt")),
+                ("call_2", "read_file", '{"path": "%s"}' % (tmp_path / "b.txt")),
+                ("call_3", "read_file", "{kaputt"),
+            ]
+        ),
+        _completion(content="Alles fertig."),
+    )
+    sess = gptcode.Session(client=client, model="m")
+    gptcode.headless_loop(sess, "lesen", max_steps=5)
+
+    assert client.calls[0]["tools"] == gptcode.tool_schemas()
+    assert client.calls[0]["parallel_tool_calls"] is True
+    roles = [m["role"] for m in sess.messages]
+    assert roles == ["user", "assistant", "tool", "tool", "tool", "assistant"]
+    assert [c["id"] for c in sess.messages[1]["tool_calls"]] == [
+        "call_1",
+        "call_2",
+        "call_3",
+    ]
+    assert sess.messages[2] == {
+        "role": "tool",
+        "tool_call_id": "call_1",
+        "content": "inhalt a.txt",
+    }
+    assert "kein gültiges JSON" in sess.messages[4]["content"]
+    assert client.calls[1]["messages"][-4]["tool_call_id"] == "call_1"
+    assert "Fertig gemeldet nach 2" in capsys.readouterr().out
+
+
+def test_streaming_accumulates_native_tool_call_deltas():
+    def delta(index, call_id=None, name=None, arguments=None):
+        fn = SimpleNamespace(name=name, arguments=arguments)
+        return _chunk(None, [SimpleNamespace(index=index, id=call_id, function=fn)])
+
+    stream = FakeStream(
+        [
+            delta(0, "c0", "list_dir", '{"pa'),
+            delta(1, "c1", "tail_file", '{"path": "x.log"'),
+            delta(0, arguments='th": "."}'),
+            delta(1, arguments=', "lines": 5}'),
+        ]
+    )
+    sess = gptcode.Session(client=FakeClient(stream), model="m", stream=True)
+    reply = gptcode.run_model(sess)
+    assert [(c.id, c.name, c.args) for c in reply.tool_calls] == [
+        ("c0", "list_dir", {"path": "."}),
+        ("c1", "tail_file", {"path": "x.log", "lines": 5}),
+    ]
+    assert reply.native is True
+
+
+def test_response_cache_serves_repeated_requests_and_evicts_lru(tmp_path):
+    cache = gptcode.ResponseCache(tmp_path / "cache", max_bytes=10_000)
+    client = FakeClient(_completion(content="Antwort eins"))
+    sess = gptcode.Session(client=client, model="m", response_cache=cache)
+    sess.add("user", "Frage")
+    first = gptcode.run_model(sess)
+    second = gptcode.run_model(
+        gptcode.Session(
+            client=FakeClient(),
+            model="m",
+            response_cache=cache,
+            messages=list(sess.messages),
+        )
+    )
+    assert first.text == second.text == "Antwort eins"
+    assert len(client.calls) == 1 and cache.hits == 1
+
+    cache.max_bytes = 1
+    cache.put("neu", gptcode.ModelReply(text="x"))
+    assert [p.name for p in (tmp_path / "cache").iterdir()] == []
+
+
+def test_cassette_records_and_replays_headless_run_offline(tmp_path, capsys):
+    cassette_path = tmp_path / "run.jsonl"
+    target = tmp_path / "a.txt"
+    target.write_text("inhalt")
+    client = FakeClient(
+        _completion(tool_calls=[("c1", "read_file", '{"path": "%s"}' % target)]),
+        _completion(content="Fertig."),
+    )
+    recorder = gptcode.Cassette(str(cassette_path), "record")
+    gptcode.headless_loop(
+        gptcode.Session(client=client, model="m", cassette=recorder),
+        "lesen",
+        max_steps=5,
+    )
+    recorder.close()
+
+    replayed = gptcode.Session(
+        client=FakeClient(),
+        model="m",
+        cassette=gptcode.Cassette(str(cassette_path), "replay"),
+    )
+    gptcode.headless_loop(replayed, "lesen", max_steps=5)
+    assert [m["role"] for m in replayed.messages] == [
+        "user",
+        "assistant",
+        "tool",
+        "assistant",
+    ]
+    assert replayed.messages[2]["content"] == "inhalt"
+    try:
+        gptcode.run_model(replayed)
+    except gptcode.CassetteError:
+        pass
+    else:
+        raise AssertionError("CassetteError erwartet")
+
+
+def test_cassette_replays_batch_goals_only_from_their_own_entries(tmp_path):
+    path = tmp_path / "batch.jsonl"
+    recorder = gptcode.Cassette(str(path), "record")
+    recorder.for_goal(1).record("k1", gptcode.ModelReply(text="Ziel 1"))
+    recorder.for_goal(0).record("k0", gptcode.ModelReply(text="Ziel 0"))
+    recorder.close()
+
+    cassette = gptcode.Cassette(str(path), "replay")
+    for goal, key in (
+        (0, "k1"),
+        (0, "anders"),
+    ):  # kein Rückfall auf fremde Ziele oder die Reihenfolge
+        try:
+            cassette.for_goal(goal).replay(key)
+        except gptcode.CassetteError:
+            pass
+        else:
+            raise AssertionError("CassetteError erwartet")
+    assert cassette.for_goal(0).replay("k0").text == "Ziel 0"
+    assert (
+        gptcode.Cassette(str(path), "replay").replay("anders").text == "Ziel 1"
+    )  # Einzellauf: Reihenfolge
+
+
+def test_result_store_references_repeats_diffs_changes_and_spills_large_output(
+    tmp_path,
+):
+    log = tmp_path / "app.log"
+    log.write_text("".join(f"zeile {i}\n" for i in range(200)))
+    big = tmp_path / "big.txt"
+    big.write_text("".join(f"eintrag {i:05d}\n" for i in range(3000)))
+    sess = gptcode.Session(
+        client=None, model="m", results=gptcode.ResultStore(spill_chars=8000)
+    )
+    sess.add("user", "Ziel: Logs prüfen")
+
+    def step(name, args):
+        call = gptcode.ToolCall(name=name, args=args, id=f"c{len(sess.messages)}")
+        reply = gptcode.ModelReply(tool_calls=[call])
+        sess.record_tool_results(reply, gptcode.dispatch_tools(sess, [call]))
+        return sess.messages[-1]["content"]
+
+    first = step("read_file", {"path": str(log)})
+    assert first.startswith("zeile 0")
+    repeat = step("read_file", {"path": str(log)})
+    assert (
+        repeat.startswith("[Ergebnis #") and "Identisch" in repeat and len(repeat) < 300
+    )
+
+    log.write_text(log.read_text().replace("zeile 100\n", "zeile 100 GEÄNDERT\n"))
+    changed = step("read_file", {"path": str(log)})
+    assert (
+        "Fast identisch" in changed
+        and "+zeile 100 GEÄNDERT" in changed
+        and len(changed) < 400
+    )
+
+    spilled = step("read_file", {"path": str(big), "start_line": 1, "end_line": 3000})
+    spill_path = spilled.rsplit("vollständig in ", 1)[1].split(" – ")[0]
+    assert len(spilled) < 4000 and Path(spill_path).read_text().count("eintrag") == 3000
+    assert sess.results.saved_chars > 20000
+
+    sess.close()
+    assert not Path(spill_path).exists()
+
+
+def test_result_store_repeats_full_text_once_original_left_the_window():
+    store = gptcode.ResultStore()
+    text = "ausgabe\n" * 100
+    assert store.compact("run", {"cmd": "ls"}, text, index=3, verbatim_from=0) == text
+    assert store.compact(
+        "run", {"cmd": "ls"}, text, index=9, verbatim_from=2
+    ).startswith("[Ergebnis #")
+    assert store.compact("run", {"cmd": "ls"}, text, index=20, verbatim_from=10) == text
+
+
+def test_prefetch_runs_read_only_calls_before_confirmation(tmp_path, capsys):
+    target = tmp_path / "a.txt"
+    target.write_text("inhalt a")
+    read_call = [("call_1", "read_file", '{"path": "%s"}' % target)]
+    client = FakeClient(
+        _completion(tool_calls=read_call), _completion(content="Gelesen.")
+    )
+    sess = gptcode.Session(client=client, model="m", read_only_policy="prefetch")
+    sess.add("user", "lesen")
+    gptcode.handle_reply(sess, gptcode.run_model(sess))
+
+    assert sess.pending_action is not None and sess.prefetch is not None
+    assert sess.prefetch.futures[0].result(timeout=5) == "inhalt a"
+    assert len(client.calls) == 1  # Ergebnisse gehen erst nach :yes an die API
+    assert sess.messages[-1]["role"] == "user"  # echter Verlauf unverändert
+
+    reply, sess.pending_action = sess.pending_action, None
+    gptcode.confirm_reply(sess, reply)
+    assert len(client.calls) == 2
+    assert [m["role"] for m in sess.messages] == [
+        "user",
+        "assistant",
+        "tool",
+        "assistant",
+    ]
+    assert sess.messages[2]["content"] == "inhalt a"
+    assert sess.messages[-1]["content"] == "Gelesen."
+    assert sess.prefetch is None
+
+    # Schreibende Calls laufen nie vorab; :auto gibt rein lesende Schritte frei.
+    write_call = [("call_2", "write_file", '{"path": "%s", "content": "neu"}' % target)]
+    client.responses = [
+        _completion(tool_calls=read_call),
+        _completion(tool_calls=write_call),
+    ]
+    sess.read_only_policy = "auto"
+    sess.add("user", "weiter")
+    gptcode.handle_reply(sess, gptcode.run_model(sess))
+    assert "[auto] Nur lesende Aktionen" in capsys.readouterr().out
+    assert sess.pending_action.tool_calls[0].name == "write_file"
+    assert sess.prefetch is not None and not sess.prefetch.futures
+    gptcode.decline_reply(sess, sess.pending_action)
+    assert sess.prefetch is None and target.read_text() == "inhalt a"
+
+
+def test_prefetch_keeps_call_order_between_reads_and_writes(tmp_path, monkeypatch):
+    target = tmp_path / "a.txt"
+    read = ("call_r", "read_file", json.dumps({"path": str(target)}))
+    write = (
+        "call_w",
+        "write_file",
+        json.dumps({"path": str(target), "content": "neu"}),
+    )
+    real_execute = gptcode._execute_call
+
+    def slow_read(sess, call):
+        if call.name == "read_file":
+            time.sleep(
+                0.2
+            )  # ein paralleler Schreiber würde die Datei jetzt schon ändern
+        return real_execute(sess, call)
+
+    monkeypatch.setattr(gptcode, "_execute_call", slow_read)
+    for calls, expected in (([read, write], "alt"), ([write, read], "neu")):
+        target.write_text("alt")
+        client = FakeClient(
+            _completion(tool_calls=calls), _completion(content="Fertig.")
+        )
+        sess = gptcode.Session(client=client, model="m", read_only_policy="prefetch")
+        sess.add("user", "los")
+        gptcode.handle_reply(sess, gptcode.run_model(sess))
+        assert sorted(sess.prefetch.futures) == ([0] if calls[0] is read else [])
+
+        reply, sess.pending_action = sess.pending_action, None
+        gptcode.confirm_reply(sess, reply)
+        read_result = next(
+            m["content"] for m in sess.messages if m.get("tool_call_id") == "call_r"
+        )
+        assert read_result == expected and target.read_text() == "neu"
+
+
+def test_request_keeps_prefix_stable_and_moves_cwd_to_the_end(tmp_path):
+    (tmp_path / "sub").mkdir()
+    sess = gptcode.Session(client=None, model="m", cwd=str(tmp_path))
+    sess.add("user", "hallo")
+    first = gptcode._build_request(sess)
+    sess.cwd = str(tmp_path / "sub")
+    sess.add("assistant", "ok")
+    second = gptcode._build_request(sess)
+
+    assert str(tmp_path) not in first["messages"][0]["content"]
+    assert (
+        first["messages"][0] == second["messages"][0]
+        and first["tools"] == second["tools"]
+    )
+    assert first["messages"][-1] == {
+        "role": "system",
+        "content": f"Arbeitsverzeichnis: {tmp_path}",
+    }
+    assert second["messages"][-1]["content"].endswith("sub")
+    assert second["messages"][:-2] == first["messages"][:-1]
+
+
+def test_rate_pacer_pauses_after_429_and_exhausted_quota():
+    now = [100.0]
+    pacer = gptcode.RatePacer(clock=lambda: now[0])
+    pacer.observe(200, {"x-ratelimit-remaining-requests": "7"})
+    assert pacer.delay() == 0
+
+    pacer.observe(429, {"retry-after-ms": "250"})
+    assert pacer.delay() == 0.25
+    pacer.observe(
+        200,
+        {"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "1m30s"},
+    )
+    assert pacer.delay() == 60.0  # gedeckelt
+    now[0] += 61
+    assert pacer.delay() == 0 and pacer.pauses == 2
+    assert (
+        gptcode._parse_reset("6m0.5s") == 360.5
+        and gptcode._parse_reset("120ms") == 0.12
+    )
+    assert gptcode.http_options({"max_retries": 9, "unbekannt": 1})["max_retries"] == 9
+
+
+def test_router_uses_fast_model_after_small_read_steps_and_escalates_bad_calls(
+    tmp_path, capsys
+):
+    (tmp_path / "a.txt").write_text("inhalt a")
+    read_call = ("call_1", "read_file", '{"path": "%s"}' % (tmp_path / "a.txt"))
+    client = FakeClient(
+        _completion(tool_calls=[read_call]),  # Ziel → Hauptmodell
+        _completion(
+            tool_calls=[("call_2", "read_file", "{kaputt")]
+        ),  # schnell, unlesbar → eskalieren
+        _completion(tool_calls=[("call_3", "run", '{"cmd": "true"}')]),
+        _completion(content="Fertig."),  # nach run → Hauptmodell
+    )
+    trace = io.StringIO()
+    sess = gptcode.Session(
+        client=client,
+        model="gross",
+        cwd=str(tmp_path),
+        tracer=gptcode.Tracer(trace),
+        router=gptcode.ModelRouter.from_config({"routing": {"fast_model": "klein"}}),
+    )
+    gptcode.headless_loop(sess, "lesen", max_steps=5)
+
+    assert [c["model"] for c in client.calls] == ["gross", "klein", "gross", "gross"]
+    routes = [
+        json.loads(line)["route"]
+        for line in trace.getvalue().splitlines()
+        if '"kind": "model"' in line
+    ]
+    assert routes == ["main", "fast", "escalated", "main"]
+    assert "Modelle: gross 3×" in capsys.readouterr().out
+
+    assert (
+        gptcode.ModelRouter.from_config(
+            {"routing": {"fast_model": "klein"}}, "off"
+        ).fast_model
+        is None
+    )
+    big = {"role": "tool", "tool_call_id": "x", "content": "[run] rc=1\nSTDOUT:\n"}
+    sess.messages += [
+        {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [
+                {
+                    "id": "x",
+                    "type": "function",
+                    "function": {"name": "read_file", "arguments": "{}"},
+                }
+            ],
+        },
+        big,
+    ]
+    assert sess.router.choose(sess) == (
+        "gross",
+        "main",
+    )  # Fehler im Ergebnis → Hauptmodell
+
+    for action, route in (("restart", "main"), ("status", "fast")):
+        sess.messages += [
+            {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": "y",
+                        "type": "function",
+                        "function": {
+                            "name": "systemctl",
+                            "arguments": json.dumps(
+                                {"action": action, "unit": "nginx"}
+                            ),
+                        },
+                    }
+                ],
+            },
+            {
+                "role": "tool",
+                "tool_call_id": "y",
+                "content": "[systemctl] rc=0\nSTDOUT:\n",
+            },
+        ]
+        assert (
+            sess.router.choose(sess)[1] == route
+        )  # nur lesende Argumente → schnelles Modell
+    for name, route in (
+        ("systemctl", "main"),
+        ("read_file", "fast"),
+    ):  # Textprotokoll: Argumente unbekannt
+        sess.messages = [
+            {
+                "role": "user",
+                "content": f"{gptcode.TOOL_RESULT_PREFIX}{name}):\n[{name}] ok",
+            }
+        ]
+        assert sess.router.choose(sess)[1] == route
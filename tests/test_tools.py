@@ -0,0 +1,443 @@
+import importlib.util
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+
+def load_gptcode_module():
+    root = Path(__file__).resolve().parent.parent
+    spec = importlib.util.spec_from_file_location("gptcode", root / "gptcode.py")
+    assert spec and spec.loader
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)  # type: ignore[assignment]
+    return module
+
+
+gptcode = load_gptcode_module()
+
+
+@pytest.fixture
+def sess():
+    return gptcode.Session(client=None, model="m")
+
+
+@pytest.fixture
+def slow_tools(monkeypatch):
+    monkeypatch.setattr(gptcode, "TOOLS", dict(gptcode.TOOLS))
+    log = []
+    active = {"now": 0, "peak": 0}
+    guard = threading.Lock()
+
+    def make(name, delay):
+        def handler(sess, args):
+            with guard:
+                active["now"] += 1
+                active["peak"] = max(active["peak"], active["now"])
+                log.append(("start", name, args.get("path")))
+            time.sleep(delay)
+            with guard:
+                active["now"] -= 1
+                log.append(("end", name, args.get("path")))
+            return f"{name}:{args.get('path')}"
+
+        return handler
+
+    gptcode.register_tool(
+        "slow_read",
+        "",
+        {"path": {"type": "string"}},
+        read_only=True,
+        lock_keys=lambda s, a: [a["path"]],
+    )(make("slow_read", 0.2))
+    gptcode.register_tool(
+        "slow_write",
+        "",
+        {"path": {"type": "string"}},
+        lock_keys=lambda s, a: [a["path"]],
+    )(make("slow_write", 0.2))
+    gptcode.register_tool(
+        "single", "", {"path": {"type": "string"}}, read_only=True, max_concurrency=1
+    )(make("single", 0.05))
+    return log, active
+
+
+def test_dispatch_tools_runs_independent_calls_concurrently(sess, slow_tools):
+    calls = [gptcode.ToolCall("slow_read", {"path": f"f{i}"}) for i in range(6)]
+    started = time.monotonic()
+    results = gptcode.dispatch_tools(sess, calls)
+    elapsed = time.monotonic() - started
+    assert results == [f"slow_read:f{i}" for i in range(6)]
+    assert elapsed < 0.6
+    assert slow_tools[1]["peak"] > 1
+
+
+def test_dispatch_tools_orders_conflicting_calls(sess, slow_tools):
+    log, _ = slow_tools
+    calls = [
+        gptcode.ToolCall("slow_write", {"path": "a"}),
+        gptcode.ToolCall("slow_read", {"path": "a"}),
+        gptcode.ToolCall("slow_read", {"path": "b"}),
+        gptcode.ToolCall("nope", {}),
+    ]
+    results = gptcode.dispatch_tools(sess, calls)
+    assert results[:3] == ["slow_write:a", "slow_read:a", "slow_read:b"]
+    assert results[3] == "Unbekanntes Tool: nope"
+    assert log.index(("end", "slow_write", "a")) < log.index(
+        ("start", "slow_read", "a")
+    )
+    assert log.index(("start", "slow_read", "b")) < log.index(
+        ("end", "slow_write", "a")
+    )
+
+
+def test_dispatch_tools_treats_keyless_writers_as_barriers(sess, tmp_path):
+    sess.cwd = str(tmp_path)
+    calls = [
+        gptcode.ToolCall("run", {"cmd": "sleep 0.3; mkdir sub"}),
+        gptcode.ToolCall("write_file", {"path": "sub/a.txt", "content": "x"}),
+        gptcode.ToolCall("run", {"cmd": "ls sub"}),
+    ]
+    assert gptcode._call_dependencies(sess, calls) == [set(), {0}, {0, 1}]
+    results = gptcode.dispatch_tools(sess, calls)
+    assert "rc=0" in results[0] and (tmp_path / "sub" / "a.txt").read_text() == "x"
+    assert "a.txt" in results[2]
+
+
+def test_dispatch_tools_respects_max_concurrency(sess, slow_tools):
+    calls = [gptcode.ToolCall("single", {"path": str(i)}) for i in range(4)]
+    assert gptcode.dispatch_tools(sess, calls) == [f"single:{i}" for i in range(4)]
+    assert slow_tools[1]["peak"] == 1
+
+
+@pytest.mark.parametrize("trailing_newline", (True, False))
+def test_tail_file_reads_only_needed_blocks(tmp_path, monkeypatch, trailing_newline):
+    monkeypatch.setattr(gptcode, "TAIL_BLOCK_SIZE", 128)
+    log = tmp_path / "app.log"
+    body = "".join(f"zeile {i}\n" for i in range(5000))
+    log.write_text(body if trailing_newline else body.rstrip("\n"))
+    expected = "".join(log.read_text().splitlines(keepends=True)[-25:])
+    reads = []
+    real_open = Path.open
+
+    def tracking_open(self, *args, **kwargs):
+        handle = real_open(self, *args, **kwargs)
+        real_read = handle.read
+        handle.read = lambda n=-1: reads.append(n) or real_read(n)
+        return handle
+
+    monkeypatch.setattr(gptcode.Path, "open", tracking_open)
+    assert gptcode.tail_file(str(log), lines=25) == expected
+    assert sum(reads) < 1024
+
+
+def test_tail_file_follow_returns_only_appended_data(tmp_path):
+    log = tmp_path / "svc.log"
+    log.write_text("a\nb\n")
+    cursors = {}
+    assert gptcode.tail_file(str(log), lines=1, follow=True, cursors=cursors) == "b\n"
+    assert "Keine neuen Daten" in gptcode.tail_file(
+        str(log), follow=True, cursors=cursors
+    )
+    with log.open("a") as f:
+        f.write("c\nd\n")
+    assert gptcode.tail_file(str(log), follow=True, cursors=cursors) == "c\nd\n"
+    log.write_text("neu\n")
+    result = gptcode.tail_file(str(log), lines=5, follow=True, cursors=cursors)
+    assert "rotiert oder gekürzt" in result
+    assert result.endswith("neu\n")
+
+
+def test_read_file_caps_large_files_and_reports_remaining_lines(tmp_path, monkeypatch):
+    monkeypatch.setattr(gptcode, "READ_FILE_MMAP_THRESHOLD", 1024)
+    target = tmp_path / "big.lock"
+    target.write_text("".join(f"line {i:05d}\n" for i in range(1, 10001)))
+    gptcode._LINE_INDEX_CACHE.clear()
+    result = gptcode.read_file(str(target), max_bytes=110)
+    assert not gptcode._LINE_INDEX_CACHE  # ohne Bereich kein Zeilenindex
+    assert result.startswith("line 00001\nline 00002\n")
+    assert "line 00011" not in result
+    assert (
+        "gekürzt: noch 9990 Zeilen bis Zeile 10000; weiter mit start_line=11" in result
+    )
+
+
+def test_read_file_line_and_byte_ranges_use_cached_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(gptcode, "READ_FILE_MMAP_THRESHOLD", 1024)
+    gptcode._LINE_INDEX_CACHE.clear()
+    target = tmp_path / "data.txt"
+    target.write_text("".join(f"row {i}\n" for i in range(1, 5001)))
+
+    first = gptcode.read_file(str(target), start_line=100, end_line=102)
+    assert first.splitlines() == [
+        f"[read_file] {target} Zeilen 100–102 von 5000",
+        "row 100",
+        "row 101",
+        "row 102",
+    ]
+    assert len(gptcode._LINE_INDEX_CACHE) == 1
+    builds = []
+    original = gptcode._line_index
+
+    def counting_index(key, data):
+        if key not in gptcode._LINE_INDEX_CACHE:
+            builds.append(key)
+        return original(key, data)
+
+    monkeypatch.setattr(gptcode, "_line_index", counting_index)
+    assert gptcode.read_file(str(target), start_line=4999).endswith(
+        "row 4999\nrow 5000\n"
+    )
+    assert builds == []
+
+    by_bytes = gptcode.read_file(str(target), offset=0, length=6)
+    assert (
+        by_bytes
+        == f"[read_file] {target} Bytes 0–6 von {target.stat().st_size}\nrow 1\n"
+    )
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.setattr(gptcode, "INDEX_DIR", tmp_path / "index")
+    monkeypatch.setattr(gptcode, "_PROJECT_INDEXES", {})
+    root = tmp_path / "repo"
+    (root / "src" / "pkg").mkdir(parents=True)
+    (root / "build").mkdir()
+    (root / ".gitignore").write_text("build/\n*.log\n!keep.log\n")
+    (root / "src" / "pkg" / "core.py").write_text(
+        "import os\n\ndef load_config(path):\n    return path\n"
+    )
+    (root / "src" / "pkg" / "cli.py").write_text(
+        "from .core import load_config\n\nload_config('x')\n"
+    )
+    (root / "build" / "core.py").write_text("def load_config(): pass\n")
+    (root / "debug.log").write_text("load_config\n")
+    (root / "keep.log").write_text("nichts\n")
+    return root
+
+
+def test_project_index_respects_gitignore_and_refreshes_incrementally(
+    project, monkeypatch
+):
+    index = gptcode.project_index(str(project))
+    assert index.files() == [
+        ".gitignore",
+        "keep.log",
+        "src/pkg/cli.py",
+        "src/pkg/core.py",
+    ]
+    assert index.store_path.exists()
+
+    scanned = []
+    original = gptcode.os.scandir
+    monkeypatch.setattr(
+        gptcode.os, "scandir", lambda p: scanned.append(p) or original(p)
+    )
+    assert index.refresh() is False and scanned == []
+
+    (project / "src" / "pkg" / "new.py").write_text("x = 1\n")
+    assert index.refresh() is True
+    assert scanned == [str(project / "src" / "pkg")]
+    assert "src/pkg/new.py" in index.files()
+
+    reloaded = gptcode.ProjectIndex(str(project))
+    reloaded.load()
+    assert reloaded.dirs.keys() == index.dirs.keys()
+
+
+@pytest.mark.parametrize("use_pool", [False, True])
+def test_search_ranks_definitions_first_with_context(project, monkeypatch, use_pool):
+    if use_pool:
+        monkeypatch.setitem(gptcode.sys.modules, "gptcode", gptcode)
+        monkeypatch.setattr(gptcode, "SEARCH_POOL_MIN_FILES", 1)
+        monkeypatch.setattr(gptcode, "SEARCH_WORKERS", 2)
+    sess = gptcode.Session(client=None, model="m", cwd=str(project))
+    out = gptcode.dispatch_tool(sess, "search", {"query": "load_config", "context": 1})
+    lines = out.splitlines()
+    assert "2 Dateien mit Treffern" in lines[0]
+    assert lines[1:4] == [
+        "src/pkg/core.py-2-",
+        "src/pkg/core.py:3:def load_config(path):",
+        "src/pkg/core.py-4-    return path",
+    ]
+    assert "build/" not in out and "debug.log" not in out
+
+    found = gptcode.dispatch_tool(
+        sess, "find_files", {"pattern": "*.py", "path": "src"}
+    )
+    assert found.splitlines()[1:] == ["src/pkg/cli.py", "src/pkg/core.py"]
+    if use_pool:
+        pool = gptcode._SEARCH_POOL
+        assert pool is not None and pool._mp_context.get_start_method() != "fork"
+        gptcode._shutdown_search_pool()
+        assert gptcode._SEARCH_POOL is None
+
+
+def test_search_falls_back_in_process_when_pool_hangs(project, monkeypatch):
+    discarded = []
+    hung = SimpleNamespace(
+        submit=lambda *args: Future(),
+        shutdown=lambda **kwargs: discarded.append(kwargs),
+    )
+    monkeypatch.setattr(gptcode, "SEARCH_POOL_MIN_FILES", 1)
+    monkeypatch.setattr(gptcode, "SEARCH_WORKERS", 2)
+    monkeypatch.setattr(gptcode, "SEARCH_POOL_TIMEOUT", 0.1)
+    monkeypatch.setattr(gptcode, "_search_pool", lambda: hung)
+    sess = gptcode.Session(client=None, model="m", cwd=str(project))
+    out = gptcode.dispatch_tool(sess, "search", {"query": "load_config"})
+    assert "2 Dateien mit Treffern" in out.splitlines()[0]
+    assert discarded == [{"wait": False, "cancel_futures": True}]
+
+
+def test_list_dir_renders_filtered_tree_and_caches_by_mtime(project, monkeypatch):
+    (project / "node_modules" / "lib").mkdir(parents=True)
+    for i in range(5):
+        (project / "src" / f"m{i}.txt").write_text("x" * 2048)
+    sess = gptcode.Session(client=None, model="m", cwd=str(project))
+
+    out = gptcode.dispatch_tool(sess, "list_dir", {"depth": 3, "max_entries": 4})
+    lines = out.splitlines()
+    assert lines[0] == f"[list_dir] {project} (3 ignoriert)"
+    assert "build/" not in out and "node_modules/" not in out and "debug.log" not in out
+    assert (
+        "  pkg/" in lines and "    core.py  50B" in lines and "  m0.txt  2.0K" in lines
+    )
+    assert lines[1:4] == ["src/", "  pkg/", "    cli.py  48B"]
+    assert "  … 2 weitere Einträge" in lines
+
+    scanned = []
+    original = gptcode.os.scandir
+    monkeypatch.setattr(
+        gptcode.os, "scandir", lambda p: scanned.append(p) or original(p)
+    )
+    assert (
+        gptcode.dispatch_tool(sess, "list_dir", {"depth": 3, "max_entries": 4}) == out
+    )
+    assert scanned == []
+
+    filtered = gptcode.dispatch_tool(
+        sess, "list_dir", {"path": "src", "depth": 3, "glob": "*.py"}
+    )
+    assert filtered.splitlines()[1:] == ["pkg/", "  cli.py  48B", "  core.py  50B"]
+    assert "node_modules/" in gptcode.dispatch_tool(sess, "list_dir", {"all": True})
+
+
+def test_edit_file_applies_exact_fuzzy_and_line_edits_atomically(tmp_path, sess):
+    target = tmp_path / "mod.py"
+    body = "".join(f"x{i} = {i}\n" for i in range(200))
+    target.write_text("def f(a):\n    if a:\n        return 1\n    return 0\n" + body)
+    target.chmod(0o640)
+
+    out = gptcode.dispatch_tool(
+        sess,
+        "edit_file",
+        {
+            "path": str(target),
+            "edits": [
+                {
+                    "search": "  if a:\n      return 1",
+                    "replace": "  if a is not None:\n      return 2",
+                },
+                {"start_line": 6, "end_line": 6, "replace": "x1 = 'eins'"},
+            ],
+        },
+    )
+    lines = target.read_text().splitlines()
+    assert lines[:4] == [
+        "def f(a):",
+        "    if a is not None:",
+        "        return 2",
+        "    return 0",
+    ]
+    assert lines[5] == "x1 = 'eins'" and len(lines) == 204
+    assert oct(target.stat().st_mode & 0o777) == oct(0o640)
+    assert "+3/-3" in out and "whitespace" in out and "x150" not in out
+    assert len(out.splitlines()) < 20
+    assert [p.name for p in tmp_path.iterdir()] == ["mod.py"]
+
+    before = target.read_text()
+    bad = gptcode.dispatch_tool(
+        sess,
+        "edit_file",
+        {
+            "path": str(target),
+            "edits": [
+                {"search": "x7 = 7", "replace": "x7 = 8"},
+                {"search": "x2", "replace": "y2"},
+            ],
+        },
+    )
+    assert "mehrdeutig" in bad and target.read_text() == before
+    fuzzy = gptcode.dispatch_tool(
+        sess,
+        "edit_file",
+        {
+            "path": str(target),
+            "edits": [
+                {
+                    "search": "def f(a):\n    if a is not None:\n        return  2",
+                    "replace": "def f(a):\n    return a",
+                },
+            ],
+        },
+    )
+    assert "unscharf" in fuzzy and target.read_text().startswith(
+        "def f(a):\n    return a\n    return 0\n"
+    )
+
+
+def test_apply_patch_validates_all_files_before_writing(tmp_path, sess):
+    sess.cwd = str(tmp_path)
+    (tmp_path / "a.txt").write_text("".join(f"zeile {i}\n" for i in range(1, 21)))
+    (tmp_path / "b.txt").write_text("alpha\nbeta\ngamma\n")
+    patch = (
+        "--- a/a.txt\n+++ b/a.txt\n"
+        "@@ -2,3 +2,3 @@\n zeile 5\n-zeile 6\n+ZEILE 6\n zeile 7\n"
+        "--- a/b.txt\n+++ b/b.txt\n"
+        "@@ -1,3 +1,3 @@\n alpha\n-BETA\n+delta\n gamma\n"
+    )
+    out = gptcode.dispatch_tool(sess, "apply_patch", {"patch": patch})
+    assert "nicht anwendbar" in out and "b.txt Hunk 1" in out and "'BETA'" in out
+    assert "ZEILE" not in (tmp_path / "a.txt").read_text()
+
+    sess.dryrun = True
+    fixed = patch.replace("-BETA", "-beta")
+    dry = gptcode.dispatch_tool(sess, "apply_patch", {"patch": fixed})
+    assert (
+        dry.startswith("[apply_patch:DRYRUN] Patch anwendbar")
+        and "a.txt Hunk 1: Offset +3" in dry
+    )
+    assert "ZEILE" not in (tmp_path / "a.txt").read_text()
+
+    sess.dryrun = False
+    new_file = "--- /dev/null\n+++ neu/c.txt\n@@ -0,0 +1,2 @@\n+eins\n+zwei\n"
+    out = gptcode.dispatch_tool(sess, "apply_patch", {"patch": fixed + new_file})
+    assert out.startswith("[apply_patch] Patch angewendet")
+    assert (tmp_path / "a.txt").read_text().splitlines()[5] == "ZEILE 6"
+    assert (tmp_path / "b.txt").read_text() == "alpha\ndelta\ngamma\n"
+    assert (tmp_path / "neu" / "c.txt").read_text() == "eins\nzwei\n"
+
+
+def test_apply_patch_tolerates_fuzz_and_missing_final_newline(tmp_path):
+    target = tmp_path / "f.py"
+    target.write_text("import os\nimport sys\n\ndef main():\n    return 1")
+    patch = (
+        "--- f.py\n+++ f.py\n"
+        "@@ -3,4 +3,4 @@\n import json\n \n def main():\n-    return 1\n\\ No newline at end of file\n"
+        "+    return 0\n\\ No newline at end of file\n"
+    )
+    out = gptcode.apply_patch(patch, cwd=str(tmp_path))
+    assert "Fuzz 1" in out
+    assert target.read_text() == "import os\nimport sys\n\ndef main():\n    return 0"
+
+
+def test_apply_patch_keeps_crlf_line_endings(tmp_path):
+    target = tmp_path / "f.txt"
+    target.write_bytes(b"one\r\ntwo\r\nthree\r\n")
+    patch = "--- f.txt\n+++ f.txt\n@@ -1,3 +1,3 @@\n one\n-two\n+TWO\n three\n"
+    gptcode.apply_patch(patch, cwd=str(tmp_path))
+    assert target.read_bytes() == b"one\r\nTWO\r\nthree\r\n"